@@ -0,0 +1,196 @@
+"""
+Offline benchmark: screenshot decoding, resizing, template matching and stage detection, without a device.
+
+Screens are composed by the game simulator of `fgobot.sim` from the bundled templates,
+with the sample quest and friend images of the repo, over a sample screenshot.
+The bot runs on a stand-in device which shows a fixed screen and ignores commands.
+Each case is timed with cold match caches, and the results are printed as one JSON object.
+With `--baseline`, cases slower than the baseline by more than `--tolerance` are listed
+as regressions and the exit status is 1.
+
+usage: python benchmarks/offline.py [--repeat N] [--output results.json] [--baseline old.json] [--tolerance 1.25]
+"""
+import argparse
+import json
+import logging
+import platform
+import statistics
+import struct
+import sys
+import tempfile
+from pathlib import Path
+from time import monotonic, perf_counter
+from typing import Callable, Dict, List
+
+import cv2 as cv
+import numpy as np
+
+ROOT = Path(__file__).absolute().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from fgobot import device, sim  # noqa: E402
+from fgobot.bot import BattleBot  # noqa: E402
+from fgobot.stream import Frame  # noqa: E402
+
+ENGINES = {'full': device.FULL_MATCH, 'pyramid': device.PYRAMID_MATCH}
+
+# the names of the templates of the simulator as loaded by `BattleBot`
+BOT_NAMES = {'friend': 'f_0'}
+
+
+class StandIn:
+    """
+    Stands in for the device of a `Device`, through `Device.replay`:
+    commands get no output, the waits do not sleep, and `update_screen` shows `screen`.
+    """
+
+    def __init__(self, dev: device.Device, screen: np.ndarray):
+        self.screen = screen
+        dev.probed = True
+        dev.replay = self
+
+    def next_frame(self) -> Frame:
+        return Frame(0, monotonic(), self.screen)
+
+    def command(self, cmd: List[str]) -> bytes:
+        return b''
+
+    def clock(self) -> float:
+        return monotonic()
+
+
+def timeit(fn: Callable, repeat: int, setup: Callable = None) -> Dict[str, float]:
+    """
+    Time `fn` `repeat` times after a warm-up call, calling `setup` untimed before each call.
+
+    :return: the median, min and max seconds.
+    """
+    samples = []
+    for n in range(repeat + 1):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        fn()
+        if n:
+            samples.append(perf_counter() - start)
+    return {'median': statistics.median(samples), 'min': min(samples), 'max': max(samples)}
+
+
+def game_screens(workdir: Path, background: Path) -> Dict[str, np.ndarray]:
+    """
+    Return a screen of each state of the simulated game, in stage 2 of a battle.
+    """
+    templates, _ = sim.default_templates(workdir)
+    templates['quest'] = cv.imread(str(ROOT / 'exp_level5.png'), cv.IMREAD_COLOR)
+    templates['friend'] = cv.imread(str(ROOT / 'molgan-1.png'), cv.IMREAD_COLOR)
+    game = sim.Game(templates, background=cv.imread(str(background), cv.IMREAD_COLOR))
+    screens = {}
+    for state in sim.SCREENS:
+        game.state, game.stage = state, 2
+        screens[state] = game.screen()
+    return screens
+
+
+def bench_decode(screens: Dict[str, np.ndarray], repeat: int) -> Dict[str, dict]:
+    screen = screens['battle']
+    png = cv.imencode('.png', screen)[1].tobytes()
+    rgba = cv.cvtColor(screen, cv.COLOR_BGR2RGBA)
+    raw = struct.pack('<4I', screen.shape[1], screen.shape[0], 1, 0) + rgba.tobytes()
+    large = cv.resize(screen, (1920, 1080))
+
+    results = {}
+    dev = device.Device(capture_method=device.FROM_SHELL, adb_server=None)
+    results['decode/png'] = timeit(lambda: dev.decode_screen(png), repeat)
+    # `screencap -p` through a pty turns LF into CRLF, undone by `__png_sanitize`
+    crlf = png.replace(b'\n', b'\r\n')
+    results['decode/png_crlf'] = timeit(lambda: dev.decode_screen(crlf), repeat)
+    dev = device.Device(capture_method=device.RAW_SHELL, adb_server=None)
+    results['decode/raw'] = timeit(lambda: dev.decode_screen(raw), repeat)
+    dev.zoom_switch = True
+    results['resize/1920x1080'] = timeit(lambda: dev.screen_adapter(large), repeat)
+    return results
+
+
+def bench_engine(name: str, screens: Dict[str, np.ndarray], repeat: int) -> Dict[str, dict]:
+    bot = BattleBot(quest=str(ROOT / 'exp_level5.png'), friend=str(ROOT / 'molgan-1.png'),
+                    match_engine=ENGINES[name], learn_timing=False, adb_server=None)
+    dev = bot.device
+    stand_in = StandIn(dev, screens['terminal'])
+
+    def show(state: str):
+        stand_in.screen = screens[state]
+        dev.update_screen()
+        dev.match_cache = {}
+
+    # every template on the screen showing it
+    pairs = [(state, BOT_NAMES.get(im, im).format(stage=2)) for state, (ims, _) in sim.SCREENS.items() for im in ims]
+    dev.images  # load the templates untimed
+
+    def match_all():
+        for state, im in pairs:
+            show(state)
+            dev.match(im)
+
+    results = {}
+    results['match/{}/all'.format(name)] = timeit(match_all, repeat)
+    results['match/{}/present'.format(name)] = timeit(lambda: dev.exists('attack'), repeat,
+                                                       lambda: show('battle'))
+    results['match/{}/absent'.format(name)] = timeit(lambda: dev.exists('attack'), repeat,
+                                                      lambda: show('support'))
+    # private methods of the bot are timed as they are called in a battle
+    results['stage/{}'.format(name)] = timeit(bot._BattleBot__get_current_stage, repeat,
+                                              lambda: show('battle'))
+    results['support/{}'.format(name)] = timeit(lambda: bot.select_friend(1), repeat,
+                                                lambda: show('support'))
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[dict]:
+    """
+    Return the cases whose median is more than `tolerance` times the baseline's.
+    """
+    regressions = []
+    for case, result in results.items():
+        old = baseline.get(case)
+        if old is not None and result['median'] > old['median'] * tolerance:
+            regressions.append({'case': case, 'ratio': result['median'] / old['median']})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES))
+    parser.add_argument('--background', type=Path, default=ROOT / 'how_to_run.png')
+    parser.add_argument('--output', type=Path, help='also write the results to this file')
+    parser.add_argument('--baseline', type=Path, help='the results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        screens = game_screens(Path(workdir), args.background)
+    results = bench_decode(screens, args.repeat)
+    for name in args.engines:
+        results.update(bench_engine(name, screens, args.repeat))
+
+    report = {
+        'python': platform.python_version(),
+        'opencv': cv.__version__,
+        'machine': platform.machine(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            report['regressions'] = compare(results, json.load(f)['results'], args.tolerance)
+    output = json.dumps(report, indent=2)
+    if args.output is not None:
+        args.output.write_text(output)
+    print(output)
+    if report.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
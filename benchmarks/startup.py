@@ -0,0 +1,62 @@
+"""
+Startup benchmark: time to import fgobot, create a BattleBot and capture the first screen.
+
+Each sample runs in a fresh interpreter so import caches do not hide the cost.
+Results are printed as one JSON object.
+
+usage: python benchmarks/startup.py [--runs N] [--port 127.0.0.1:16384] [--quest exp_level5.png] [--friend molgan-1.png]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).absolute().parent.parent
+
+# runs in the child interpreter, prints the timings as JSON
+PROBE = '''
+import json, sys
+from time import perf_counter
+t0 = perf_counter()
+from fgobot import bot
+t1 = perf_counter()
+b = bot.BattleBot(quest=sys.argv[1], friend=sys.argv[2], port=sys.argv[3])
+t2 = perf_counter()
+result = {'import': t1 - t0, 'init': t2 - t1}
+try:
+    b.device.update_screen()
+    result['first_action'] = perf_counter() - t2
+except Exception as e:
+    result['error'] = '{}: {}'.format(type(e).__name__, e)
+print(json.dumps(result))
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', default='127.0.0.1:16384')
+    parser.add_argument('--quest', default=str(ROOT / 'exp_level5.png'))
+    parser.add_argument('--friend', default=str(ROOT / 'molgan-1.png'))
+    args = parser.parse_args()
+
+    samples = []
+    for _ in range(args.runs):
+        out = subprocess.check_output([sys.executable, '-c', PROBE, args.quest, args.friend, args.port], cwd=ROOT)
+        samples.append(json.loads(out.decode('utf-8').splitlines()[-1]))
+
+    report = {'runs': args.runs}
+    for key in ('import', 'init', 'first_action'):
+        values = [s[key] for s in samples if key in s]
+        if values:
+            report[key] = {'median': statistics.median(values), 'max': max(values)}
+    errors = sorted({s['error'] for s in samples if 'error' in s})
+    if errors:
+        report['errors'] = errors
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,11 @@
+import importlib
 import logging
-from . import bot
-from . import device
\ No newline at end of file
+
+# submodules are imported on first access, so `import fgobot` stays cheap
+__all__ = ['adb', 'aio', 'bot', 'bundle', 'device', 'exporter', 'farm', 'history', 'input', 'matching', 'profiler', 'sim', 'spans', 'stream', 'timing', 'trace', 'wait']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
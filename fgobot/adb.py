@@ -0,0 +1,261 @@
+"""
+Client of the adb server protocol.
+
+Talks to the adb server directly over a local socket instead of forking an
+`adb` client for every command.
+"""
+import logging
+import os
+import socket
+import threading
+import uuid
+from typing import Tuple, Union
+
+# the default address of the adb server
+ADB_HOST = '127.0.0.1'
+ADB_PORT = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+
+
+class AdbError(Exception):
+    """
+    Raised when the adb server refuses a request.
+    """
+
+
+class AdbClient:
+    """
+    A client that speaks the adb server protocol over local sockets.
+
+    Shell commands are written to a long-lived `exec:sh` stream on the device,
+    which is reused across calls. Each thread gets its own stream, so a capture
+    on a background thread does not hold up taps. If the stream breaks, a new
+    one is opened; if that fails too, the command runs on a one-shot `exec:` stream.
+    """
+
+    def __init__(self, serial: str = None,
+                 host: str = ADB_HOST,
+                 port: int = ADB_PORT,
+                 timeout: int = 15,
+                 ):
+        """
+
+        :param serial: the serial of the target device. If not given, use the only connected device.
+        :param host: the host of the adb server.
+        :param port: the port of the adb server.
+        :param timeout: the timeout of socket operations, in seconds.
+        """
+        self.logger = logging.getLogger('adb')
+        self.serial = serial
+        self.addr = (host, port)
+        self.timeout = timeout
+        self.local = threading.local()
+        self.sessions = set()
+        self.lock = threading.Lock()
+
+    def __connect(self) -> socket.socket:
+        sock = socket.create_connection(self.addr, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    @staticmethod
+    def send_request(sock: socket.socket, payload: str):
+        """
+        Send a request to the adb server and check its reply.
+
+        :param sock: the socket connected to the adb server.
+        :param payload: the request, such as 'host:transport-any'.
+        """
+        data = payload.encode('utf-8')
+        sock.sendall('{:04x}'.format(len(data)).encode('ascii') + data)
+        status = AdbClient.recv_exactly(sock, 4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            length = int(AdbClient.recv_exactly(sock, 4), 16)
+            message = AdbClient.recv_exactly(sock, length).decode('utf-8', 'replace')
+            raise AdbError('{}: {}'.format(payload, message))
+        raise AdbError('{}: unexpected reply {!r}'.format(payload, status))
+
+    @staticmethod
+    def recv_exactly(sock: socket.socket, size: int) -> bytes:
+        """
+        Receive exactly `size` bytes from the socket.
+        """
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = sock.recv(size - len(buf))
+            if not chunk:
+                raise AdbError('Connection closed by adb server.')
+            buf += chunk
+        return bytes(buf)
+
+    def host(self, query: str) -> str:
+        """
+        Send a query to the adb server itself, such as 'host:devices', and return its answer.
+
+        :param query: the host service.
+        :return: the answer of the adb server.
+        """
+        sock = self.__connect()
+        try:
+            self.send_request(sock, query)
+            length = int(self.recv_exactly(sock, 4), 16)
+            return self.recv_exactly(sock, length).decode('utf-8', 'replace')
+        finally:
+            sock.close()
+
+    def open(self, service: str) -> socket.socket:
+        """
+        Open a stream to a service on the device, such as 'exec:ls' or 'shell:'.
+
+        :param service: the device service.
+        :return: the socket, switched to the service stream.
+        """
+        sock = self.__connect()
+        try:
+            if self.serial:
+                self.send_request(sock, 'host:transport:{}'.format(self.serial))
+            else:
+                self.send_request(sock, 'host:transport-any')
+            self.send_request(sock, service)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    def exec(self, cmd: str) -> bytes:
+        """
+        Execute a shell command on the device and return its raw output.
+
+        :param cmd: the command line.
+        :return: the stdout and stderr of the command.
+        """
+        if '\n' not in cmd:
+            for _ in range(2):
+                session = getattr(self.local, 'session', None)
+                try:
+                    if session is None:
+                        session = ShellSession(self)
+                        self.local.session = session
+                        with self.lock:
+                            self.sessions.add(session)
+                    return session.run(cmd)
+                except TimeoutError:
+                    # the command may have run already, do not send it twice
+                    self.__drop(session)
+                    raise
+                except (OSError, AdbError) as e:
+                    self.logger.debug('Shell session broken: {}'.format(e))
+                    self.__drop(session)
+        return self.exec_once(cmd)
+
+    def __drop(self, session: 'ShellSession'):
+        self.local.session = None
+        if session is not None:
+            session.close()
+            with self.lock:
+                self.sessions.discard(session)
+
+    def exec_once(self, cmd: str) -> bytes:
+        """
+        Execute a shell command on a dedicated `exec:` stream.
+
+        :param cmd: the command line.
+        :return: the stdout and stderr of the command.
+        """
+        sock = self.open('exec:{}'.format(cmd))
+        try:
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b''.join(chunks)
+        finally:
+            sock.close()
+
+    def close(self):
+        """
+        Close the long-lived shell streams of all threads.
+        """
+        with self.lock:
+            sessions, self.sessions = self.sessions, set()
+        for session in sessions:
+            session.close()
+        self.local = threading.local()
+
+
+def shell_line(cmd: str, marker: bytes) -> bytes:
+    """
+    Return the line to write to a long-lived `sh` to run `cmd`, followed by
+    a marker line carrying its exit status.
+
+    :param cmd: the command line, must not contain a newline.
+    :param marker: the marker of the shell session.
+    """
+    return "{{ {}; }} 2>&1; printf '\\n{}%d\\n' $?\n".format(cmd, marker.decode('ascii')).encode('utf-8')
+
+
+def pop_output(buf: bytearray, marker: bytes, start: int = 0) -> Tuple[Union[bytes, None], int]:
+    """
+    Take the output of a command out of the bytes received from a shell session.
+
+    :param buf: the received bytes, consumed up to the end of the marker line if found.
+    :param marker: the marker of the shell session.
+    :param start: the position to search from, as returned by the previous call.
+    :return: the output, or None if the marker line is not complete yet, \
+        and the position to search from once more bytes are received.
+    """
+    tail = b'\n' + marker
+    pos = buf.find(tail, start)
+    if pos == -1:
+        return None, max(0, len(buf) - len(tail))
+    end = buf.find(b'\n', pos + len(tail))
+    if end == -1:
+        return None, pos
+    output = bytes(buf[:pos])
+    del buf[:end + 1]
+    return output, 0
+
+
+def new_marker() -> bytes:
+    return '__fgobot_{}__'.format(uuid.uuid4().hex).encode('ascii')
+
+
+class ShellSession:
+    """
+    A long-lived `sh` process on the device, fed with commands through one socket.
+
+    Each command is followed by a marker line carrying its exit status,
+    so the output of consecutive commands can be told apart.
+    """
+
+    def __init__(self, client: AdbClient):
+        self.sock = client.open('exec:sh')
+        self.marker = new_marker()
+        self.buf = bytearray()
+
+    def run(self, cmd: str) -> bytes:
+        """
+        Run a command and return its output.
+
+        :param cmd: the command line, must not contain a newline.
+        :return: the output of the command.
+        """
+        self.sock.sendall(shell_line(cmd, self.marker))
+        start = 0
+        while True:
+            output, start = pop_output(self.buf, self.marker, start)
+            if output is not None:
+                return output
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise AdbError('Shell session closed.')
+            self.buf += chunk
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
@@ -0,0 +1,470 @@
+"""
+asyncio device I/O, to drive many devices from one process.
+
+Commands are sent to the adb server over asyncio streams, falling back to an
+asyncio subprocess of the adb executable, and template matching runs in an
+executor, so waiting on one device never blocks the others.
+
+Only the device is asynchronous. `BattleBot` and its stage handlers stay synchronous,
+and `run_bots` runs each of them on a thread of its own. Code that drives the
+devices itself, with `AsyncDevice`, is the one that runs on the event loop alone.
+"""
+import asyncio
+import logging
+import subprocess
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from random import randint
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Union
+
+from . import spans
+from .adb import ADB_HOST, ADB_PORT, AdbError, new_marker, pop_output, shell_line
+from .device import (Device, Match, SCREENCAP_CMDS, SPAN_ADB, SPAN_ADB_OTHER, SPAN_CAPTURE, SPAN_INPUT,
+                     SPAN_SLEEP, SPAN_WAIT_ANY, SPAN_WAIT_MATCH)
+from .wait import Poller, count_deadline
+
+
+class AsyncAdbClient:
+    """
+    An asyncio client of the adb server protocol, see `adb.AdbClient`.
+
+    Shell commands are written to long-lived `exec:sh` streams. Idle streams are
+    kept for reuse, and a new one is opened when all are busy, so concurrent
+    commands, e.g. a capture and a tap, do not wait for each other.
+    """
+
+    def __init__(self, serial: str = None,
+                 host: str = ADB_HOST,
+                 port: int = ADB_PORT,
+                 timeout: int = 15,
+                 ):
+        """
+
+        :param serial: the serial of the target device. If not given, use the only connected device.
+        :param host: the host of the adb server.
+        :param port: the port of the adb server.
+        :param timeout: the timeout of a command, in seconds.
+        """
+        self.logger = logging.getLogger('aio')
+        self.serial = serial
+        self.addr = (host, port)
+        self.timeout = timeout
+        self.idle = []  # type: List[AsyncShellSession]
+
+    @staticmethod
+    async def send_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, payload: str):
+        """
+        Send a request to the adb server and check its reply.
+        """
+        data = payload.encode('utf-8')
+        writer.write('{:04x}'.format(len(data)).encode('ascii') + data)
+        await writer.drain()
+        try:
+            status = await reader.readexactly(4)
+            if status == b'OKAY':
+                return
+            if status == b'FAIL':
+                length = int(await reader.readexactly(4), 16)
+                message = (await reader.readexactly(length)).decode('utf-8', 'replace')
+                raise AdbError('{}: {}'.format(payload, message))
+        except asyncio.IncompleteReadError:
+            raise AdbError('Connection closed by adb server.')
+        raise AdbError('{}: unexpected reply {!r}'.format(payload, status))
+
+    async def open(self, service: str) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """
+        Open a stream to a service on the device, such as 'exec:ls'.
+        """
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.addr), self.timeout)
+        try:
+            if self.serial:
+                await self.send_request(reader, writer, 'host:transport:{}'.format(self.serial))
+            else:
+                await self.send_request(reader, writer, 'host:transport-any')
+            await self.send_request(reader, writer, service)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def exec(self, cmd: str) -> bytes:
+        """
+        Execute a shell command on the device and return its raw output.
+
+        :param cmd: the command line.
+        :return: the stdout and stderr of the command.
+        """
+        if '\n' not in cmd:
+            for _ in range(2):
+                session = self.idle.pop() if self.idle else None
+                try:
+                    if session is None:
+                        session = await AsyncShellSession.open(self)
+                    output = await asyncio.wait_for(session.run(cmd), self.timeout)
+                except asyncio.TimeoutError:
+                    # the command may have run already, do not send it twice
+                    if session is not None:
+                        session.close()
+                    raise TimeoutError('Command timed out: {}'.format(cmd))
+                except (OSError, AdbError) as e:
+                    self.logger.debug('Shell session broken: {}'.format(e))
+                    if session is not None:
+                        session.close()
+                    continue
+                self.idle.append(session)
+                return output
+        try:
+            return await asyncio.wait_for(self.exec_once(cmd), self.timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('Command timed out: {}'.format(cmd))
+
+    async def exec_once(self, cmd: str) -> bytes:
+        """
+        Execute a shell command on a dedicated `exec:` stream.
+        """
+        reader, writer = await self.open('exec:{}'.format(cmd))
+        try:
+            return await reader.read()
+        finally:
+            writer.close()
+
+    def close(self):
+        """
+        Close the idle shell streams.
+        """
+        sessions, self.idle = self.idle, []
+        for session in sessions:
+            session.close()
+
+
+class AsyncShellSession:
+    """
+    A long-lived `sh` process on the device, see `adb.ShellSession`.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.marker = new_marker()
+        self.buf = bytearray()
+
+    @classmethod
+    async def open(cls, client: AsyncAdbClient) -> 'AsyncShellSession':
+        return cls(*await client.open('exec:sh'))
+
+    async def run(self, cmd: str) -> bytes:
+        """
+        Run a command and return its output.
+
+        :param cmd: the command line, must not contain a newline.
+        """
+        self.writer.write(shell_line(cmd, self.marker))
+        await self.writer.drain()
+        start = 0
+        while True:
+            output, start = pop_output(self.buf, self.marker, start)
+            if output is not None:
+                return output
+            chunk = await self.reader.read(65536)
+            if not chunk:
+                raise AdbError('Shell session closed.')
+            self.buf += chunk
+
+    def close(self):
+        self.writer.close()
+
+
+class AsyncDevice:
+    """
+    The asyncio counterpart of `Device`.
+
+    Images, search regions, the current screen and the settings are those of
+    the wrapped `Device`, which can still be used for anything not offered here.
+    So are its spans, and a trace recorder or replayer attached to it, see `trace`.
+    """
+
+    def __init__(self, device: Device = None, executor: Executor = None, **kwargs):
+        """
+
+        :param device: the device to drive. If not given, created from `kwargs`, see `Device`.
+        :param executor: the executor running template matching and decoding. \
+            If not given, the default executor of the event loop.
+        """
+        self.logger = logging.getLogger('aio')
+        self.device = device or Device(**kwargs)
+        self.executor = executor
+        self.adb = None
+        if self.device.adb is not None:
+            host, port = self.device.adb.addr
+            self.adb = AsyncAdbClient(self.device.adb.serial, host, port, self.device.timeout)
+
+    @property
+    def screen(self):
+        return self.device.screen
+
+    @property
+    def spans(self) -> spans.Spans:
+        return self.device.spans
+
+    async def __call(self, f: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(f, *args))
+
+    async def probe(self):
+        """
+        Connect to the device and get its screen size, see `Device.probe`.
+        """
+        if not self.device.probed:
+            await self.__call(self.device.probe)
+
+    async def run_cmd(self, cmd: List[str], raw: bool = False) -> Union[bytes, List[str]]:
+        """
+        Execute an adb command, see `Device`.
+
+        :param cmd: the command to execute, separated as a string list.
+        :param raw: whether to return the raw output
+        :return: the raw output, or the utf-8 decoded output separated by line.
+        """
+        device = self.device
+        if device.replay is not None:
+            output = device.replay.command(cmd)
+            return output if raw else output.decode('utf-8').splitlines()
+        await self.probe()
+        command, start = cmd, monotonic()
+        output = None
+        if self.adb is not None and cmd[0] in ('shell', 'exec-out'):
+            self.logger.debug('Executing command via adb server: {}'.format(' '.join(cmd)))
+            try:
+                output = await self.adb.exec(' '.join(cmd[1:]))
+            except TimeoutError:
+                raise subprocess.TimeoutExpired(cmd, self.device.timeout)
+            except (OSError, AdbError) as e:
+                self.logger.debug('adb server transport failed: {}'.format(e))
+        if output is None:
+            if self.device.serial and cmd[0] in ('shell', 'exec-out', 'pull'):
+                cmd = ['-s', self.device.serial] + cmd
+            cmd = [self.device.adb_path] + cmd
+            self.logger.debug('Executing command: {}'.format(' '.join(cmd)))
+            proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE)
+            try:
+                output, _ = await asyncio.wait_for(proc.communicate(), self.device.timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                raise subprocess.TimeoutExpired(cmd, self.device.timeout)
+            if proc.returncode:
+                raise subprocess.CalledProcessError(proc.returncode, cmd, output)
+        self.spans.since(SPAN_ADB.get(command[0], SPAN_ADB_OTHER), start)
+        if device.recorder is not None:
+            device.recorder.command(command, start, monotonic() - start, None if raw else output)
+        if raw:
+            return output
+        else:
+            return output.decode('utf-8').splitlines()
+
+    async def __input(self, cmd: str, action: str) -> bool:
+        start = monotonic()
+        output = await self.run_cmd(['shell', cmd])
+        self.device.last_action = monotonic()
+        self.spans.add(SPAN_INPUT, self.device.last_action - start)
+        for line in output:
+            if line.startswith('error'):
+                self.logger.error('Failed to {}'.format(action))
+                self.logger.error('Error message: {}'.format('\n'.join(output)))
+                return False
+        self.logger.debug('Done {}'.format(action))
+        return True
+
+    async def tap(self, x: int = 590, y: int = 230) -> bool:
+        """
+        Input a tap event at `pos:(x, y)`.
+
+        :return: whether the event is successful.
+        """
+        await self.probe()
+        x, y = self.device.tap_adapter((x, y))
+        return await self.__input(self.device.input.tap(x, y), 'tap {:d} {:d}'.format(x, y))
+
+    async def tap_rand(self, x: int, y: int, w: int, h: int) -> bool:
+        """
+        Input a tap event at a random position in the rectangle `(x, y)` and `(x+w, y+h)`.
+        """
+        return await self.tap(randint(x, x + w - 1), randint(y, y + h - 1))
+
+    async def tap_match(self, match: Match) -> bool:
+        """
+        Tap at a random position inside a matched image.
+        """
+        w, h = self.device.get_image_size(match.name)
+        x, y = match.loc
+        return await self.tap_rand(x, y, w, h)
+
+    async def swipe(self, pos0: Tuple[int, int], pos1: Tuple[int, int], duration: int = 1000) -> bool:
+        """
+        Input a swipe event from `pos0` to `pos1`, taking `duration` milliseconds.
+
+        :return: whether the event is successful.
+        """
+        await self.probe()
+        (x0, y0), (x1, y1) = self.device.tap_adapter(pos0), self.device.tap_adapter(pos1)
+        return await self.__input(self.device.input.swipe(x0, y0, x1, y1, duration),
+                                  'swipe {:d} {:d} {:d} {:d} {:d}'.format(x0, y0, x1, y1, duration))
+
+    async def update_screen(self):
+        """
+        Capture the screen, see `Device.update_screen`.
+        The screenshot is transferred asynchronously, and decoded in the executor.
+        """
+        device = self.device
+        cmd = SCREENCAP_CMDS.get(device.method)
+        if cmd is None or device.stream is not None or device.pipeline is not None or device.replay is not None:
+            await self.__call(device.update_screen)
+            return
+        frame_time = monotonic()
+        data = await self.run_cmd(cmd, raw=True)
+        await self.__call(self.__set_screen, data, frame_time)
+        self.logger.debug('Screen captured.')
+
+    def __set_screen(self, data: bytes, frame_time: float):
+        # decoded and resized to 1280x720
+        screen = self.device.decode_screen(data)
+        self.spans.since(SPAN_CAPTURE, frame_time)
+        self.device.set_screen(screen, frame_time)
+
+    async def match(self, img: str) -> Tuple[float, Tuple[int, int]]:
+        """
+        Match `img` with the screen in the executor, see `Device.match`.
+
+        :return: match-value and match-location.
+        """
+        return await self.__call(self.device.match, img)
+
+    async def match_many(self, imgs: Iterable[str]) -> Dict[str, Match]:
+        """
+        Match several images with the same screen in the executor, see `Device.match_many`.
+        """
+        return await self.__call(self.device.match_many, list(imgs))
+
+    async def exists(self, im: str, threshold: float = None) -> bool:
+        """
+        Check if a given image exists on screen.
+        """
+        prob, _ = await self.match(im)
+        return prob >= (threshold or self.device.threshold)
+
+    async def __poll(self, poller: Poller) -> bool:
+        sec = poller.next_interval(self.device.screen_changed)
+        if sec is None:
+            return False
+        await self.sleep(sec)
+        return True
+
+    async def sleep(self, sec: float):
+        """
+        Sleep without blocking the event loop, unless replaying, see `Device.clock`.
+        """
+        if self.device.replay is None:
+            start = monotonic()
+            await asyncio.sleep(sec)
+            self.spans.since(SPAN_SLEEP, start)
+
+    async def wait_match(self, im: str, sec: float = 1, threshold: float = None,
+                         countLimit: int = None, deadline: float = None) -> Union[Match, None]:
+        """
+        Update screen until the given image appears, see `Device.wait_match`.
+
+        :return: the match, or None if the image did not appear within the limits.
+        """
+        self.logger.debug("Wait until image '{}' appears.".format(im))
+        threshold = threshold or self.device.threshold
+        deadline = count_deadline(countLimit, sec, self.device.clock(), deadline)
+        poller = Poller(self.device.poll_interval, sec, deadline= deadline, clock= self.device.clock)
+        start = monotonic()
+        try:
+            while True:
+                await self.update_screen()
+                max_val, max_loc = await self.match(im)
+                if max_val >= threshold:
+                    return Match(im, max_val, max_loc)
+                if not await self.__poll(poller):
+                    self.logger.debug("Image '{}' did not appear before deadline.".format(im))
+                    return None
+        finally:
+            self.spans.since(SPAN_WAIT_MATCH, start)
+
+    async def wait_any(self, imgs: Dict[str, float], sec: float = 1,
+                       countLimit: int = None, deadline: float = None) -> Union[Match, None]:
+        """
+        Update screen until any of the given images appears, see `Device.wait_any`.
+
+        :return: the match of the first image in `imgs` that appears, \
+            or None if none appeared within the limits.
+        """
+        self.logger.debug("Wait until any of '{}' appears.".format("', '".join(imgs)))
+        deadline = count_deadline(countLimit, sec, self.device.clock(), deadline)
+        poller = Poller(self.device.poll_interval, sec, deadline= deadline, clock= self.device.clock)
+        start = monotonic()
+        try:
+            while True:
+                await self.update_screen()
+                for im, result in (await self.match_many(imgs)).items():
+                    if result.value >= (imgs[im] or self.device.threshold):
+                        self.logger.debug("Image '{}' appears.".format(im))
+                        return result
+                if not await self.__poll(poller):
+                    self.logger.debug('None of the images appeared before deadline.')
+                    return None
+        finally:
+            self.spans.since(SPAN_WAIT_ANY, start)
+
+    async def wait_until(self, im: str, sec: float = 1, threshold: float = None,
+                         countLimit: int = None, deadline: float = None) -> bool:
+        """
+        Update screen until the given image appears, see `Device.wait_until`.
+
+        :return: True after the im appears, False if it did not appear within the limits.
+        """
+        return await self.wait_match(im, sec, threshold, countLimit, deadline) is not None
+
+    async def wait_until_tap(self, im: str, sec: float = 1, threshold: float = None,
+                             deadline: float = None) -> bool:
+        """
+        Update screen until the given image appears and tap it at once.
+
+        :return: True after the click event is successful.
+        """
+        match = await self.wait_match(im, sec, threshold, deadline= deadline)
+        if match is None:
+            return False
+        return await self.tap_match(match)
+
+    def close(self):
+        """
+        Close the shell streams to the adb server.
+        """
+        if self.adb is not None:
+            self.adb.close()
+
+
+async def run_bots(bots: Iterable, max_loops: int = 3) -> List[Any]:
+    """
+    Run several `bot.BattleBot`s concurrently from one event loop, e.g. one per emulator.
+
+    This is not an asynchronous battle loop: the stage handlers of a `BattleBot` are
+    plain functions calling its blocking `Device`, so each bot runs on a worker thread
+    of its own, and the threads spend nearly all their time waiting on I/O.
+    New code driving devices asynchronously should use `AsyncDevice` instead.
+
+    :param bots: the bots, each bound to its own device.
+    :param max_loops: the max number of loops of each bot, see `BattleBot.run`.
+    :return: the result of `run` of each bot, or the exception it raised, in the order of `bots`.
+    """
+    bots = list(bots)
+    logger = logging.getLogger('aio')
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(max(len(bots), 1), thread_name_prefix='bot') as executor:
+        results = await asyncio.gather(*(loop.run_in_executor(executor, bot.run, max_loops) for bot in bots),
+                                       return_exceptions=True)
+    for n, result in enumerate(results):
+        if isinstance(result, BaseException):
+            logger.error('Bot {} failed: {!r}'.format(n, result))
+    return results
@@ -3,14 +3,23 @@ Game auto-playing bot.
 """
 
 import logging
+import os
+import sqlite3
+import sys
+import threading
 
+from collections import Counter
 from functools import partial
 from typing import Dict, Any, Callable
-from . import device
+from . import device, spans
+from .history import RunHistory
+from .input import InputBackend
+from .timing import TimingProfile
 import json
 from pathlib import Path
 from typing import Tuple, List, Union, Literal
 from random import randint
+from time import monotonic, time
 
 logger = logging.getLogger('bot')
 
@@ -18,6 +27,8 @@ logger = logging.getLogger('bot')
 INTERVAL_LONG = 20          # used in wait: loading battle, playing attack animation
 INTERVAL_MID   = 4          # used in wait: loading friend list 
 INTERVAL_SHORT = 1          # used in wait: pop up windows, any other case
+INTERVAL_TAP   = 0.2        # used in gesture batches: between taps on the same screen, such as command cards
+TIMEOUT_REFRESH = 10        # used in wait: friend list reloading after a refresh, before tapping refresh again
 
 # argument for calculating the position of friendlist class button
 ALL     = 0
@@ -30,6 +41,13 @@ ASSASSIN = 6
 BERSERKER = 7
 EXTRA   = 8
 
+# timing spans of the phases of a battle, see `spans`
+SPAN_BATTLE = spans.register('bot.battle')
+SPAN_ENTER_BATTLE = spans.register('bot.enter_battle')
+SPAN_SELECT_FRIEND = spans.register('bot.select_friend')
+SPAN_PLAY_BATTLE = spans.register('bot.play_battle')
+SPAN_END_BATTLE = spans.register('bot.end_battle')
+
 class BattleBot:
     """
     A class of the bot that automatically play battles.
@@ -44,6 +62,15 @@ class BattleBot:
                  quest_threshold: float = 0.97,
                  friend_threshold: float = 0.97,
                  port: str = '127.0.0.1:16384',
+                 capture_method: int = device.FROM_SHELL,
+                 match_engine: int = device.FULL_MATCH,
+                 settle: bool = False,
+                 learn_timing: bool = False,
+                 keep_history: bool = False,
+                 metrics_port: int = None,
+                 serial: str = None,
+                 input_backend: InputBackend = None,
+                 adb_server: Union[Tuple[str, int], None] = (device.ADB_HOST, device.ADB_PORT),
                  ):
         """
 
@@ -58,6 +85,19 @@ class BattleBot:
         :param quest_threshold: threshold of quest matching
         :param friend_threshold: threshold of friend matching
         :param port: the connect port of device
+        :param capture_method: the way to capture screen, `device.FROM_SHELL` or `device.RAW_SHELL`
+        :param match_engine: the template matching engine, `device.FULL_MATCH` or `device.PYRAMID_MATCH`
+        :param settle: if True, wait for loadings and attack animations until the screen stops moving, \
+                       at most `INTERVAL_LONG` seconds, instead of always `INTERVAL_LONG` seconds
+        :param learn_timing: if True, learn how long loadings take on this device and adapt \
+                             the waits of `INTERVAL_LONG` and `INTERVAL_MID` to it, see `timing.TimingProfile`. \
+                             The latencies are saved under the cache directory, `~/.cache/fgobot/timing`
+        :param keep_history: if True, record each run and battle in the run history, see `history`. \
+                             The history is kept under the cache directory, `~/.cache/fgobot/history.sqlite`
+        :param metrics_port: if given, export the metrics of this bot over HTTP on this port, see `exporter`
+        :param serial: the serial of the device, needed when more than one device is connected, see `farm`
+        :param input_backend: how taps and swipes are injected, e.g. `input.SendeventInput()` for raw touch events
+        :param adb_server: `(host, port)` of the adb server, or None to always use the adb executable
         """
         logger.info('Fgobot loading...')
 
@@ -91,7 +131,27 @@ class BattleBot:
 
         # Device
         self.device = device.Device(load_imgs= user_imgs, port= port, 
-                                    capture_method= device.FROM_SHELL)
+                                    capture_method= capture_method,
+                                    match_engine= match_engine,
+                                    serial= serial,
+                                    input_backend= input_backend,
+                                    adb_server= adb_server)
+
+        # durations of the phases of a battle, sharing the spans of the device
+        self.spans = self.device.spans
+        self.stage_spans = {stage: spans.register('bot.stage.{}'.format(stage))
+                            for stage in range(1, self.stage_count + 1)}
+        # the timing report of each battle played, see `spans.Spans.report`
+        self.reports = []
+        # events of the current battle, such as AP items used, refreshes of the support list
+        # and failures to detect the stage
+        self.counters = Counter()
+        # rounds played in the current battle, see `__play_battle`
+        self.rounds = 0
+        # battles completed in the current or last run, also when it was interrupted
+        self.count = 0
+        # the sampling profiler of the current run, see `run`
+        self.profiler = None
 
         # AP strategy
         self.ap = ap
@@ -100,6 +160,20 @@ class BattleBot:
         self.quest_threshold = quest_threshold
         self.friend_threshold = friend_threshold
 
+        self.settle = settle
+
+        # latencies observed on this device, saved after each battle
+        self.timing = TimingProfile.load(serial or port) if learn_timing else None
+        # the last sleep before polling for the result of an action, see `__sleep_before`
+        self.__slept = None
+
+        # runs are recorded keyed by device, script and quest
+        self.keep_history = keep_history
+        self.history_key = (serial or port, Path(sys.argv[0]).name or 'interactive', Path(quest).name)
+
+        if metrics_port is not None:
+            self.export_metrics(metrics_port)
+
         # Load button coords from config
         btn_path = Path(__file__).absolute().parent / 'config' / 'buttons.json'
         with open(btn_path) as f:
@@ -107,6 +181,70 @@ class BattleBot:
 
         logger.debug('Bot initialized.')
 
+    def export_metrics(self, port: int = 9464):
+        """
+        Export the metrics of this bot over HTTP, labeled by device, script and quest, see `exporter`.
+
+        :param port: the port of the exporter, shared by the bots of this process.
+        """
+        from . import exporter
+        labels = dict(zip(('device', 'script', 'quest'), self.history_key))
+        exporter.serve(port).add(self.spans, labels, self.device)
+
+    def __wait_animation(self, kind: str):
+        """
+        Wait for a loading or an animation to finish.
+
+        :param kind: the kind of wait its latency is learned as, 'enter' for loading a battle, \
+            'attack' for the attack animations or 'close' for leaving the battle. Loading the \
+            support list is learned as 'quest' after tapping the quest, and as 'continue' after \
+            continuing the last battle.
+        """
+        if self.settle:
+            self.__slept = (kind, self.device.clock(), 0, None)
+            self.device.wait_settled(timeout= self.__timeout(kind, INTERVAL_LONG))
+        else:
+            self.__sleep_before(kind, INTERVAL_LONG)
+
+    def __sleep_before(self, kind: str, default: float):
+        """
+        Sleep before polling for the result of an action, and remember the sleep for `__observe`.
+        """
+        sec = self.__sleep_time(kind, default)
+        self.device.wait(sec)
+        self.__slept = (kind, self.device.clock(), sec, self.device.frame_id)
+
+    def __sleep_time(self, kind: str, default: float) -> float:
+        """
+        Return the seconds to sleep before polling for the result of an action, learned if enabled.
+        """
+        return self.timing.sleep(kind, default) if self.timing else default
+
+    def __timeout(self, kind: str, default: float) -> float:
+        """
+        Return the seconds to wait at most for the result of an action, learned if enabled.
+        """
+        return self.timing.timeout(kind, default) if self.timing else default
+
+    def __observe(self, kind: str):
+        """
+        Record the latency of the result of an action, now on the current screen.
+
+        After a sleep of this kind, the latency is the sleep plus the time from its end to the
+        current screen. If the current screen is the first one captured after the sleep,
+        the result may have been there for a while: the sleep was too long.
+        Else, it is the time from the last action to the current screen.
+        """
+        slept, self.__slept = self.__slept, None
+        if not self.timing:
+            return
+        if slept is None or slept[0] != kind:
+            self.timing.observe(kind, self.device.frame_time - self.device.last_action)
+            return
+        _, end, sec, frame_id = slept
+        overslept = frame_id is not None and self.device.frame_id <= frame_id + 1
+        self.timing.observe(kind, sec + self.device.frame_time - end, overslept)
+
     def __add_stage_handler(self, stage: int, f: Callable):
         """
         Register a handler function to a given stage of the battle.
@@ -150,13 +288,14 @@ class BattleBot:
         """
         
         max_prob, max_stage = 0.70, -1
-        for stage in range(1, self.stage_count + 1):
-            im = '{}_{}'.format(stage, self.stage_count)
-            prob = self.device.probability(im)
-            if prob > max_prob:
-                max_prob, max_stage = prob, stage
+        ims = ['{}_{}'.format(stage, self.stage_count) for stage in range(1, self.stage_count + 1)]
+        results = self.device.match_many(ims)
+        for stage, im in enumerate(ims, 1):
+            if results[im].value > max_prob:
+                max_prob, max_stage = results[im].value, stage
 
         if max_stage == -1:
+            self.counters['stage_failures'] += 1
             logger.error('Failed to get current stage.')
         else:
             logger.debug('Got current stage: {}'.format(max_stage))
@@ -176,6 +315,7 @@ class BattleBot:
         self.device.tap(x, y)
         self.device.wait_and_updateScreen(INTERVAL_SHORT /2 )
 
+    @spans.phase(SPAN_SELECT_FRIEND)
     def select_friend(self, friendList_status:int ) -> bool:
         """
         Select friend and enter team select screen 
@@ -186,13 +326,12 @@ class BattleBot:
             self.__refresh_friendlist()
 
         swp_times = 0
+        friends = ['f_{}'.format(fid) for fid in range(self.friend_count)]
         while True:
-            for fid in range(self.friend_count):
-                im = 'f_{}'.format(fid)
-                logging.disable(logging.WARNING)
-                
-                if self.device.find_and_tap(im, threshold=self.friend_threshold):
-                    logging.disable(logging.NOTSET)
+            # match all friends on the same screen, prefer the former ones
+            for result in self.device.match_many(friends).values():
+                if result.value >= self.friend_threshold:
+                    self.device.tap_match(result)
                     self.device.wait(INTERVAL_SHORT)
                     return True
             # when all friends are not found
@@ -209,6 +348,7 @@ class BattleBot:
 
     def __refresh_friendlist(self):
         while True:
+            self.counters['refreshes'] += 1
             x, y = self.buttons['refresh_friends'].values()
             self.device.tap(x, y)
             self.device.wait(INTERVAL_SHORT)
@@ -216,12 +356,12 @@ class BattleBot:
             x, y = self.buttons['refresh_friends_yes'].values()
             self.device.tap(x, y)
             # if friend appear, quit loop, else tap refresh again 
-            if self.device.wait_until('view_friend_party', countLimit= 10):
+            if self.device.wait_until('view_friend_party', deadline= self.device.clock() + TIMEOUT_REFRESH):
                 break
     
     def __from_terminal_select_quest(self):
         """
-        Select quest. Update screen when return
+        Select quest, and sleep until the next screen is about to show.
 
         :Return: True if success,
 
@@ -231,8 +371,9 @@ class BattleBot:
         while not self.device.find_and_tap('quest', threshold=self.quest_threshold):
             self.__swipe('quest')
             self.device.wait_and_updateScreen(INTERVAL_SHORT)
-        self.device.wait_and_updateScreen(INTERVAL_MID)
+        self.__sleep_before('quest', INTERVAL_MID)
 
+    @spans.phase(SPAN_ENTER_BATTLE)
     def __enter_battle(self, battle_count: int) -> bool:
         """
         Enter the battle.
@@ -260,11 +401,14 @@ class BattleBot:
             # case 4: no enough AP in Ordeal Call quests
             'recover_ap'    :self.__recover_ap_OrdealCall
             }
-        for case, treatment in case_list.items():
-            if self.device.find_and_tap(case):
-                friendList_status = treatment()
-                break
-
+        # wait until one of the cases appears
+        result = self.device.wait_any(dict.fromkeys(case_list), INTERVAL_SHORT,
+                                      deadline= self.device.clock() + INTERVAL_LONG)
+        if result is not None:
+            # from tapping the quest, or from continuing the last battle
+            self.__observe('quest' if battle_count == 0 else 'continue')
+            self.device.tap_match(result)
+            friendList_status = case_list[result.name]()
         else:
             # need to check macro: INTERVAL used in 'wait()' or 'wait_and_updateScreen()' 
             # also check the images used to enter quest, path:./fgobot/images/ 
@@ -288,8 +432,9 @@ class BattleBot:
             self.device.wait_until_tap('start_quest')
 
         logger.info('wait...')
-        self.device.wait(INTERVAL_LONG)
+        self.__wait_animation('enter')
         self.device.wait_until('attack')
+        self.__observe('enter')
         logger.info('Enter success')
         return True
             
@@ -299,19 +444,9 @@ class BattleBot:
         return friend list status to control
         the behavior of select_friend()
         """
-        while True:
-            self.device.update_screen()
-            # friend appear
-            if self.device.exists('view_friend_party') :
-                return 1
-            
-            # no friend
-            elif self.device.exists('noSupport'):
-                return 0
-            
-            # loading has not finished
-            else:
-                self.device.wait(INTERVAL_SHORT *2)
+        # wait until friend appear or no friend
+        result = self.device.wait_any({'view_friend_party': None, 'noSupport': None}, INTERVAL_SHORT *2)
+        return 1 if result.name == 'view_friend_party' else 0
 
     def __recover_ap_normal(self):
         """
@@ -352,19 +487,21 @@ class BattleBot:
                 if  self.device.find_and_tap(ap_item):
                     self.device.wait_and_updateScreen(INTERVAL_SHORT)
                     self.device.find_and_tap('decide')
+                    self.counters['ap.' + ap_item] += 1
                     logger.info("Apple used")
                     return True
             else:
                 logger.error('找不到AP道具 或者 道具已用尽')
                 return False
 
+    @spans.phase(SPAN_PLAY_BATTLE)
     def __play_battle(self) -> int:
         """
         Play the battle.
 
         :return: count of rounds.
         """
-        rounds = 0
+        rounds = self.rounds = 0
         lastStage = 0
         while True:
             stage = self.__get_current_stage()
@@ -372,9 +509,11 @@ class BattleBot:
                 logger.error("Failed to get current stage. Quit battle...")
                 return -1
 
-            rounds += 1
+            rounds = self.rounds = rounds + 1
             
             # when fail to enter the next stage, go XJBD
+            start = monotonic()
+            previous = self.spans.enter(self.stage_spans[stage])
             if lastStage == stage:
                 logger.info('At stage {}/{}, round {}, go xjbd...'
                             .format(stage, self.stage_count, rounds))
@@ -383,19 +522,19 @@ class BattleBot:
                 logger.info('At stage {}/{}, round {}, calling handler function...'
                             .format(stage, self.stage_count, rounds))
                 self.stage_handlers[stage]()
-
-            while True:
-                if self.device.updateScreen_and_exists('bond'):
-                    logger.info("'与从者的牵绊' detected. Leaving battle...")
-                    return rounds
-                elif self.device.exists('attack'):
-                    logger.info("'Attack' detected. Continuing loop...")
-                    # update the last stage
-                    lastStage = stage
-                    break
-                else:
-                    self.device.wait(INTERVAL_SHORT *2)
-
+            self.spans.since(self.stage_spans[stage], start)
+            self.spans.enter(previous)
+
+            result = self.device.wait_any({'bond': None, 'attack': None}, INTERVAL_SHORT *2)
+            self.__observe('attack')
+            if result.name == 'bond':
+                logger.info("'与从者的牵绊' detected. Leaving battle...")
+                return rounds
+            logger.info("'Attack' detected. Continuing loop...")
+            # update the last stage
+            lastStage = stage
+
+    @spans.phase(SPAN_END_BATTLE)
     def __end_battle(self, battle_count: int, max_loops: int):
         """
         Click to end the billing page. Update screen when return
@@ -429,8 +568,9 @@ class BattleBot:
         else:
             self.device.find_and_tap('close')
             logger.info('wait...')
-            self.device.wait(INTERVAL_LONG)
+            self.__wait_animation('close')
             self.device.wait_until('menu')
+            self.__observe('close')
             return True
 
     def __wait_manual_operation(self, im: str, sec: int = INTERVAL_SHORT *2):
@@ -491,17 +631,16 @@ class BattleBot:
         x += self.buttons['servant_distance'] * (servant - 1)
         x += self.buttons['skill_distance'] * (skill - 1)
         logger.info('Used skill ({}, {})'.format(servant, skill))
-        self.device.tap(x, y)
-        self.device.wait(INTERVAL_SHORT)
+        gestures = device.Gestures().tap(x, y).wait(INTERVAL_SHORT)
         
         # skill reinforce, for example, KuKulcan
         if reinforceOrNot is not None:
             if reinforceOrNot:
                 x, y = self.buttons['skill_reinforce']['yes']
-                self.device.tap_and_wait(x, y, INTERVAL_SHORT/2)
             else:
                 x, y = self.buttons['skill_reinforce']['no']
-                self.device.tap_and_wait(x, y, INTERVAL_SHORT /2)
+            gestures.tap(x, y).wait(INTERVAL_SHORT /2)
+        self.device.perform(gestures)
 
         # when need to select object
         if self.device.updateScreen_and_exists('choose_object'):
@@ -532,12 +671,14 @@ class BattleBot:
         :param obj2: the second object of skill, if required.
         """
 
+        gestures = device.Gestures()
         x, y, w, h = self.buttons['master_skill_menu'].values()
-        self.device.tap_and_wait(x, y, INTERVAL_SHORT)
+        gestures.tap(x, y).wait(INTERVAL_SHORT)
 
         x, y, w, h = self.buttons['master_skill'].values()
         x += self.buttons['master_skill_distance'] * (skill - 1)
-        self.device.tap_and_wait(x, y, INTERVAL_SHORT)
+        gestures.tap(x, y).wait(INTERVAL_SHORT)
+        self.device.perform(gestures)
         logger.info('Used master skill {}'.format(skill))
 
         # when need to select 1 object
@@ -563,10 +704,10 @@ class BattleBot:
             elif 1 <= obj <= 3 and 4 <= obj2 <= 6:
                 x, y, w, h = self.buttons['change'].values()
                 x += self.buttons['change_distance'] * (obj - 1)
-                self.device.tap(x, y)
+                gestures = device.Gestures().tap(x, y)
 
                 x += self.buttons['change_distance'] * (obj2 - obj)
-                self.device.tap_and_wait(x, y, INTERVAL_SHORT)
+                self.device.perform(gestures.tap(x, y).wait(INTERVAL_SHORT))
                 logger.info('Chose order change object ({}, {}).'.format(obj, obj2))
 
                 self.device.find_and_tap('change')
@@ -580,13 +721,18 @@ class BattleBot:
         self.device.wait(INTERVAL_SHORT)
         self.device.wait_until('attack')
     
-    def __choose_enemy(self, enemy: int=3):
+    def __choose_enemy(self, enemy: int=3, gestures: device.Gestures = None):
         """
         choose enemy, as object of skill or attack. From left to right are 1, 2, 3
+
+        :param gestures: if given, add the tap to it instead of tapping at once
         """
         x, y = self.buttons['enemy'].values()
         x += self.buttons['enemy_distance'] * (enemy - 1)
-        self.device.tap(x, y)
+        if gestures is None:
+            self.device.tap(x, y)
+        else:
+            gestures.tap(x, y)
 
     def use_skill_enemy(self, servant:int, skill:int, enemy:int=3):
         """
@@ -617,22 +763,24 @@ class BattleBot:
         :param obj: the number of servant, should be one of [1,2,3]
         """
         # continuously tap
+        gestures = device.Gestures()
         for im in ['spell', 'spell_np', 'spell_decide']:
             x, y = self.buttons[im].values()
-            self.device.tap(x, y)
-            self.device.wait(INTERVAL_SHORT /2)
+            gestures.tap(x, y).wait(INTERVAL_SHORT /2)
 
         if 1 <= obj <= 3:
             x, y = self.buttons['choose_object'].values()
             x += self.buttons['choose_object_distance'] * (obj - 1)
+            # and tap for high speed animation
+            self.device.perform(gestures.tap(x, y).tap(590, 230))
             logger.info(f'Spell used, obj is servant[{obj}]')
-            self.device.tap(x, y)
         else:
+            self.device.perform(gestures)
             logger.warning(f'使用令咒的对象{obj}不恰当 应该是1、2或3.')
             self.__wait_manual_operation('choose_object')
 
-        # tap for high speed animation
-        self.device.tap()
+            # tap for high speed animation
+            self.device.tap()
         self.device.wait_until('attack', INTERVAL_SHORT*2)
         return
 
@@ -649,25 +797,25 @@ class BattleBot:
         assert len(set(cards)) == 3, 'Cards must be distinct.'
 
         x, y, w, h = self.buttons['attack'].values()
-        self.device.tap(x, y)
-        self.device.wait(INTERVAL_SHORT * 2)
+        gestures = device.Gestures().tap(x, y).wait(INTERVAL_SHORT * 2)
 
         
         for card in cards:
             if 1 <= card <= 5:
                 x, y, w, h = self.buttons['card'].values()
                 x += self.buttons['normal_card_distance'] * (card - 1)
-                self.device.tap_rand(x, y, w, h)
+                gestures.tap_rand(x, y, w, h)
             elif 6 <= card <= 8:
                 x, y, w, h = self.buttons['noble_card'].values()
                 x += self.buttons['noble_card_distance'] * (card - 6)
-                self.device.tap_rand(x, y, w, h)
+                gestures.tap_rand(x, y, w, h)
             else:
                 logger.warning('Card number must be in range [1, 8]')
-            self.device.wait(INTERVAL_SHORT)
+            gestures.wait(INTERVAL_SHORT)
+        self.device.perform(gestures)
         
         logger.info('wait...')
-        self.device.wait(INTERVAL_LONG)
+        self.__wait_animation('attack')
 
     def attack(self, cards: list, enemy: int=3 ):
         """
@@ -679,10 +827,11 @@ class BattleBot:
         """
         assert len(cards) == 3, 'Number of cards must be 3.'
         
-        self.__choose_enemy(enemy)
+        gestures = device.Gestures()
+        self.__choose_enemy(enemy, gestures)
 
         x, y, _, _ = self.buttons['attack'].values()
-        self.device.tap(x, y)
+        self.device.perform(gestures.tap(x, y))
         self.device.wait_until('battleBack')
 
         self.__unselected_NormalCards = {
@@ -699,7 +848,9 @@ class BattleBot:
                 9 : self.__attack_random,
             }
 
-        # pop each element from cards and tap it
+        # pop each element from cards and choose it on the same screen,
+        # then tap the three cards at once
+        gestures = device.Gestures()
         for userChoice in cards:
             # add user's preferred card to cards option
             if isinstance(userChoice, str) and userChoice not in cardsOption:
@@ -707,23 +858,24 @@ class BattleBot:
                 self.device.load_image(Path(userChoice +'.png'), userChoice)
             
             # execute the choice
-            cardsOption[userChoice](userChoice)
+            cardsOption[userChoice](userChoice, gestures)
             
             # interval between clicks 
-            self.device.wait_and_updateScreen(INTERVAL_SHORT /2)
+            gestures.wait(INTERVAL_TAP)
+        self.device.perform(gestures)
 
         # waiting for battle animation
         logger.info('wait...')
-        self.device.wait(INTERVAL_LONG)
+        self.__wait_animation('attack')
     
-    def __attack_hougu(self, userChoice: int):
+    def __attack_hougu(self, userChoice: int, gestures: device.Gestures):
 
         x, y, w, h = self.buttons['noble_card'].values()
         x += self.buttons['noble_card_distance'] * (userChoice - 6)
         logger.info('choose hougu[{}]'.format(userChoice -5))
-        self.device.tap_rand(x, y, w, h)
+        gestures.tap_rand(x, y, w, h)
 
-    def __attack_random(self, noUseParam = 0):
+    def __attack_random(self, noUseParam, gestures: device.Gestures):
         # choose the left most of unselected cards 
         for i in range(5):
             if self.__unselected_NormalCards[i] == True:
@@ -733,27 +885,36 @@ class BattleBot:
         x += self.buttons['normal_card_distance'] * (selected_card)
         
         logger.info('choose card[{}]'.format(selected_card +1))
-        self.device.tap_rand(x, y, w, h)
+        gestures.tap_rand(x, y, w, h)
         self.__unselected_NormalCards[selected_card] = False
         
-    def __attack_preferred(self, userChoice: str):
-        success, (x, y) = self.device.find_and_tap(userChoice, 0.85, withPosition= True)
+    def __attack_preferred(self, userChoice: str, gestures: device.Gestures):
+        if self.device.screen is None:
+            self.device.update_screen()
+        prob, (x, y) = self.device.match(userChoice)
 
         # if not found, do as 'random'
-        if not success:
+        if prob < 0.85:
             logger.info('NO preferredCard {} found, select at random'.format(userChoice))
-            self.__attack_random()
+            self.__attack_random(userChoice, gestures)
             return
         
         # if found, calculate the location of chosen card, pop it from unselected cards
-        logger.info('choose card {}'.format(userChoice))
+        left = x
         x -= 50
         location = -1   # location range [0,4]
         while x >0:
             location += 1
             x -= self.buttons['normal_card_distance']
-        else:
-            self.__unselected_NormalCards[location] = False
+        # the same card found again, as the screen is not updated between choices
+        if not self.__unselected_NormalCards.get(location, True):
+            logger.info('preferredCard {} already chosen, select at random'.format(userChoice))
+            self.__attack_random(userChoice, gestures)
+            return
+        logger.info('choose card {}'.format(userChoice))
+        self.__unselected_NormalCards[location] = False
+        w, h = self.device.get_image_size(userChoice)
+        gestures.tap_rand(left, y, w, h)
 
     def __check_xjbd_handlers(self) -> bool:
         try:
@@ -772,17 +933,69 @@ class BattleBot:
         logger.info('handlers filled')
         return True
     
-    def run(self, max_loops: int = 3):
+    def run(self, max_loops: int = 3, profile: Union[str, Path] = None) -> int:
         """
         Start the bot.
 
         :param max_loops: the max number of loops.
+        :param profile: a directory to profile the run into, one file of collapsed stacks per battle, \
+            see `profiler`. If not given, `$FGOBOT_PROFILE` if set, else no profiling.
+        :return: the number of battles played, or -1 if a battle was interrupted. \
+            The battles completed before the interruption are left in `count`.
         """
         self.__check_xjbd_handlers()
+        profile = profile or os.environ.get('FGOBOT_PROFILE')
+        if profile:
+            from .profiler import SamplingProfiler
+            # the phases are of this thread only
+            self.profiler = SamplingProfiler(self.spans, profile, thread=threading.get_ident()).start()
+        history = None
+        if self.keep_history:
+            try:
+                history = RunHistory()
+                history.start_run(*self.history_key)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning('Failed to open the run history: {}'.format(e))
+                history = None
+        status = 'failed'
+        try:
+            count = self.__run(max_loops, history)
+            status = 'interrupted' if count == -1 else 'ok'
+            return count
+        finally:
+            if history is not None:
+                history.end_run(status)
+                history.close()
+            if self.profiler is not None:
+                self.profiler.stop()
+                # the samples of an unfinished battle
+                self.profiler.dump('rest')
+                self.profiler = None
+
+    def __record_battle(self, number: int, start: float, started: float, rounds: int,
+                        history: Union[RunHistory, None], status: str):
+        """
+        Log the timing report of a battle, and record it in the history and the profile.
+
+        :param start: the `time.monotonic()` the battle started at.
+        :param started: the `time.time()` the battle started at.
+        :param status: 'ok', or 'interrupted' if the battle was left unfinished.
+        """
+        self.reports.append(self.spans.report())
+        logger.info('Timings of the {}-th battle in ms:\n{}'.format(number, spans.format_report(self.reports[-1])))
+        if history is not None:
+            history.add_battle(number, started, monotonic() - start, rounds, self.reports[-1], self.counters, status)
+        if self.profiler is not None:
+            self.profiler.dump('battle-{}'.format(number) if status == 'ok' else 'battle-{}-{}'.format(number, status))
+
+    def __run(self, max_loops: int, history: Union[RunHistory, None]) -> int:
         #count for the number of battles which were completed successfully
-        count = 0
+        count = self.count = 0
         for n_loop in range(max_loops):
-            
+            self.spans.reset()
+            self.counters.clear()
+            start, started = monotonic(), time()
+
             logger.info('Entering battle...')
             if not self.__enter_battle(count):
                 logger.info('Quiting...')
@@ -790,12 +1003,21 @@ class BattleBot:
 
             rounds = self.__play_battle()
             if rounds == -1:
-                logger.error('{}-th Battle interrupt. {} rounds played.'.format(count, rounds))
+                logger.error('{}-th Battle interrupt. {} rounds played.'.format(count + 1, self.rounds))
+                self.__record_battle(count + 1, start, started, self.rounds, history, 'interrupted')
                 return -1
             else:
-                count += 1
-                if not self.__end_battle(count, max_loops):
+                count = self.count = count + 1
+                ended = self.__end_battle(count, max_loops)
+                self.spans.since(SPAN_BATTLE, start)
+                self.__record_battle(count, start, started, rounds, history, 'ok')
+                if not ended:
                     break
                 logger.info('{}-th Battle complete. {} rounds played.'.format(count, rounds))
+                if self.timing:
+                    self.timing.save()
                 
+        if self.timing:
+            self.timing.save()
         logger.info('{} Battles played in total. Good bye!'.format(count))
+        return count
@@ -0,0 +1,221 @@
+"""
+Precompiled template bundle.
+
+Decoded templates and their matching pyramids are stored in a single binary
+file, which is memory-mapped at startup instead of decoding every png.
+Processes loading the same bundle share its pages through the page cache.
+
+Build the bundle of the default templates with `python -m fgobot.bundle`.
+A bundle is rebuilt automatically when the content of any source png changes.
+Bundles not loaded for `MAX_AGE` seconds are deleted when another one is built.
+"""
+import hashlib
+import json
+import logging
+import os
+import struct
+import tempfile
+import time
+from collections import namedtuple
+from pathlib import Path
+from typing import Dict, Union
+
+import cv2 as cv
+import numpy as np
+
+from . import matching
+
+MAGIC = b'FGOBUNDL'
+# bump when the layout or the derived forms change
+VERSION = 1
+ALIGN = 64
+# seconds after its last load before a bundle is deleted, see `prune`
+MAX_AGE = 30 * 24 * 3600
+
+# decoded templates by name, and their pyramids (level 0 first) by name
+Templates = namedtuple('Templates', ['images', 'pyramids'])
+
+logger = logging.getLogger('bundle')
+
+
+def cache_dir() -> Path:
+    """
+    Return the directory of template bundles, `$FGOBOT_CACHE` or `~/.cache/fgobot`.
+    """
+    return Path(os.environ.get('FGOBOT_CACHE', Path.home() / '.cache' / 'fgobot'))
+
+
+def bundle_path(paths: Dict[str, Path]) -> Path:
+    """
+    Return the bundle file for a set of templates. Each set of names and paths gets its own bundle.
+    """
+    key = '\n'.join('{}={}'.format(n, Path(p).absolute()) for n, p in sorted(paths.items()))
+    return cache_dir() / 'templates-{}.bundle'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+
+def digest(path: Path) -> str:
+    return hashlib.sha256(Path(path).read_bytes()).hexdigest()
+
+
+def decode(paths: Dict[str, Path]) -> Templates:
+    """
+    Decode templates and build their pyramids.
+
+    :param paths: png paths by template name.
+    """
+    images, pyramids = {}, {}
+    for name, p in paths.items():
+        img = cv.imread(str(p), cv.IMREAD_COLOR)
+        images[name] = img
+        pyramids[name] = matching.build_pyramid(img, matching.pyramid_levels(img))
+    return Templates(images, pyramids)
+
+
+def build(paths: Dict[str, Path], out: Path, templates: Templates = None):
+    """
+    Write templates, with their pyramids, to a bundle.
+
+    :param paths: png paths by template name.
+    :param out: the bundle file to write.
+    :param templates: the decoded templates. If not given, decode them from `paths`.
+    """
+    templates = templates or decode(paths)
+    entries, blobs, offset = [], [], 0
+    for name, pyramid in templates.pyramids.items():
+        for level, img in enumerate(pyramid):
+            img = np.ascontiguousarray(img)
+            entries.append({'name': name, 'level': level, 'offset': offset, 'shape': img.shape})
+            blobs.append(img)
+            offset += -(-img.nbytes // ALIGN) * ALIGN
+    header = json.dumps({
+        'version': VERSION,
+        'max_levels': matching.MAX_LEVELS,
+        'min_side': matching.MIN_TEMPLATE_SIDE,
+        'sources': {name: digest(p) for name, p in paths.items()},
+        'entries': entries,
+    }).encode('utf-8')
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+    out = Path(out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    # write to a temporary file first, so other processes never map a partial bundle
+    fd, tmp = tempfile.mkstemp(dir=out.parent, prefix=out.name, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for entry, img in zip(entries, blobs):
+            f.seek(start + entry['offset'])
+            f.write(img.tobytes())
+        f.truncate(start + offset)
+    os.chmod(tmp, 0o644)
+    os.replace(tmp, out)
+    logger.info('Template bundle built: {}'.format(out))
+
+
+def load(paths: Dict[str, Path], path: Path) -> Union[Templates, None]:
+    """
+    Memory-map a bundle.
+
+    :param paths: png paths by template name, which the bundle must have been built from.
+    :param path: the bundle file.
+    :return: the templates, or None if the bundle is missing or out of date.
+    """
+    # a truncated or foreign file may have any header, which is then out of date as well
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return None
+            size, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(size))
+        if header['version'] != VERSION or header['max_levels'] != matching.MAX_LEVELS \
+                or header['min_side'] != matching.MIN_TEMPLATE_SIDE \
+                or header['sources'].keys() != paths.keys():
+            return None
+        sources, entries = header['sources'], header['entries']
+    except (OSError, ValueError, struct.error, KeyError, TypeError, AttributeError):
+        return None
+    for name, p in paths.items():
+        try:
+            changed = sources[name] != digest(p)
+        except OSError:
+            return None
+        if changed:
+            logger.debug('Template {} changed.'.format(name))
+            return None
+
+    start = -(-(len(MAGIC) + 8 + size) // ALIGN) * ALIGN
+    images, pyramids = {}, {}
+    try:
+        data = np.memmap(path, np.uint8, mode='r')
+        for entry in entries:
+            shape = tuple(entry['shape'])
+            offset = start + entry['offset']
+            img = data[offset:offset + int(np.prod(shape))].reshape(shape)
+            pyramids.setdefault(entry['name'], []).append(img)
+    except (OSError, ValueError, KeyError, TypeError):
+        # the pixels are cut short
+        return None
+    for name, pyramid in pyramids.items():
+        images[name] = pyramid[0]
+    return Templates(images, pyramids)
+
+
+def prune(directory: Path = None, keep: Path = None, max_age: float = MAX_AGE):
+    """
+    Delete the bundles not loaded for `max_age` seconds, and temporary files left by interrupted builds.
+    Failures are ignored, e.g. of a bundle another process still maps on Windows.
+
+    :param directory: the directory of the bundles, `cache_dir()` if not given.
+    :param keep: a bundle never to delete.
+    :param max_age: seconds since the last load, the modification time of a bundle.
+    """
+    directory = Path(directory) if directory else cache_dir()
+    deadline = time.time() - max_age
+    for p in list(directory.glob('templates-*.bundle')) + list(directory.glob('templates-*.bundle*.tmp')):
+        if keep is not None and p == Path(keep):
+            continue
+        try:
+            if p.stat().st_mtime < deadline:
+                p.unlink()
+                logger.info('Stale template bundle deleted: {}'.format(p))
+        except OSError:
+            pass
+
+
+def load_or_build(paths: Dict[str, Path]) -> Templates:
+    """
+    Load the bundle of given templates, building it first if it is missing or out of date.
+    If the bundle cannot be written, the decoded templates are returned anyway.
+
+    :param paths: png paths by template name.
+    """
+    path = bundle_path(paths)
+    templates = load(paths, path)
+    if templates is not None:
+        logger.debug('Template bundle loaded: {}'.format(path))
+        # the modification time tells `prune` when the bundle was last used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return templates
+    templates = decode(paths)
+    try:
+        build(paths, path, templates)
+    except OSError as e:
+        logger.warning('Failed to write template bundle: {}'.format(e))
+        return templates
+    prune(path.parent, keep=path)
+    return load(paths, path) or templates
+
+
+def default_paths() -> Dict[str, Path]:
+    """
+    Return the default templates in `fgobot/images` by name.
+    """
+    im_dir = Path(__file__).absolute().parent / 'images'
+    return {im.name[:-4]: im for im in sorted(im_dir.glob('*.png'))}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    build(default_paths(), bundle_path(default_paths()))
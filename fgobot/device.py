@@ -4,18 +4,139 @@ Android device interaction.
 import subprocess
 import logging
 import re
+import json
+import threading
 import cv2 as cv
 import numpy as np
+from functools import partial
 from pathlib import Path
 from random import randint
-from typing import List, Tuple, Union
-from time import sleep
-from matplotlib import pyplot as plt
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Tuple, Union
+from time import monotonic, sleep
+from . import bundle, matching, spans
+from .adb import AdbClient, AdbError, ADB_HOST, ADB_PORT
+from .input import InputBackend, ShellInput
+from .stream import FramePipeline, FrameStream
+from .wait import ChangeDetector, Poller, SettleDetector, count_deadline
 
 # the template matching method
-TM_METHOD = cv.TM_CCOEFF_NORMED
+TM_METHOD = matching.TM_METHOD
+FULL_MATCH    = 0
+PYRAMID_MATCH = 1
+
 FROM_SHELL = 0
 SDCARD_PULL= 1    
+RAW_SHELL  = 2
+
+# adb commands transferring a screenshot, by capture method
+SCREENCAP_CMDS = {
+    FROM_SHELL: ['shell', 'screencap -p'],
+    RAW_SHELL: ['exec-out', 'screencap'],
+}
+
+# threads of `Device.match_many`. If None, chosen by the number of CPUs
+MATCH_WORKERS = None
+
+# timing spans, see `Device.spans`
+SPAN_ADB = {cmd: spans.register('adb.' + cmd) for cmd in ('shell', 'exec-out', 'pull', 'devices', 'connect')}
+SPAN_ADB_OTHER = spans.register('adb.other')
+SPAN_CAPTURE = spans.register('capture')
+SPAN_DECODE = spans.register('decode')
+SPAN_RESIZE = spans.register('resize')
+SPAN_MATCH = spans.register('match')
+SPAN_MATCH_MANY = spans.register('match_many')
+SPAN_INPUT = spans.register('input')
+SPAN_SLEEP = spans.register('wait.sleep')
+SPAN_WAIT_SETTLED = spans.register('wait.settled')
+SPAN_WAIT_MATCH = spans.register('wait.match')
+SPAN_WAIT_ANY = spans.register('wait.any')
+
+# pixel formats of the raw screencap output, and their bytes per pixel and conversion to BGR
+RAW_FORMATS = {
+    1: (4, cv.COLOR_RGBA2BGR),  # RGBA_8888
+    2: (4, cv.COLOR_RGBA2BGR),  # RGBX_8888
+    3: (3, cv.COLOR_RGB2BGR),   # RGB_888
+    5: (4, cv.COLOR_BGRA2BGR),  # BGRA_8888
+}
+
+
+def decode_raw(data: bytes) -> Union[np.ndarray, None]:
+    """
+    Decode the output of `screencap` without `-p`.
+
+    The pixels follow a header of width, height, pixel format
+    and, since Android 9, color space, each a little-endian uint32.
+
+    :param data: the raw screencap output
+    :return: a cv2 image as numpy ndarray, or None if the format is unsupported
+    """
+    w, h, fmt = np.frombuffer(data, '<u4', count=3)
+    if fmt not in RAW_FORMATS:
+        logging.getLogger('device').error('Unsupported raw pixel format {}'.format(fmt))
+        return None
+    bpp, code = RAW_FORMATS[fmt]
+    size = int(w) * int(h) * bpp
+    header = len(data) - size
+    if header not in (12, 16):
+        logging.getLogger('device').error('Unexpected raw screencap size {}'.format(len(data)))
+        return None
+    # a view on the received bytes, only the color conversion copies
+    pixels = np.frombuffer(data, np.uint8, count=size, offset=header).reshape(h, w, bpp)
+    return cv.cvtColor(pixels, code)
+
+
+# the result of matching an image: its name, match-value and match-location
+Match = namedtuple('Match', ['name', 'value', 'loc'])
+
+
+class Gestures:
+    """
+    A sequence of taps, swipes and waits, sent to the device as one shell command,
+    see `Device.perform`. The waits run on the device, so the steps keep their
+    spacing without a round-trip between them.
+
+    Methods return the sequence itself, so they can be chained::
+
+        device.perform(Gestures().tap(100, 200).wait(0.5).tap(300, 200))
+    """
+
+    def __init__(self):
+        # ('tap', (x, y)), ('swipe', ((x0, y0), (x1, y1), duration)) or ('wait', sec)
+        self.steps = []
+
+    def __len__(self) -> int:
+        return len(self.steps)
+
+    def tap(self, x: int, y: int) -> 'Gestures':
+        """
+        Add a tap at `pos:(x, y)`.
+        """
+        self.steps.append(('tap', (x, y)))
+        return self
+
+    def tap_rand(self, x: int, y: int, w: int, h: int) -> 'Gestures':
+        """
+        Add a tap at a random position in the rectangle `(x, y)` and `(x+w, y+h)`.
+        """
+        return self.tap(randint(x, x + w - 1), randint(y, y + h - 1))
+
+    def swipe(self, pos0: Tuple[int, int], pos1: Tuple[int, int], duration: int = 1000) -> 'Gestures':
+        """
+        Add a swipe from `pos0` to `pos1`, taking `duration` milliseconds.
+        """
+        self.steps.append(('swipe', (pos0, pos1, duration)))
+        return self
+
+    def wait(self, sec: float) -> 'Gestures':
+        """
+        Add a wait of `sec` seconds.
+        """
+        if sec > 0:
+            self.steps.append(('wait', sec))
+        return self
+
 
 class Device:
     """
@@ -34,6 +155,10 @@ class Device:
                  load_imgs: dict = dict(), 
                  capture_method: int = FROM_SHELL,
                  port: str = '127.0.0.1:16384',
+                 adb_server: Union[Tuple[str, int], None] = (ADB_HOST, ADB_PORT),
+                 match_engine: int = FULL_MATCH,
+                 serial: str = None,
+                 input_backend: InputBackend = None,
                  ):
         """
 
@@ -45,10 +170,24 @@ class Device:
 
         :param load_imgs: use's images need to be loaded, such as "quest" and "friend"
 
-        :param capture_method:  Options are `FROM_SHELL` or `SDCARD_PULL`, which \
-            decides the way to capture screen is `from adb shell` or `from sd-card`
+        :param capture_method:  Options are `FROM_SHELL`, `SDCARD_PULL` or `RAW_SHELL`, which \
+            decides the way to capture screen is `from adb shell`, `from sd-card` \
+            or `from adb shell without png encoding`
         
         :param port: the connect port of device
+
+        :param adb_server: `(host, port)` of the adb server. Shell commands are sent to it \
+            over a long-lived socket, falling back to the adb executable on failure. \
+            Set `None` to always use the adb executable.
+
+        :param match_engine: Options are `FULL_MATCH` or `PYRAMID_MATCH`, which decides \
+            to match templates at full resolution, or coarse-to-fine on image pyramids
+
+        :param serial: the serial of the device as listed by `adb devices`, such as \
+            `emulator-5554` or `127.0.0.1:16384`. Needed when more than one device is connected.
+
+        :param input_backend: how taps and swipes are injected, `input.ShellInput` (default) \
+            with the `input` command, or `input.SendeventInput` with raw touch events.
         """
 
         self.logger = logging.getLogger('device')
@@ -57,6 +196,18 @@ class Device:
 
         self.timeout = timeout
 
+        # the device commands are sent to, if more than one is connected
+        self.serial = serial
+
+        # socket transport to the adb server
+        self.adb = None
+        if adb_server is not None:
+            host, server_port = adb_server
+            self.adb = AdbClient(serial=serial, host=host, port=server_port, timeout=timeout)
+
+        # turns taps and swipes into shell commands, set up by `probe`
+        self.input = input_backend or ShellInput()
+
         # record user's screen size
         self.screen_size = (1280, 720)
 
@@ -64,25 +215,83 @@ class Device:
         self.zoom_switch = False
         self.zoom_factor = (1, 1)
 
-        if not self.connected():
-            # If no connection, try to connect through local port
-            self.connect(port)
-        
-        self.get_screen_size()
+        # connect and get screen size before the first command to device, see `probe`
+        self.port = port
+        self.probed = False
 
         self.threshold = threshold
 
-        # Load images in the path ' ./fgobot/images/ '
-        self.images = {}
+        # whether the current screen differs from the screen of the cached match results, and
+        # match results of the current screen, kept while it does not change
+        self.change_detector = ChangeDetector()
+        self.screen_changed = True
+        self.match_cache = {}
+
+        # Template matching engine, and the pyramids it uses
+        self.engine = match_engine
+        self.pyramids = {}
+        self.screen_pyramid = (None, None)
+        self.pyramid_lock = threading.Lock()
+
+        # Load images in the path ' ./fgobot/images/ ', decoded on first use of `images`
+        self.__images = {}
+        self.pending_images = []
         self.load_images()
 
+        # Search regions of templates, as name: (x, y, w, h) on the 1280x720 screen
+        self.rois = {}
+        self.load_rois()
+
         # Template matcher, set the method to capture screen
         self.method = capture_method
         self.screen = None
 
+        # id and capture time of the current screen
+        self.frame_id = 0
+        self.frame_time = 0.0
+
+        # background capturing, see `start_stream` and `start_pipeline`
+        self.stream = None
+        # id of the last frame taken from the stream, which counts its frames from 1
+        self.stream_frame_id = 0
+        self.pipeline = None
+
+        # thread pool of `match_many`, created on first use
+        self.executor = None
+
+        # the shortest seconds between two captures when waiting, see `wait_match`
+        self.poll_interval = 0.05
+
+        # the time of the last tap or swipe, to measure how long the screen takes to respond
+        self.last_action = monotonic()
+        # the capture time of the last screen that changed
+        self.last_change = self.last_action
+
+        # durations of commands, captures, matches and waits, see `spans.Spans`
+        self.spans = spans.Spans()
+
+        # recording and replaying of the session, see `trace.TraceRecorder` and `trace.TraceReplayer`
+        self.recorder = None
+        self.replay = None
+
         # Load images provided by user
-        for n, p in load_imgs.items():
-            self.load_image(name = n, im = p)
+        if load_imgs:
+            self.load_images(load_imgs)
+
+    def probe(self):
+        """
+        Connect to the device if not connected, and get its screen size.
+        Called once before the first command to the device, so creating a `Device` is fast.
+        """
+        if self.probed:
+            return
+        self.probed = True
+        if not self.connected():
+            # If no connection, try to connect through local port, or the address of a tcp/ip serial
+            self.connect(self.serial if self.serial and ':' in self.serial else self.port)
+
+        self.get_screen_size()
+        self.input.setup(lambda cmd: self.__run_cmd(['shell', cmd]), self.screen_size)
 
     def __run_cmd(self, cmd: List[str], raw: bool = False) -> Union[bytes, List[str]]:
         """
@@ -94,9 +303,36 @@ class Device:
         :param raw: whether to return the raw output
         :return: a list of the output, utf-8 decoded, separated by line, as a list.
         """
-        cmd = [self.adb_path] + cmd
-        self.logger.debug('Executing command: {}'.format(' '.join(cmd)))
-        output = subprocess.check_output(cmd, timeout=self.timeout)
+        if self.replay is not None:
+            output = self.replay.command(cmd)
+            return output if raw else output.decode('utf-8').splitlines()
+        if cmd[0] in ('shell', 'exec-out', 'pull'):
+            self.probe()
+        command, start = cmd, monotonic()
+        output = None
+        if self.adb is not None and cmd[0] in ('devices', 'connect'):
+            self.logger.debug('Querying adb server: {}'.format(' '.join(cmd)))
+            try:
+                output = self.adb.host(':'.join(['host'] + cmd)).encode('utf-8')
+            except (OSError, AdbError) as e:
+                self.logger.debug('adb server transport failed: {}'.format(e))
+        if self.adb is not None and cmd[0] in ('shell', 'exec-out'):
+            self.logger.debug('Executing command via adb server: {}'.format(' '.join(cmd)))
+            try:
+                output = self.adb.exec(' '.join(cmd[1:]))
+            except TimeoutError:
+                raise subprocess.TimeoutExpired(cmd, self.timeout)
+            except (OSError, AdbError) as e:
+                self.logger.debug('adb server transport failed: {}'.format(e))
+        if output is None:
+            if self.serial and cmd[0] in ('shell', 'exec-out', 'pull'):
+                cmd = ['-s', self.serial] + cmd
+            cmd = [self.adb_path] + cmd
+            self.logger.debug('Executing command: {}'.format(' '.join(cmd)))
+            output = subprocess.check_output(cmd, timeout=self.timeout)
+        self.spans.since(SPAN_ADB.get(command[0], SPAN_ADB_OTHER), start)
+        if self.recorder is not None:
+            self.recorder.command(command, start, monotonic() - start, None if raw else output)
         if raw:
             return output
         else:
@@ -114,6 +350,8 @@ class Device:
         :return: whether connection is successful.
         """
         if restart:
+            if self.adb is not None:
+                self.adb.close()
             self.__run_cmd(['kill-server'])
         output = self.__run_cmd(['connect', addr])
         for line in output:
@@ -124,20 +362,29 @@ class Device:
         self.logger.error('Error message: {}'.format('\n'.join(output)))
         return False
 
-    def connected(self) -> bool:
+    def devices(self) -> List[str]:
         """
-        Check if a device is connected.
+        Return the serials of the connected devices.
         """
         output = self.__run_cmd(['devices'])
-        devices = 0
-        for line in output:
-            if line.endswith('device'):
-                devices += 1
-        if devices == 0:
+        return [line.split()[0] for line in output if line.endswith('device')]
+
+    def connected(self) -> bool:
+        """
+        Check if the device is connected. Without a serial, it must be the only one connected.
+        """
+        serials = self.devices()
+        if self.serial:
+            if self.serial in serials:
+                self.logger.info('OK device {} connected.'.format(self.serial))
+                return True
+            self.logger.error('Device {} not connected.'.format(self.serial))
+            return False
+        if len(serials) == 0:
             self.logger.error('No device connected.')
             return False
-        elif devices > 1:
-            self.logger.error('More than one device connected.')
+        elif len(serials) > 1:
+            self.logger.error('More than one device connected, set the serial of the device to use.')
             return False
         else:
             self.logger.info('OK device connected.')
@@ -148,14 +395,17 @@ class Device:
         resize screen.
         """
         if self.zoom_switch:
-            self.logger.debug('Screen resized')
+            start = monotonic()
             src = cv.resize(src, (1280, 720))
+            self.spans.since(SPAN_RESIZE, start)
+            self.logger.debug('Screen resized')
         return src
     
     def tap_adapter(self, pos: tuple[int, int]) -> tuple[int, int]:
         """
         zoom the position of tap or swipe, return new position
         """
+        self.probe()
         if self.zoom_switch:
             x_float = pos[0]*self.zoom_factor[0]
             y_float = pos[1]*self.zoom_factor[1]
@@ -176,21 +426,96 @@ class Device:
         assert im.name.endswith('.png'),"quest is not a png"
         name = name or im.name[:-4]
         self.images[name] = cv.imread(str(im), cv.IMREAD_COLOR)
-        # self.images[name] = cv.cvtColor(self.images[name], cv.COLOR_BGR2RGB)
-        # plt.figure(name)
-        # plt.imshow(self.images[name])
-        # plt.show()
+        self.pyramids.pop(name, None)
+        self.match_cache.pop(name, None)
         self.logger.debug('Loaded image {}'.format(name))
 
-    def load_images(self):
+    def load_images(self, paths: Dict[str, Path] = None):
+        """
+        Load template images through a precompiled template bundle, see `bundle`.
+        May override loaded images.
+
+        The images are only checked here, and loaded on first use of `images`.
+
+        :param paths: paths to the images by name. If not given, load images from directory.
+        """
+        if paths is None:
+            paths = bundle.default_paths()
+        for name, im in paths.items():
+            assert im.is_file(), "cannot find your .png file"
+            assert im.name.endswith('.png'),"quest is not a png"
+        self.pending_images.append(paths)
+
+    @property
+    def images(self) -> Dict[str, np.ndarray]:
+        """
+        The template images by name.
+        """
+        while self.pending_images:
+            paths = self.pending_images.pop(0)
+            templates = bundle.load_or_build(paths)
+            self.__images.update(templates.images)
+            for name in paths:
+                self.pyramids.pop(name, None)
+                self.match_cache.pop(name, None)
+            self.pyramids.update(templates.pyramids)
+            self.logger.info('Images loaded successfully.')
+        return self.__images
+
+    @property
+    def engine(self) -> int:
+        """
+        The template matching engine, `FULL_MATCH` or `PYRAMID_MATCH`.
+        Setting it drops the match results of the current screen, found by the previous engine.
+        """
+        return self.__engine
+
+    @engine.setter
+    def engine(self, engine: int):
+        self.__engine = engine
+        self.match_cache = {}
+
+    def load_rois(self):
         """
-        Load template images from directory.
+        Load the search regions of templates from `config/rois.json`.
         """
-        im_dir = Path(__file__).absolute().parent / 'images'
-        for im in im_dir.glob('*.png'):
-            self.load_image(im)
+        roi_path = Path(__file__).absolute().parent / 'config' / 'rois.json'
+        with open(roi_path) as f:
+            rois = json.load(f)
+        margin = rois.pop('margin', 0)
+        for name, roi in rois.items():
+            self.set_roi(name, roi['x'], roi['y'], roi['w'], roi['h'], roi.get('margin', margin))
 
-        self.logger.info('Images loaded successfully.')
+        self.logger.debug('Search regions loaded.')
+
+    def set_roi(self, name: str, x: int, y: int, w: int, h: int, margin: int = 0):
+        """
+        Restrict the matching of an image to a region of the screen. May override default regions.
+
+        :param name: the name of the image.
+        :param x: the left x coord of the region in pixels.
+        :param y: the top y coord of the region in pixels.
+        :param w: the width in pixels.
+        :param h: the height in pixels.
+        :param margin: pixels added to each side of the region.
+        """
+        x0, y0 = max(x - margin, 0), max(y - margin, 0)
+        x1, y1 = min(x + w + margin, 1280), min(y + h + margin, 720)
+        self.rois[name] = (x0, y0, x1 - x0, y1 - y0)
+        self.match_cache.pop(name, None)
+
+    def __search_area(self, img: str) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """
+        Return the part of screen to search `img` in, and its offset on the screen.
+        """
+        roi = self.rois.get(img)
+        if roi is None:
+            return self.screen, (0, 0)
+        x, y, w, h = roi
+        th, tw = self.images[img].shape[:2]
+        if w < tw or h < th:
+            return self.screen, (0, 0)
+        return self.screen[y:y + h, x:x + w], (x, y)
 
     def get_image_size(self, im: str) -> Tuple[int, int]:
         """
@@ -235,7 +560,10 @@ class Device:
         """
         (x, y) = self.tap_adapter(pos=(x, y))
         coords = '{:d} {:d}'.format(x, y)
-        output = self.__run_cmd(['shell', 'input tap {}'.format(coords)])
+        start = monotonic()
+        output = self.__run_cmd(['shell', self.input.tap(x, y)])
+        self.last_action = monotonic()
+        self.spans.add(SPAN_INPUT, self.last_action - start)
         for line in output:
             if line.startswith('error'):
                 self.logger.error('Failed to tap at {}'.format(coords))
@@ -272,7 +600,10 @@ class Device:
         npos0, npos1 = list(newpos)
         coords0 = '{:d} {:d}'.format(npos0[0], npos0[1])
         coords1 = '{:d} {:d}'.format(npos1[0], npos1[1])
-        output = self.__run_cmd(['shell', 'input swipe {} {} {:d}'.format(coords0, coords1, duration)])
+        start = monotonic()
+        output = self.__run_cmd(['shell', self.input.swipe(*npos0, *npos1, duration)])
+        self.last_action = monotonic()
+        self.spans.add(SPAN_INPUT, self.last_action - start)
         for line in output:
             if line.startswith('error'):
                 self.logger.error('Failed to swipe from {} to {} taking {:d}ms'.format(coords0, coords1, duration))
@@ -281,6 +612,36 @@ class Device:
         self.logger.debug('Swiped from {} to {} taking {:d}ms'.format(coords0, coords1, duration))
         return True
     
+    def perform(self, gestures: Gestures) -> bool:
+        """
+        Input a sequence of taps and swipes in one shell command, see `Gestures`.
+
+        :param gestures: the sequence.
+        :return: whether all events are successful.
+        """
+        cmds = []
+        for kind, args in gestures.steps:
+            if kind == 'tap':
+                cmds.append(self.input.tap(*self.tap_adapter(args)))
+            elif kind == 'swipe':
+                pos0, pos1, duration = args
+                cmds.append(self.input.swipe(*self.tap_adapter(pos0), *self.tap_adapter(pos1), duration))
+            else:
+                cmds.append('sleep {:.3f}'.format(args))
+        if not cmds:
+            return True
+        start = monotonic()
+        output = self.__run_cmd(['shell', '; '.join(cmds)])
+        self.last_action = monotonic()
+        self.spans.add(SPAN_INPUT, self.last_action - start)
+        for line in output:
+            if line.startswith('error'):
+                self.logger.error('Failed to perform {} gestures'.format(len(gestures)))
+                self.logger.error('Error message: {}'.format('\n'.join(output)))
+                return False
+        self.logger.debug('Performed {} gestures'.format(len(gestures)))
+        return True
+
     @staticmethod
     def __png_sanitize(s: bytes) -> bytes:
         """
@@ -300,38 +661,191 @@ class Device:
         """
         Capture the screen.
 
-        :param method: 'FROM_SHELL' or 'SDCARD_PULL'
+        :param method: 'FROM_SHELL', 'SDCARD_PULL' or 'RAW_SHELL'
 
         :return: a cv2 image as numpy ndarray
         """
+        return self.__decode(method, self.__fetch(method))
+
+    def __fetch(self, method: int) -> Union[bytes, None]:
+        """
+        Transfer a screenshot from the device, without decoding it.
+
+        :param method: 'FROM_SHELL', 'SDCARD_PULL' or 'RAW_SHELL'
+
+        :return: the encoded screenshot
+        """
         if method == FROM_SHELL:
             self.logger.debug('Capturing screen from shell...')
-            img = self.__run_cmd(['shell', 'screencap -p'], raw=True)
-            img = self.__png_sanitize(img)
-            img = np.frombuffer(img, np.uint8)
-            img = cv.imdecode(img, cv.IMREAD_COLOR)
-            return img
+            return self.__run_cmd(SCREENCAP_CMDS[FROM_SHELL], raw=True)
+        elif method == RAW_SHELL:
+            self.logger.debug('Capturing raw screen from shell...')
+            return self.__run_cmd(SCREENCAP_CMDS[RAW_SHELL], raw=True)
         elif method == SDCARD_PULL:
             self.logger.debug('Capturing screen from sdcard pull...')
             self.__run_cmd(['shell', 'screen -p /sdcard/sc.png'])
             self.__run_cmd(['pull', '/sdcard/sc.png', './sc.png'])
-            img = cv.imread('./sc.png', cv.IMREAD_COLOR)
-            return img
+            with open('./sc.png', 'rb') as f:
+                return f.read()
         else:
             self.logger.error('Unsupported screen capturing method.')
             return None
 
+    def __decode(self, method: int, data: Union[bytes, None]) -> Union[np.ndarray, None]:
+        """
+        Decode a screenshot transferred by `__fetch`.
+
+        :param method: 'FROM_SHELL', 'SDCARD_PULL' or 'RAW_SHELL'
+        :param data: the encoded screenshot
+
+        :return: a cv2 image as numpy ndarray
+        """
+        if data is None:
+            return None
+        start = monotonic()
+        if method == RAW_SHELL:
+            img = decode_raw(data)
+        else:
+            if method == FROM_SHELL:
+                data = self.__png_sanitize(data)
+            img = cv.imdecode(np.frombuffer(data, np.uint8), cv.IMREAD_COLOR)
+        self.spans.since(SPAN_DECODE, start)
+        return img
+
     def update_screen(self):
         """
         Update the screencap image and resize screencap to 1280x720. 
+
+        If streaming, take the latest frame newer than the current screen and captured after
+        the last tap or swipe, instead of capturing.
+        If pipelining, take the next frame captured after the last tap or swipe.
+        If replaying, take the next frame of the trace.
+        """
+        if self.replay is not None:
+            frame = self.replay.next_frame()
+            self.set_screen(frame.image, frame.timestamp)
+            self.logger.debug('Screen replayed, frame {}.'.format(self.frame_id))
+        elif self.pipeline is not None:
+            while True:
+                frame = self.next_frame().result(timeout= self.timeout)
+                if frame.timestamp >= self.last_action:
+                    break
+                self.logger.debug('Frame {} captured before last action, dropped.'.format(frame.id))
+            self.set_screen(frame.image, frame.timestamp)
+            self.logger.debug('Screen updated from pipeline, frame {}.'.format(frame.id))
+        elif self.stream is not None:
+            deadline = monotonic() + self.timeout
+            while True:
+                frame = self.stream.latest(newer_than= self.stream_frame_id, timeout= max(deadline - monotonic(), 0))
+                if frame is None:
+                    self.logger.error('No new frame from stream in {} seconds.'.format(self.timeout))
+                    return
+                self.stream_frame_id = frame.id
+                if frame.timestamp >= self.last_action:
+                    break
+                self.logger.debug('Frame {} captured before last action, dropped.'.format(frame.id))
+            self.set_screen(frame.image, frame.timestamp)
+            self.logger.debug('Screen updated from stream, frame {}.'.format(frame.id))
+        else:
+            frame_time = monotonic()
+            screen = self.__adapt_frame(self.__capture(method= self.method))
+            self.spans.since(SPAN_CAPTURE, frame_time)
+            self.set_screen(screen, frame_time)
+            self.logger.debug('Screen captured.')
+
+    def set_screen(self, screen: Union[np.ndarray, None], frame_time: float, frame_id: int = None):
         """
-        self.screen = self.__capture(method= self.method)
-        self.screen = self.screen_adapter(self.screen)
-        self.logger.debug('Screen captured.')
+        Replace the current screen, e.g. with a screenshot captured elsewhere.
+
+        Compare the new screen with the previous one. If it did not change,
+        keep the match results of the previous screen for reuse.
+
+        :param screen: the 1280x720 screen, see `decode_screen`.
+        :param frame_time: the `time.monotonic()` the screen was captured at.
+        :param frame_id: the id of the frame. If not given, the next id.
+        """
+        if self.recorder is not None:
+            self.recorder.frame(screen, frame_time)
+        self.screen = screen
+        self.frame_time = frame_time
+        self.frame_id = self.frame_id + 1 if frame_id is None else frame_id
+        self.screen_changed = self.change_detector.update(self.screen)
+        if self.screen_changed:
+            self.last_change = frame_time
+            self.match_cache = {}
+        else:
+            self.logger.debug('Screen unchanged.')
+
+    def start_stream(self, source: Callable[[], np.ndarray] = None, interval: float = 0):
+        """
+        Capture screen continuously on a background thread.
+        `update_screen` then returns at once with the latest frame.
+
+        :param source: a callable returning the next screen image, such as `stream.MinicapSource`. \
+            If not given, capture repeatedly with the capture method of this device.
+        :param interval: the minimum seconds between two captures.
+        """
+        self.stop_stream()
+        self.stop_pipeline()
+        if source is None:
+            source = partial(self.__capture, self.method)
+        self.stream = FrameStream(lambda: self.__adapt_frame(source()), interval)
+        self.stream_frame_id = 0
+        self.stream.start()
+
+    def start_pipeline(self, depth: int = 1):
+        """
+        Pipeline capturing: transfer and decode screenshots on background threads, so the next
+        screenshot is transferred while the current one is decoded and matched.
+        `update_screen` then takes frames from the pipeline, see `next_frame`.
+
+        :param depth: the number of screenshots in flight besides the one being returned.
+        """
+        self.stop_pipeline()
+        self.stop_stream()
+        self.pipeline = FramePipeline(partial(self.__fetch, self.method), self.decode_screen, depth)
+
+    def stop_pipeline(self):
+        """
+        Stop pipelined capturing.
+        """
+        if self.pipeline is not None:
+            self.pipeline.stop()
+            self.pipeline = None
+
+    def next_frame(self) -> Future:
+        """
+        Return the next frame without waiting for it, and start capturing another one.
+        Only available after `start_pipeline`.
+
+        :return: a future of `stream.Frame`.
+        """
+        return self.pipeline.next_frame()
+
+    def stop_stream(self):
+        """
+        Stop capturing on the background thread.
+        """
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream = None
+
+    def __adapt_frame(self, img: Union[np.ndarray, None]) -> Union[np.ndarray, None]:
+        return None if img is None else self.screen_adapter(img)
+
+    def decode_screen(self, data: bytes) -> Union[np.ndarray, None]:
+        """
+        Decode a screenshot transferred with the capture method of this device,
+        such as the output of `SCREENCAP_CMDS[method]`, and resize it to 1280x720.
+
+        :param data: the encoded screenshot
+        :return: a cv2 image as numpy ndarray
+        """
+        return self.__adapt_frame(self.__decode(self.method, data))
     
     def match(self, img:str):
         """
-        Match `img` with screen.
+        Match `img` with screen, only inside its search region if it has one.
         
         :param img: the name of img
         :param threshold: the threshold of matching. If not given, will be set to the default threshold
@@ -340,17 +854,91 @@ class Device:
         
                 match-location is a tuple(int, int)
         """
-        try:
-            template = self.images[img]
-        except KeyError:
+        if img not in self.images:
             self.logger.error('Unexpected image name {}'.format(img))
             return 0, (-1, -1)
         
-        res = cv.matchTemplate(self.screen, template, TM_METHOD)
-        _, max_val, _, max_loc = cv.minMaxLoc(res)
+        max_val, max_loc = self.__match_template(img)
         self.logger.debug(f'image:{img}, max_val = {max_val}, max_loc = {max_loc}')
         
         return max_val, max_loc
+
+    def __match_template(self, img: str) -> Tuple[float, Tuple[int, int]]:
+        """
+        Match a loaded template with the current screen.
+        """
+        cached = self.match_cache.get(img)
+        if cached is not None:
+            return cached
+        start = monotonic()
+        area, (dx, dy) = self.__search_area(img)
+        if self.engine == PYRAMID_MATCH:
+            templates = self.pyramids.get(img)
+            if templates is None:
+                template = self.images[img]
+                templates = matching.build_pyramid(template, matching.pyramid_levels(template))
+                self.pyramids[img] = templates
+            max_val, (x, y) = matching.pyramid_match(self.__area_pyramid(area), templates)
+        else:
+            max_val, (x, y) = matching.full_match(area, self.images[img])
+        self.match_cache[img] = max_val, (x + dx, y + dy)
+        self.spans.since(SPAN_MATCH, start)
+        return self.match_cache[img]
+
+    def __area_pyramid(self, area: np.ndarray) -> List[np.ndarray]:
+        """
+        Return the image pyramid of a search area. The pyramid of the full screen is
+        built once per screen and shared by all templates.
+        """
+        if area is not self.screen:
+            return matching.build_pyramid(area, matching.MAX_LEVELS)
+        with self.pyramid_lock:
+            screen, pyramid = self.screen_pyramid
+            if screen is not self.screen:
+                pyramid = matching.build_pyramid(self.screen, matching.MAX_LEVELS)
+                self.screen_pyramid = (self.screen, pyramid)
+            return pyramid
+
+    def match_many(self, imgs: Iterable[str]) -> Dict[str, Match]:
+        """
+        Match several images with the same screen at once.
+        The images are matched in parallel, as OpenCV releases the GIL while matching.
+
+        :param imgs: the names of images
+        :return: a dict of `Match` by image name, in the order of `imgs`. \
+            An unknown image gets match-value 0 and match-location (-1, -1).
+        """
+        names = list(imgs)
+        known = [n for n in names if n in self.images]
+        for n in names:
+            if n not in self.images:
+                self.logger.error('Unexpected image name {}'.format(n))
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(MATCH_WORKERS, thread_name_prefix='match')
+        start = monotonic()
+        found = dict(zip(known, self.executor.map(self.__match_template, known)))
+        self.spans.since(SPAN_MATCH_MANY, start)
+
+        results = {}
+        for n in names:
+            max_val, max_loc = found.get(n, (0, (-1, -1)))
+            results[n] = Match(n, max_val, max_loc)
+        # only format the values when they are logged, this runs several times per second
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('matched {}'.format(', '.join('{}={:.3f}'.format(n, r.value) for n, r in results.items())))
+        return results
+
+    def tap_match(self, match: Match) -> bool:
+        """
+        Tap at a random position inside a matched image.
+
+        :param match: the result of `match_many`
+        :return: whether the event is successful.
+        """
+        w, h = self.get_image_size(match.name)
+        x, y = match.loc
+        return self.tap_rand(x, y, w, h)
     
     def updateScreen_and_exists(self, im: str, threshold: float = None) -> bool:
         """
@@ -377,6 +965,22 @@ class Device:
         else:
             return False
     
+    def clock(self) -> float:
+        """
+        The current time: `time.monotonic()`, or the time of the session if replaying.
+        Deadlines of the waits are on this clock.
+        """
+        return monotonic() if self.replay is None else self.replay.clock()
+
+    def __sleep(self, sec: float):
+        """
+        Sleep, unless replaying: a replay runs as fast as the screens can be matched.
+        """
+        if self.replay is None:
+            start = monotonic()
+            sleep(sec)
+            self.spans.since(SPAN_SLEEP, start)
+
     def wait(self, sec: int = 1):
         """
         Wait some seconds 
@@ -384,7 +988,7 @@ class Device:
         :param sec: the seconds to wait
         """
         self.logger.debug('Sleep {} seconds.'.format(sec))
-        sleep(sec)
+        self.__sleep(sec)
 
     def wait_and_updateScreen(self, sec:int = 1):
         """
@@ -393,58 +997,132 @@ class Device:
         :param sec: the seconds to wait
         """
         self.logger.debug('Sleep {} seconds.'.format(sec))
-        sleep(sec)
+        self.__sleep(sec)
         self.update_screen()
     
-    def wait_until(self, im: str, sec: int=1, threshold: float = None, countLimit: int = None) -> bool:
+    @spans.timed(SPAN_WAIT_SETTLED)
+    def wait_settled(self, quiet: float = 2, threshold: float = 1, timeout: float = 20) -> bool:
+        """
+        Update screen until it has settled, i.e. nothing moved on it for `quiet` seconds.
+        Useful to wait for animations and loadings to finish, see `wait.SettleDetector`.
+
+        :param quiet: the seconds without motion for the screen to count as settled.
+        :param threshold: the motion energy, in gray levels, below which a frame counts as still.
+        :param timeout: the longest seconds to wait.
+
+        :return: True once the screen has settled, False if it was still moving after `timeout` seconds.
+        """
+        self.logger.debug('Wait until screen settles.')
+        start = self.clock()
+        detector = SettleDetector(quiet, threshold)
+        while True:
+            self.update_screen()
+            if detector.update(self.screen, self.frame_time):
+                self.logger.debug('Screen settled after {:.1f} seconds.'.format(self.clock() - start))
+                return True
+            if self.clock() - start >= timeout:
+                self.logger.debug('Screen still moving after {} seconds.'.format(timeout))
+                return False
+            self.__sleep(self.poll_interval)
+
+    @spans.timed(SPAN_WAIT_MATCH)
+    def wait_match(self, im: str, sec: float = 1, threshold: float = None,
+                   countLimit: int = None, deadline: float = None) -> Union[Match, None]:
+        """
+        Update screen until the given image appears, and return the match as soon as it does.
+
+        Polls tightly at first and backs off up to `sec` seconds between captures
+        while the screen does not change, see `wait.Poller`.
+
+        :param im: the name of image
+        :param sec: the longest seconds to wait between captures
+        :param threshold: threshold of matching, If not given, will be set to the default threshold
+        :param countLimit: give up after about `countLimit * sec` seconds, the time that many captures \
+            took at one per `sec` seconds. If not given, no limit. Prefer `deadline`.
+        :param deadline: the `clock()` to give up at. If not given, no limit.
+
+        :return: the match, or None if the image did not appear within the limits.
+        """
+        self.logger.debug("Wait until image '{}' appears.".format(im))
+        threshold = threshold or self.threshold
+        deadline = count_deadline(countLimit, sec, self.clock(), deadline)
+        poller = Poller(self.poll_interval, sec, deadline= deadline, clock= self.clock)
+        while True:
+            self.update_screen()
+            max_val, max_loc = self.match(img= im)
+            if max_val >= threshold:
+                return Match(im, max_val, max_loc)
+            interval = poller.next_interval(self.screen_changed)
+            if interval is None:
+                self.logger.debug("Image '{}' did not appear before deadline.".format(im))
+                return None
+            self.__sleep(interval)
+
+    @spans.timed(SPAN_WAIT_ANY)
+    def wait_any(self, imgs: Dict[str, float], sec: float = 1,
+                 countLimit: int = None, deadline: float = None) -> Union[Match, None]:
+        """
+        Update screen until any of the given images appears. All images are matched
+        on each captured screen, see `match_many`.
+
+        :param imgs: thresholds of matching by image name, in order of priority. \
+            A threshold of None will be set to the default threshold.
+        :param sec: the longest seconds to wait between captures
+        :param countLimit: give up after about `countLimit * sec` seconds, the time that many captures \
+            took at one per `sec` seconds. If not given, no limit. Prefer `deadline`.
+        :param deadline: the `clock()` to give up at. If not given, no limit.
+
+        :return: the match of the first image in `imgs` that appears, \
+            or None if none appeared within the limits.
+        """
+        self.logger.debug("Wait until any of '{}' appears.".format("', '".join(imgs)))
+        deadline = count_deadline(countLimit, sec, self.clock(), deadline)
+        poller = Poller(self.poll_interval, sec, deadline= deadline, clock= self.clock)
+        while True:
+            self.update_screen()
+            for im, result in self.match_many(imgs).items():
+                if result.value >= (imgs[im] or self.threshold):
+                    self.logger.debug("Image '{}' appears.".format(im))
+                    return result
+            interval = poller.next_interval(self.screen_changed)
+            if interval is None:
+                self.logger.debug('None of the images appeared before deadline.')
+                return None
+            self.__sleep(interval)
+
+    def wait_until(self, im: str, sec: float = 1, threshold: float = None,
+                   countLimit: int = None, deadline: float = None) -> bool:
         """
         Wait and Update screen until the given image appears. 
         
         Useful when try to use skills, etc.
         
         :param im: the name of image
-        :param sec: the seconds to wait
+        :param sec: the longest seconds to wait between captures
         :param threshold: threshold of matching, If not given, will be set to the default threshold
+        :param countLimit: give up after about `countLimit * sec` seconds, the time that many captures \
+            took at one per `sec` seconds. If not given, no limit. Prefer `deadline`.
+        :param deadline: the `clock()` to give up at. If not given, no limit.
 
-        :return: True after the im appears.
+        :return: True after the im appears, False if it did not appear within the limits.
         """
-        self.logger.debug("Wait until image '{}' appears.".format(im))
-        threshold = self.threshold or threshold
-        if countLimit is None:
-            while not self.updateScreen_and_exists(im, threshold):
-                self.wait(sec)
-            else:
-                return True
-        else:
-            while countLimit:
-                if self.updateScreen_and_exists(im, threshold):
-                    return True
-                self.wait(sec)
-                countLimit = countLimit - 1
-            else:
-                return False
-    def wait_until_tap(self, im: str, sec: int=1, threshold: float = None) -> bool:
+        return self.wait_match(im, sec, threshold, countLimit, deadline) is not None
+
+    def wait_until_tap(self, im: str, sec: float = 1, threshold: float = None, deadline: float = None) -> bool:
         """
-        Wait, Update screen until the given image appears and Tap.
+        Wait, Update screen until the given image appears and Tap it at once.
 
         :param im: the name of image
-        :param sec: the seconds to wait
+        :param sec: the longest seconds to wait between captures
         :param threshold: threshold of matching, If not given, will be set to the default threshold
+        :param deadline: the `clock()` to give up at. If not given, no limit.
 
         :return: True after the click event is successful.
         """
-        self.logger.debug("Wait until image '{}' appears.".format(im))
-        prob = 0
-        x, y = 0, 0
-        threshold = threshold or self.threshold
-        while prob < threshold :
-            self.update_screen()
-            prob, pos = self.match(img= im)
-            self.wait(sec)
-        else:
-            x = pos[0]
-            y = pos[1]
-            return self.tap(x, y)
+        match = self.wait_match(im, sec, threshold, deadline= deadline)
+        if match is None:
+            return False
+        return self.tap_match(match)
 
     def probability(self, im:str) -> float:
         """
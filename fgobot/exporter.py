@@ -0,0 +1,163 @@
+"""
+Prometheus-style metrics of running bots, served over HTTP in the text exposition format.
+
+The metrics are read from the `spans.Spans` of each bot when scraped, so an exporter
+nobody scrapes costs nothing. Start one per process and add the bots to it::
+
+    bot = BattleBot(...)
+    exporter.serve(9464).add(bot.spans, {'device': '127.0.0.1:16384'}, bot.device)
+    bot.run(10)
+
+or pass `metrics_port` to `BattleBot`, or to `farm.run_farm` to export each device
+on its own port. Then scrape `http://127.0.0.1:9464/metrics`.
+"""
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic
+from typing import Dict, List, Tuple
+
+from . import spans
+
+# the counters derived from the count of a span
+COUNTERS = {
+    'captures': ('decode', 'Screenshots captured and decoded.'),
+    'inputs': ('input', 'Input commands sent, taps, swipes or batches of them.'),
+    'matches': ('match', 'Templates matched.'),
+    'battles': ('bot.battle', 'Battles completed.'),
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+logger = logging.getLogger('exporter')
+
+# the exporter of this process by port, see `serve`
+_exporters = {}  # type: Dict[int, MetricsExporter]
+_lock = threading.Lock()
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(values: Dict[str, str]) -> str:
+    return ','.join('{}="{}"'.format(k, escape(v)) for k, v in values.items())
+
+
+class MetricsExporter:
+    """
+    Serve the metrics of the added bots at `/metrics`.
+    """
+
+    def __init__(self, port: int = 9464, host: str = '127.0.0.1'):
+        """
+
+        :param port: the port to listen on, 0 for any free port.
+        :param host: the address to listen on.
+        """
+        self.sources = []  # type: List[Tuple[Dict[str, str], spans.Spans, object]]
+        self.lock = threading.Lock()
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = exporter.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format % args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='exporter', daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server.server_address[1]
+
+    def start(self) -> 'MetricsExporter':
+        self.thread.start()
+        logger.info('Serving metrics at http://{}:{}/metrics'.format(*self.server.server_address[:2]))
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add(self, source: spans.Spans, labels: Dict[str, str], device=None) -> 'MetricsExporter':
+        """
+        Export the spans of a bot.
+
+        :param source: the spans, such as `BattleBot.spans`.
+        :param labels: the labels of its metrics, such as `{'device': 'emulator-5554'}`.
+        :param device: its `Device`, to export how long its screen has not changed.
+        """
+        with self.lock:
+            self.sources.append((labels, source, device))
+        return self
+
+    def remove(self, source: spans.Spans):
+        with self.lock:
+            self.sources = [s for s in self.sources if s[1] is not source]
+
+    def render(self) -> str:
+        """
+        Return the metrics in the text exposition format.
+        """
+        with self.lock:
+            sources = list(self.sources)
+        now = monotonic()
+        histograms = [(values, source.histograms()) for values, source, _ in sources]
+        lines = []
+
+        for name, (span, help_) in COUNTERS.items():
+            lines += ['# HELP fgobot_{}_total {}'.format(name, help_), '# TYPE fgobot_{}_total counter'.format(name)]
+            for values, stats in histograms:
+                count = stats[span][0] if span in stats else 0
+                lines.append('fgobot_{}_total{{{}}} {}'.format(name, format_labels(values), count))
+
+        lines += ['# HELP fgobot_phase The current phase of the bot.', '# TYPE fgobot_phase gauge']
+        for values, source, _ in sources:
+            if source.phase is not None:
+                lines.append('fgobot_phase{{{}}} 1'.format(format_labels(dict(values, phase=spans.NAMES[source.phase]))))
+        lines += ['# HELP fgobot_phase_seconds Seconds since the bot entered its current phase.',
+                  '# TYPE fgobot_phase_seconds gauge']
+        for values, source, _ in sources:
+            lines.append('fgobot_phase_seconds{{{}}} {:.3f}'.format(format_labels(values), now - source.phase_since))
+        lines += ['# HELP fgobot_screen_unchanged_seconds Seconds since the screen last changed.',
+                  '# TYPE fgobot_screen_unchanged_seconds gauge']
+        for values, _, device in sources:
+            if device is not None:
+                lines.append('fgobot_screen_unchanged_seconds{{{}}} {:.3f}'.format(
+                    format_labels(values), device.clock() - device.last_change))
+
+        lines += ['# HELP fgobot_span_seconds Durations of commands, captures, matches, waits and phases.',
+                  '# TYPE fgobot_span_seconds histogram']
+        for values, stats in histograms:
+            for span, (count, total, cumulative) in stats.items():
+                span_labels = dict(values, span=span)
+                for bound, n in zip(spans.BUCKETS, cumulative):
+                    lines.append('fgobot_span_seconds_bucket{{{}}} {}'.format(
+                        format_labels(dict(span_labels, le=repr(float(bound)))), n))
+                lines.append('fgobot_span_seconds_bucket{{{}}} {}'.format(format_labels(dict(span_labels, le='+Inf')), count))
+                lines.append('fgobot_span_seconds_sum{{{}}} {:.6f}'.format(format_labels(span_labels), total))
+                lines.append('fgobot_span_seconds_count{{{}}} {}'.format(format_labels(span_labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def serve(port: int = 9464, host: str = '127.0.0.1') -> MetricsExporter:
+    """
+    Return the exporter of this process listening on `port`, starting it if needed.
+    """
+    with _lock:
+        exporter = _exporters.get(port)
+        if exporter is None:
+            exporter = _exporters[port] = MetricsExporter(port, host).start()
+        return exporter
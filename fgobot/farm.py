@@ -0,0 +1,142 @@
+"""
+Run one `BattleBot` per device on a pool of processes.
+
+A bot is set up in its worker process by a function of the user's script,
+which takes the serial of the device and returns a `BattleBot` with its
+stage handlers registered. The function must be importable by the workers,
+i.e. defined at the top level of the script, and the farm started under
+`if __name__ == '__main__':`, for example::
+
+    def setup(serial: str) -> BattleBot:
+        bot = BattleBot(quest='quest.png', friend='friend.png', serial=serial)
+
+        @bot.at_stage(1)
+        def stage_1():
+            bot.attack([6, 1, 2])
+
+        return bot
+
+    if __name__ == '__main__':
+        farm.run_farm(setup, max_loops=10)
+"""
+import logging
+import subprocess
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import monotonic
+from typing import Callable, Dict, List
+
+import cv2 as cv
+
+from . import device
+
+# the outcome of a bot: the serial of its device, 'ok', 'interrupted' or 'failed',
+# the number of battles played, the seconds it ran and the error it failed with
+FarmResult = namedtuple('FarmResult', ['serial', 'status', 'battles', 'seconds', 'error'])
+
+logger = logging.getLogger('farm')
+
+
+def list_devices(adb_path: str = 'adb', timeout: int = 15) -> List[str]:
+    """
+    Return the serials of the devices connected to the adb server.
+    """
+    output = subprocess.check_output([adb_path, 'devices'], timeout=timeout).decode('utf-8').splitlines()
+    return [line.split()[0] for line in output if line.endswith('device')]
+
+
+def init_worker(cv_threads: int, log_level: int):
+    """
+    Set up a worker process: limit the threads OpenCV and matching use, so
+    that the workers do not fight over the CPUs.
+    """
+    logging.basicConfig(level=log_level,
+                        format='%(asctime)s %(processName)s %(name)s %(levelname)s %(message)s')
+    cv.setNumThreads(cv_threads)
+    device.MATCH_WORKERS = max(cv_threads, 1)
+
+
+def run_bot(setup: Callable, serial: str, max_loops: int, metrics_port: int = None) -> FarmResult:
+    """
+    Set up and run the bot of one device. Runs in a worker process.
+    """
+    start = monotonic()
+    bot = None
+    try:
+        bot = setup(serial)
+        if metrics_port is not None:
+            bot.export_metrics(metrics_port)
+        status = 'interrupted' if bot.run(max_loops) == -1 else 'ok'
+    except Exception as e:
+        logging.getLogger('farm').exception('Bot of {} failed.'.format(serial))
+        return FarmResult(serial, 'failed', 0 if bot is None else bot.count, monotonic() - start, repr(e))
+    # the battles completed before an interruption count as well
+    return FarmResult(serial, status, bot.count, monotonic() - start, None)
+
+
+def run_farm(setup: Callable, serials: List[str] = None,
+             max_loops: int = 3,
+             cv_threads: int = 1,
+             workers: int = None,
+             log_level: int = logging.INFO,
+             metrics_port: int = None,
+             ) -> List[FarmResult]:
+    """
+    Run one bot per device, each in its own process.
+
+    :param setup: a top-level function taking the serial of a device and returning its `BattleBot`.
+    :param serials: the serials of the devices. If not given, all devices connected to the adb server.
+    :param max_loops: the max number of loops of each bot, see `BattleBot.run`.
+    :param cv_threads: the threads each worker lets OpenCV and matching use.
+    :param workers: the number of processes. If not given, one per device.
+    :param log_level: the logging level of the workers.
+    :param metrics_port: if given, export the metrics of the n-th device on port `metrics_port + n`, \
+        see `exporter`. The exporter of a worker keeps serving the devices it ran until the farm ends.
+    :return: the result of each device, in the order of `serials`.
+    """
+    if serials is None:
+        serials = list_devices()
+    if not serials:
+        logger.error('No device to run.')
+        return []
+    logger.info('Running {} devices: {}'.format(len(serials), ', '.join(serials)))
+
+    results = {}  # type: Dict[str, FarmResult]
+    with ProcessPoolExecutor(workers or len(serials), initializer=init_worker,
+                             initargs=(cv_threads, log_level)) as executor:
+        futures = {executor.submit(run_bot, setup, serial, max_loops,
+                                   None if metrics_port is None else metrics_port + n): serial
+                   for n, serial in enumerate(serials)}
+        for future in as_completed(futures):
+            serial = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # the worker died, or `setup` could not be sent to it
+                result = FarmResult(serial, 'failed', 0, 0.0, repr(e))
+            results[serial] = result
+            logger.info('{}: {}, {} battles in {:.0f} seconds.'.format(
+                serial, result.status, result.battles, result.seconds))
+
+    ordered = [results[serial] for serial in serials]
+    summary = summarize(ordered)
+    logger.info('{battles} battles on {devices} devices, {failed} failed, {battles_per_hour:.1f} battles per hour.'
+                .format(**summary))
+    return ordered
+
+
+def summarize(results: List[FarmResult]) -> Dict[str, float]:
+    """
+    Aggregate the results of a farm.
+
+    :return: the number of devices, of failed devices and of battles, and the battles per hour \
+        over the longest run.
+    """
+    battles = sum(r.battles for r in results)
+    longest = max((r.seconds for r in results), default=0)
+    return {
+        'devices': len(results),
+        'failed': sum(r.status == 'failed' for r in results),
+        'battles': battles,
+        'battles_per_hour': battles * 3600 / longest if longest > 0 else 0.0,
+    }
@@ -0,0 +1,323 @@
+"""
+Run history: battles, phase timings and counters of every run, kept in SQLite across sessions.
+
+Given `keep_history=True`, `BattleBot.run` appends a run keyed by device, script and
+quest, then one record per battle with its duration, rounds, the timing report of its
+phases (see `spans`) and its counters, such as AP items used, refreshes of the support
+list and failures to detect the stage. The store is `history.sqlite` under the cache directory.
+
+Query it from the command line:
+
+    python -m fgobot.history summary [--days 7] [--device ...] [--script ...] [--quest ...]
+    python -m fgobot.history trend [--by day|week]
+    python -m fgobot.history phases
+    python -m fgobot.history counters
+    python -m fgobot.history regressions [--recent 3] [--days 30] [--tolerance 1.2]
+"""
+import argparse
+import json
+import logging
+import sqlite3
+from pathlib import Path
+from time import time
+from typing import Dict, List
+
+from .bundle import cache_dir
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    device TEXT NOT NULL,
+    script TEXT NOT NULL,
+    quest TEXT NOT NULL,
+    started REAL NOT NULL,
+    ended REAL,
+    status TEXT
+);
+CREATE TABLE IF NOT EXISTS battles (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    number INTEGER NOT NULL,
+    started REAL NOT NULL,
+    seconds REAL NOT NULL,
+    rounds INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'ok'
+);
+CREATE TABLE IF NOT EXISTS phases (
+    battle_id INTEGER NOT NULL REFERENCES battles(id),
+    span TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    total REAL NOT NULL,
+    p50 REAL NOT NULL,
+    p95 REAL NOT NULL,
+    max REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    battle_id INTEGER NOT NULL REFERENCES battles(id),
+    name TEXT NOT NULL,
+    value INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS battles_run ON battles(run_id);
+CREATE INDEX IF NOT EXISTS phases_battle ON phases(battle_id);
+CREATE INDEX IF NOT EXISTS counters_battle ON counters(battle_id);
+'''
+
+# the run key columns the queries can group and filter by
+KEYS = ('device', 'script', 'quest')
+
+# strftime formats of the periods of `trend`
+PERIODS = {'day': '%Y-%m-%d', 'week': '%Y-W%W'}
+
+logger = logging.getLogger('history')
+
+
+def default_path() -> Path:
+    return cache_dir() / 'history.sqlite'
+
+
+class RunHistory:
+    """
+    The SQLite store of runs. Safe to share between processes, e.g. the workers of a `farm`,
+    but each thread needs its own instance.
+    """
+
+    def __init__(self, path: Path = None):
+        """
+
+        :param path: the database file. If not given, `history.sqlite` under the cache directory.
+        """
+        self.path = Path(path) if path else default_path()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path), timeout=30)
+        self.db.row_factory = sqlite3.Row
+        # let the workers of a farm write while others read
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        # databases written before battles had a status only hold finished battles
+        columns = [row['name'] for row in self.db.execute('PRAGMA table_info(battles)')]
+        if 'status' not in columns:
+            with self.db:
+                self.db.execute("ALTER TABLE battles ADD COLUMN status TEXT NOT NULL DEFAULT 'ok'")
+        self.run_id = None
+
+    def start_run(self, device: str, script: str, quest: str) -> int:
+        """
+        Start recording a run.
+
+        :param device: the serial or connect address of the device.
+        :param script: the name of the script running the bot.
+        :param quest: the name of the quest image.
+        :return: the id of the run.
+        """
+        with self.db:
+            cursor = self.db.execute('INSERT INTO runs (device, script, quest, started) VALUES (?, ?, ?, ?)',
+                                     (device, script, quest, time()))
+        self.run_id = cursor.lastrowid
+        return self.run_id
+
+    def add_battle(self, number: int, started: float, seconds: float, rounds: int,
+                   report: Dict[str, Dict[str, float]], counters: Dict[str, int], status: str = 'ok'):
+        """
+        Record a battle of the current run.
+
+        :param number: the number of the battle in the run, from 1.
+        :param started: the `time.time()` the battle started at.
+        :param seconds: the seconds it took.
+        :param rounds: the rounds played.
+        :param report: the timings of its phases, see `spans.Spans.report`.
+        :param counters: its counters by name, such as 'refreshes'.
+        :param status: 'ok', or 'interrupted' if the battle was left unfinished, \
+            e.g. after failing to detect the stage.
+
+        Failures are logged, not raised.
+        """
+        try:
+            with self.db:
+                cursor = self.db.execute(
+                    'INSERT INTO battles (run_id, number, started, seconds, rounds, status) VALUES (?, ?, ?, ?, ?, ?)',
+                    (self.run_id, number, started, seconds, rounds, status))
+                battle_id = cursor.lastrowid
+                self.db.executemany(
+                    'INSERT INTO phases VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(battle_id, span, s['count'], s['total'], s['p50'], s['p95'], s['max'])
+                     for span, s in report.items()])
+                self.db.executemany('INSERT INTO counters VALUES (?, ?, ?)',
+                                    [(battle_id, name, value) for name, value in counters.items() if value])
+        except sqlite3.Error as e:
+            logger.warning('Failed to record battle {}: {}'.format(number, e))
+
+    def end_run(self, status: str):
+        """
+        Finish the current run.
+
+        :param status: 'ok', 'interrupted' or 'failed'.
+
+        Failures are logged, not raised.
+        """
+        try:
+            with self.db:
+                self.db.execute('UPDATE runs SET ended = ?, status = ? WHERE id = ?', (time(), status, self.run_id))
+        except sqlite3.Error as e:
+            logger.warning('Failed to record the end of run {}: {}'.format(self.run_id, e))
+        self.run_id = None
+
+    def close(self):
+        self.db.close()
+
+    @staticmethod
+    def __where(filters: Dict[str, str], days: float = None, column: str = 'runs.started') -> tuple:
+        clauses, params = [], []
+        for key in KEYS:
+            if filters.get(key):
+                clauses.append('runs.{} = ?'.format(key))
+                params.append(filters[key])
+        if days is not None:
+            clauses.append('{} >= ?'.format(column))
+            params.append(time() - days * 86400)
+        return ' AND '.join(clauses) or '1', params
+
+    def summary(self, days: float = None, **filters) -> List[dict]:
+        """
+        Throughput of each device, script and quest.
+
+        :param days: only the runs of the last `days` days. If not given, all runs.
+        :param filters: only the runs of the given `device`, `script` or `quest`.
+        :return: the runs, finished and interrupted battles, hours run, battles per hour \
+            and mean seconds and rounds per finished battle, by device, script and quest.
+        """
+        where, params = self.__where(filters, days)
+        rows = self.db.execute('''
+            SELECT runs.device, runs.script, runs.quest,
+                   COUNT(DISTINCT runs.id) AS runs,
+                   COUNT(CASE WHEN battles.status = 'ok' THEN 1 END) AS battles,
+                   COUNT(CASE WHEN battles.status != 'ok' THEN 1 END) AS interrupted,
+                   AVG(CASE WHEN battles.status = 'ok' THEN battles.seconds END) AS seconds_per_battle,
+                   AVG(CASE WHEN battles.status = 'ok' THEN battles.rounds END) AS rounds_per_battle
+            FROM runs LEFT JOIN battles ON battles.run_id = runs.id
+            WHERE {}
+            GROUP BY runs.device, runs.script, runs.quest
+            ORDER BY runs.device, runs.script, runs.quest'''.format(where), params).fetchall()
+        hours = {tuple(row)[:3]: row[3] for row in self.db.execute('''
+            SELECT device, script, quest, SUM(ended - started) / 3600
+            FROM runs WHERE ended IS NOT NULL AND {}
+            GROUP BY device, script, quest'''.format(where), params)}
+        results = []
+        for row in rows:
+            result = dict(row)
+            result['hours'] = hours.get(tuple(row)[:3]) or 0.0
+            result['battles_per_hour'] = result['battles'] / result['hours'] if result['hours'] else None
+            results.append(result)
+        return results
+
+    def trend(self, by: str = 'day', days: float = None, **filters) -> List[dict]:
+        """
+        Battles and mean seconds per battle, by period.
+
+        :param by: 'day' or 'week'.
+        """
+        where, params = self.__where(filters, days, 'battles.started')
+        return [dict(row) for row in self.db.execute('''
+            SELECT strftime(?, battles.started, 'unixepoch', 'localtime') AS period,
+                   COUNT(*) AS battles,
+                   AVG(battles.seconds) AS seconds_per_battle,
+                   3600 / AVG(battles.seconds) AS battles_per_hour
+            FROM battles JOIN runs ON battles.run_id = runs.id
+            WHERE battles.status = 'ok' AND {}
+            GROUP BY period ORDER BY period'''.format(where), [PERIODS[by]] + params)]
+
+    def phases(self, days: float = None, **filters) -> List[dict]:
+        """
+        Mean seconds per battle of each span, and the mean of their p95, the slowest first.
+        """
+        where, params = self.__where(filters, days, 'battles.started')
+        return [dict(row) for row in self.db.execute('''
+            SELECT phases.span,
+                   COUNT(*) AS battles,
+                   AVG(phases.total) AS seconds_per_battle,
+                   AVG(phases.count) AS count_per_battle,
+                   AVG(phases.p95) AS p95,
+                   MAX(phases.max) AS max
+            FROM phases JOIN battles ON phases.battle_id = battles.id JOIN runs ON battles.run_id = runs.id
+            WHERE {}
+            GROUP BY phases.span ORDER BY seconds_per_battle DESC'''.format(where), params)]
+
+    def counters(self, days: float = None, **filters) -> List[dict]:
+        """
+        Totals of each counter, such as AP items used, by device, script and quest.
+        """
+        where, params = self.__where(filters, days, 'battles.started')
+        return [dict(row) for row in self.db.execute('''
+            SELECT runs.device, runs.script, runs.quest, counters.name, SUM(counters.value) AS total,
+                   CAST(SUM(counters.value) AS REAL) / COUNT(DISTINCT battles.id) AS per_battle
+            FROM counters JOIN battles ON counters.battle_id = battles.id JOIN runs ON battles.run_id = runs.id
+            WHERE {}
+            GROUP BY runs.device, runs.script, runs.quest, counters.name
+            ORDER BY runs.device, runs.script, runs.quest, counters.name'''.format(where), params)]
+
+    def regressions(self, recent: float = 3, days: float = 30, tolerance: float = 1.2, **filters) -> List[dict]:
+        """
+        Find the devices, scripts and quests whose battles got slower: the mean seconds per battle
+        of the last `recent` days against the `days` days before.
+
+        :return: the keys whose recent mean is more than `tolerance` times the earlier one, the worst first.
+        """
+        where, params = self.__where(filters, recent + days, 'battles.started')
+        split = time() - recent * 86400
+        rows = self.db.execute('''
+            SELECT runs.device, runs.script, runs.quest,
+                   AVG(CASE WHEN battles.started >= ? THEN battles.seconds END) AS recent,
+                   AVG(CASE WHEN battles.started < ? THEN battles.seconds END) AS before,
+                   SUM(battles.started >= ?) AS recent_battles
+            FROM battles JOIN runs ON battles.run_id = runs.id
+            WHERE battles.status = 'ok' AND {}
+            GROUP BY runs.device, runs.script, runs.quest'''.format(where), [split] * 3 + params)
+        results = []
+        for row in rows:
+            if row['recent'] is not None and row['before'] and row['recent'] > row['before'] * tolerance:
+                result = dict(row)
+                result['ratio'] = row['recent'] / row['before']
+                results.append(result)
+        return sorted(results, key=lambda r: -r['ratio'])
+
+
+def format_table(rows: List[dict]) -> str:
+    """
+    Format query results as an aligned text table.
+    """
+    if not rows:
+        return '(no data)'
+    columns = list(rows[0])
+    cells = [columns] + [['{:.2f}'.format(v) if isinstance(v, float) else '-' if v is None else str(v)
+                          for v in row.values()] for row in rows]
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    return '\n'.join('  '.join(c.rjust(w) if n else c.ljust(w) for n, (c, w) in enumerate(zip(line, widths)))
+                     for line in cells)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the history of runs of BattleBot.')
+    parser.add_argument('query', choices=['summary', 'trend', 'phases', 'counters', 'regressions'])
+    parser.add_argument('--db', type=Path, help='the database file, by default under the cache directory')
+    parser.add_argument('--days', type=float, help='only the last days, or the baseline days of regressions')
+    parser.add_argument('--recent', type=float, default=3, help='the recent days of regressions')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='the slowdown counted as a regression')
+    parser.add_argument('--by', choices=list(PERIODS), default='day', help='the period of trend')
+    for key in KEYS:
+        parser.add_argument('--' + key, help='only the runs of this ' + key)
+    parser.add_argument('--json', action='store_true', help='print JSON instead of a table')
+    args = parser.parse_args()
+
+    history = RunHistory(args.db)
+    filters = {key: getattr(args, key) for key in KEYS}
+    if args.query == 'trend':
+        rows = history.trend(args.by, args.days, **filters)
+    elif args.query == 'regressions':
+        rows = history.regressions(args.recent, args.days or 30, args.tolerance, **filters)
+    else:
+        rows = getattr(history, args.query)(args.days, **filters)
+    history.close()
+    print(json.dumps(rows, indent=2) if args.json else format_table(rows))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+"""
+Input backends: how taps and swipes are turned into shell commands on the device.
+
+`ShellInput` uses the `input` command, which starts a JVM (`app_process`) for
+every event. `SendeventInput` writes raw multi-touch events to the touch screen's
+event device with `sendevent`, which is a small native tool and much faster.
+"""
+import logging
+import re
+from collections import namedtuple
+from typing import Callable, Dict, List, Tuple, Union
+
+# event types and codes of linux/input-event-codes.h
+EV_SYN = 0x00
+EV_KEY = 0x01
+EV_ABS = 0x03
+SYN_REPORT = 0x00
+BTN_TOUCH = 0x14a
+ABS_MT_TOUCH_MAJOR = 0x30
+ABS_MT_POSITION_X = 0x35
+ABS_MT_POSITION_Y = 0x36
+ABS_MT_TRACKING_ID = 0x39
+ABS_MT_PRESSURE = 0x3a
+
+# the range of an absolute axis
+AxisRange = namedtuple('AxisRange', ['min', 'max'])
+
+# the least seconds between two moves of a swipe
+SWIPE_STEP = 0.03
+# the estimated seconds a device takes to start one `sendevent`, a new process for each event
+SENDEVENT_COST = 0.005
+
+
+class InputBackend:
+    """
+    Turns taps and swipes, in pixels of the device screen, into shell commands.
+    """
+
+    def setup(self, run: Callable[[str], List[str]], screen_size: Tuple[int, int]):
+        """
+        Called once the device is connected, before the first event.
+
+        :param run: a callable executing a shell command on the device and returning its output lines.
+        :param screen_size: the (width, height) of the device screen in pixels.
+        """
+
+    def tap(self, x: int, y: int) -> str:
+        """
+        Return the shell command of a tap at `pos:(x, y)`.
+        """
+        raise NotImplementedError
+
+    def swipe(self, x0: int, y0: int, x1: int, y1: int, duration: int) -> str:
+        """
+        Return the shell command of a swipe from `(x0, y0)` to `(x1, y1)`, taking `duration` milliseconds.
+        """
+        raise NotImplementedError
+
+
+class ShellInput(InputBackend):
+    """
+    Inject events with the `input` command.
+    """
+
+    def tap(self, x: int, y: int) -> str:
+        return 'input tap {:d} {:d}'.format(x, y)
+
+    def swipe(self, x0: int, y0: int, x1: int, y1: int, duration: int) -> str:
+        return 'input swipe {:d} {:d} {:d} {:d} {:d}'.format(x0, y0, x1, y1, duration)
+
+
+class TouchDevice:
+    """
+    An input device of the kernel, as described by `getevent -p`.
+    """
+
+    def __init__(self, path: str, name: str = ''):
+        self.path = path
+        self.name = name
+        # ranges of the absolute axes by code
+        self.axes = {}  # type: Dict[int, AxisRange]
+        # supported key codes
+        self.keys = set()
+        self.props = set()
+
+    @property
+    def multi_touch(self) -> bool:
+        return ABS_MT_POSITION_X in self.axes and ABS_MT_POSITION_Y in self.axes
+
+
+def parse_getevent(output: List[str]) -> List[TouchDevice]:
+    """
+    Parse the output of `getevent -p`.
+
+    :param output: the output lines.
+    :return: the input devices.
+    """
+    devices = []
+    dev, section = None, None
+    for line in output:
+        m = re.match(r'add device \d+: (\S+)', line)
+        if m:
+            dev, section = TouchDevice(m.group(1)), None
+            devices.append(dev)
+            continue
+        if dev is None:
+            continue
+        m = re.match(r'\s*name:\s*"(.*)"', line)
+        if m:
+            dev.name = m.group(1)
+            continue
+        m = re.match(r'\s*(\w+) \(([0-9a-f]{4})\):(.*)', line)
+        if m:
+            section, line = m.group(1), m.group(3)
+        elif re.match(r'\s*(events|input props):', line):
+            section = 'PROPS' if 'props' in line else None
+            continue
+        if section == 'ABS':
+            m = re.search(r'([0-9a-f]{4})\s*: value -?\d+, min (-?\d+), max (-?\d+)', line)
+            if m:
+                dev.axes[int(m.group(1), 16)] = AxisRange(int(m.group(2)), int(m.group(3)))
+        elif section == 'KEY':
+            dev.keys.update(int(code, 16) for code in re.findall(r'\b[0-9a-f]{4}\b', line))
+        elif section == 'PROPS':
+            dev.props.add(line.strip())
+    return devices
+
+
+class SendeventInput(InputBackend):
+    """
+    Inject multi-touch events (protocol B) into the touch screen with `sendevent`.
+
+    The touch screen and the ranges of its axes are discovered once with `getevent -p`.
+    Screen pixels are scaled to the axis ranges, and rotated if the touch panel
+    is mounted in portrait while the screen is in landscape.
+    """
+
+    def __init__(self, device_path: str = None, rotation: int = None):
+        """
+
+        :param device_path: the event device of the touch screen, such as `/dev/input/event2`. \
+            If not given, the first device reporting multi-touch positions.
+        :param rotation: the rotation of the screen from the natural orientation of the panel, \
+            0 to 3 for 0, 90, 180 and 270 degrees. If not given, 1 if the panel is portrait \
+            and the screen is landscape, else 0.
+        """
+        self.logger = logging.getLogger('input')
+        self.device_path = device_path
+        self.rotation = rotation
+        self.touch = None  # type: Union[TouchDevice, None]
+        self.screen_size = (1280, 720)
+        self.tracking_id = 0
+
+    def setup(self, run: Callable[[str], List[str]], screen_size: Tuple[int, int]):
+        self.screen_size = screen_size
+        devices = parse_getevent(run('getevent -p'))
+        for dev in devices:
+            if (self.device_path is None and dev.multi_touch) or dev.path == self.device_path:
+                self.touch = dev
+                break
+        if self.touch is None or not self.touch.multi_touch:
+            raise RuntimeError('No multi-touch input device found{}.'.format(
+                '' if self.device_path is None else ' at ' + self.device_path))
+        if self.rotation is None:
+            x, y = self.touch.axes[ABS_MT_POSITION_X], self.touch.axes[ABS_MT_POSITION_Y]
+            panel_portrait = x.max - x.min < y.max - y.min
+            self.rotation = 1 if panel_portrait and screen_size[0] > screen_size[1] else 0
+        self.logger.info('Touch device {} "{}", rotation {}.'.format(self.touch.path, self.touch.name, self.rotation))
+
+    def to_axes(self, x: int, y: int) -> Tuple[int, int]:
+        """
+        Convert a position on the screen, in pixels, to the axes of the touch panel.
+        """
+        w, h = self.screen_size
+        # the position in the natural orientation of the panel, and the natural size
+        if self.rotation == 1:
+            (nx, ny), (nw, nh) = (h - 1 - y, x), (h, w)
+        elif self.rotation == 2:
+            (nx, ny), (nw, nh) = (w - 1 - x, h - 1 - y), (w, h)
+        elif self.rotation == 3:
+            (nx, ny), (nw, nh) = (y, w - 1 - x), (h, w)
+        else:
+            (nx, ny), (nw, nh) = (x, y), (w, h)
+        ax, ay = self.touch.axes[ABS_MT_POSITION_X], self.touch.axes[ABS_MT_POSITION_Y]
+        return (ax.min + round(nx * (ax.max - ax.min) / max(nw - 1, 1)),
+                ay.min + round(ny * (ay.max - ay.min) / max(nh - 1, 1)))
+
+    def __event(self, type_: int, code: int, value: int) -> str:
+        # sendevent takes the value as unsigned
+        return 'sendevent {} {:d} {:d} {:d}'.format(self.touch.path, type_, code, value & 0xffffffff)
+
+    def __down(self, x: int, y: int) -> List[str]:
+        self.tracking_id = (self.tracking_id + 1) % 0x10000
+        ax, ay = self.to_axes(x, y)
+        events = [self.__event(EV_ABS, ABS_MT_TRACKING_ID, self.tracking_id)]
+        for code in (ABS_MT_TOUCH_MAJOR, ABS_MT_PRESSURE):
+            axis = self.touch.axes.get(code)
+            if axis is not None:
+                events.append(self.__event(EV_ABS, code, max(axis.min, min(axis.max, (axis.min + axis.max) // 2))))
+        events += [self.__event(EV_ABS, ABS_MT_POSITION_X, ax), self.__event(EV_ABS, ABS_MT_POSITION_Y, ay)]
+        if BTN_TOUCH in self.touch.keys:
+            events.append(self.__event(EV_KEY, BTN_TOUCH, 1))
+        events.append(self.__event(EV_SYN, SYN_REPORT, 0))
+        return events
+
+    def __move(self, x: int, y: int) -> List[str]:
+        ax, ay = self.to_axes(x, y)
+        return [self.__event(EV_ABS, ABS_MT_POSITION_X, ax), self.__event(EV_ABS, ABS_MT_POSITION_Y, ay),
+                self.__event(EV_SYN, SYN_REPORT, 0)]
+
+    def __up(self) -> List[str]:
+        events = [self.__event(EV_ABS, ABS_MT_TRACKING_ID, -1)]
+        if BTN_TOUCH in self.touch.keys:
+            events.append(self.__event(EV_KEY, BTN_TOUCH, 0))
+        events.append(self.__event(EV_SYN, SYN_REPORT, 0))
+        return events
+
+    def tap(self, x: int, y: int) -> str:
+        return '; '.join(self.__down(x, y) + self.__up())
+
+    def swipe(self, x0: int, y0: int, x1: int, y1: int, duration: int) -> str:
+        """
+        Every move runs 3 `sendevent`, so moves are at least `SWIPE_STEP` apart, and the
+        estimated cost of starting them, `SENDEVENT_COST` each, is taken from the sleeps
+        between them. A swipe of 1000 ms is 33 moves and about 105 processes, of which
+        starting takes about half a second, for the swipe to still take about `duration`.
+        """
+        steps = max(int(duration / 1000 / SWIPE_STEP), 1)
+        pause = duration / 1000 / steps - 3 * SENDEVENT_COST
+        events = self.__down(x0, y0)
+        for i in range(1, steps + 1):
+            if pause > 0:
+                events.append('sleep {:.3f}'.format(pause))
+            events += self.__move(x0 + (x1 - x0) * i // steps, y0 + (y1 - y0) * i // steps)
+        return '; '.join(events + self.__up())
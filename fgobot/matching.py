@@ -0,0 +1,90 @@
+"""
+Template matching engines.
+
+Both engines return the same `(max_val, max_loc)` as `cv.minMaxLoc` on a full
+`cv.matchTemplate` result.
+"""
+from typing import List, Tuple
+
+import cv2 as cv
+import numpy as np
+
+# the template matching method
+TM_METHOD = cv.TM_CCOEFF_NORMED
+
+# the smallest side of a template at the coarsest pyramid level
+MIN_TEMPLATE_SIDE = 12
+MAX_LEVELS = 3
+
+
+def full_match(screen: np.ndarray, template: np.ndarray) -> Tuple[float, Tuple[int, int]]:
+    """
+    Match `template` at every position of `screen`.
+
+    :return: match-value and match-location.
+    """
+    res = cv.matchTemplate(screen, template, TM_METHOD)
+    _, max_val, _, max_loc = cv.minMaxLoc(res)
+    return max_val, max_loc
+
+
+def pyramid_levels(template: np.ndarray) -> int:
+    """
+    Return how many times `template` can be halved for coarse matching.
+    """
+    side = min(template.shape[:2])
+    levels = 0
+    while levels < MAX_LEVELS and side >> (levels + 1) >= MIN_TEMPLATE_SIDE:
+        levels += 1
+    return levels
+
+
+def build_pyramid(img: np.ndarray, levels: int) -> List[np.ndarray]:
+    """
+    Return `img` and its `levels` successive half-size downscales.
+    """
+    pyramid = [img]
+    for _ in range(levels):
+        pyramid.append(cv.pyrDown(pyramid[-1]))
+    return pyramid
+
+
+def pyramid_match(screens: List[np.ndarray], templates: List[np.ndarray],
+                  candidates: int = 3) -> Tuple[float, Tuple[int, int]]:
+    """
+    Match on the coarsest level of the pyramids, then refine the best
+    `candidates` peaks at full resolution.
+
+    :param screens: the pyramid of the screen, see `build_pyramid`. May be deeper than `templates`.
+    :param templates: the pyramid of the template.
+    :param candidates: the number of coarse peaks to refine.
+    :return: match-value and match-location.
+    """
+    levels = len(templates) - 1
+    screen, template = screens[0], templates[0]
+    coarse_screen = screens[levels]
+    if levels == 0 or any(s < t for s, t in zip(coarse_screen.shape[:2], templates[levels].shape[:2])):
+        return full_match(screen, template)
+
+    res = cv.matchTemplate(coarse_screen, templates[levels], TM_METHOD)
+    scale = 1 << levels
+    th, tw = template.shape[:2]
+    sh, sw = screen.shape[:2]
+    # pyrDown rounds sizes, so allow a few pixels of drift when refining
+    radius = 2 * scale
+    suppress = max(1, min(templates[levels].shape[:2]) // 2)
+
+    best_val, best_loc = -1.0, (0, 0)
+    for _ in range(candidates):
+        _, val, _, (cx, cy) = cv.minMaxLoc(res)
+        if val == -np.inf:
+            break
+        x0, y0 = max(cx * scale - radius, 0), max(cy * scale - radius, 0)
+        x1, y1 = min(cx * scale + radius + tw, sw), min(cy * scale + radius + th, sh)
+        if x1 - x0 >= tw and y1 - y0 >= th:
+            max_val, (x, y) = full_match(screen[y0:y1, x0:x1], template)
+            if max_val > best_val:
+                best_val, best_loc = max_val, (x + x0, y + y0)
+        # suppress this peak so the next candidate is elsewhere
+        res[max(cy - suppress, 0):cy + suppress + 1, max(cx - suppress, 0):cx + suppress + 1] = -np.inf
+    return best_val, best_loc
@@ -0,0 +1,144 @@
+"""
+A sampling profiler for long runs, writing collapsed stacks tagged with the phase of the bot.
+
+A thread samples the Python stack of the bot's thread at a fixed interval, or of all
+other threads if not given one. Each sample is tagged with the current phase of the bot,
+see `spans.Spans.phase`, and the name of its thread, so flame graphs split by phase::
+
+    bot.stage.2;MainThread;bot:run;bot:__run;...;matching:full_match 42
+
+`BattleBot.run` profiles when given `profile=<directory>` or when `$FGOBOT_PROFILE`
+is set to a directory, and writes one file per battle. It samples the thread calling
+`run` only, so the bots of a `farm`, each in its own thread, profile apart. Render
+them with e.g. `flamegraph.pl battle-1.collapsed > battle-1.svg`, or load them into speedscope.
+
+Samples are of wall-clock time: a thread waiting in `time.sleep` or for a screenshot
+counts as much as one matching. Threads idle in a pool or a server are skipped.
+"""
+import logging
+import os
+import sys
+import threading
+from collections import Counter
+from pathlib import Path
+from time import strftime
+from typing import Union
+
+from . import spans
+
+# seconds between two samples
+INTERVAL = 0.01
+# the deepest frames kept per stack
+MAX_DEPTH = 128
+# the innermost frames of threads with nothing to do, as (file name, function)
+IDLE = {
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('selectors.py', 'select'),
+    ('thread.py', '_worker'),
+}
+
+logger = logging.getLogger('profiler')
+
+
+def frame_name(code) -> str:
+    """
+    Return the name of a frame in a collapsed stack, `module:function`.
+    """
+    name = '{}:{}'.format(os.path.splitext(os.path.basename(code.co_filename))[0], code.co_name)
+    return name.replace(';', ',').replace(' ', '_')
+
+
+class SamplingProfiler:
+    """
+    Sample the stacks of a thread, or of all threads of the process, in a background thread.
+    """
+
+    def __init__(self, source: spans.Spans = None, directory: Path = None, interval: float = INTERVAL,
+                 thread: int = None):
+        """
+
+        :param source: the spans whose current phase tags the samples, such as `BattleBot.spans`.
+        :param directory: where `dump` writes the collapsed stacks, created if needed.
+        :param interval: the seconds between two samples.
+        :param thread: the ident of the thread to sample, such as the one running the bot, \
+            see `threading.get_ident`. If not given, all threads but the profiler's, \
+            tagged with the same phase.
+        """
+        self.source = source
+        self.directory = Path(directory) if directory else Path('.')
+        self.prefix = strftime('%Y%m%d-%H%M%S')
+        self.interval = interval
+        self.target = thread
+        # samples by (phase, thread name, code objects from the outermost frame)
+        self.samples = Counter()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__run, name='profiler', daemon=True)
+
+    def start(self) -> 'SamplingProfiler':
+        self.thread.start()
+        logger.info('Profiling every {:.0f} ms into {}.'.format(self.interval * 1000, self.directory))
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def __run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            phase = None if self.source is None else self.source.phase
+            names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = []
+            frames = sys._current_frames()
+            if self.target is not None:
+                frames = {self.target: frames[self.target]} if self.target in frames else {}
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE:
+                    continue
+                codes = []
+                while frame is not None and len(codes) < MAX_DEPTH:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                codes.reverse()
+                stacks.append((phase, names.get(ident, str(ident)), tuple(codes)))
+            with self.lock:
+                self.samples.update(stacks)
+
+    def collapse(self) -> Counter:
+        """
+        Take the samples since the last call, as counts by collapsed stack.
+        """
+        with self.lock:
+            samples, self.samples = self.samples, Counter()
+        stacks = Counter()
+        for (phase, thread, codes), count in samples.items():
+            tag = 'other' if phase is None else spans.NAMES[phase]
+            thread = thread.replace(';', ',').replace(' ', '_')
+            stacks[';'.join([tag, thread] + [frame_name(code) for code in codes])] += count
+        return stacks
+
+    def dump(self, name: str) -> Union[Path, None]:
+        """
+        Write the samples since the last dump to `<directory>/<start time>-<name>.collapsed`.
+
+        :return: the file, or None if there was no sample. Failures are logged, not raised.
+        """
+        stacks = self.collapse()
+        if not stacks:
+            return None
+        path = self.directory / '{}-{}.collapsed'.format(self.prefix, name)
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with open(path, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write('{} {}\n'.format(stack, count))
+        except OSError as e:
+            logger.warning('Failed to write profile: {}'.format(e))
+            return None
+        logger.info('{} samples written to {}.'.format(sum(stacks.values()), path))
+        return path
@@ -0,0 +1,532 @@
+"""
+A simulated game behind a fake adb server, to run `BattleBot` without an emulator.
+
+The fake server speaks the adb server protocol, so the bot talks to it exactly
+as to a real one. Screens are composed from the templates in `fgobot/images`
+over a background, follow a state machine of the game's flow from the quest
+list to the end of a battle, and react to taps at the coordinates of
+`config/buttons.json`. Screenshots are served as PNG or raw, and every
+command, capture and transition of the game takes a configurable time.
+
+Run a bot against it and report battles per hour and reaction times:
+
+    python -m fgobot.sim --battles 3 --settle
+"""
+import argparse
+import json
+import logging
+import re
+import socketserver
+import struct
+import tempfile
+import threading
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Dict, List, Tuple, Union
+
+import cv2 as cv
+import numpy as np
+
+from .input import ABS_MT_POSITION_X, ABS_MT_POSITION_Y, ABS_MT_TRACKING_ID, EV_ABS, EV_SYN
+
+# seconds the simulated device and game take, before being divided by `speed`
+LATENCIES = {
+    'command': 0.005,    # any shell command
+    'screencap': 0.05,   # taking a screenshot
+    'input': 0.1,        # one `input` command, which starts a JVM
+    'sendevent': 0.002,  # one `sendevent` command
+    'short': 0.3,        # pop up windows
+    'mid': 1.0,          # loading the friend list
+    'long': 3.0,         # loading a battle, attack animations
+}
+
+SERIAL = 'emulator-5554'
+SCREEN_SIZE = (1280, 720)
+# animated screens cycle through this many frames
+FRAMES = 8
+
+# the top-left corner of each template on the screens showing it
+POSITIONS = {
+    'quest': (600, 200),
+    'friend_pick': (520, 500),
+    'view_friend_party': (1000, 250),
+    'friend': (60, 220),
+    'start_quest': (1100, 640),
+    'attack': (1100, 620),
+    '1_3': (880, 12),
+    '2_3': (880, 12),
+    '3_3': (880, 12),
+    'battleBack': (1180, 680),
+    'bond': (100, 100),
+    'next_step': (1040, 620),
+    'not_apply': (300, 560),
+    'close': (400, 560),
+    'continue_battle': (720, 560),
+    'menu': (1100, 640),
+}
+
+# the keys of `buttons.json` giving the distance between buttons of a row
+DISTANCES = {'card': 'normal_card_distance', 'noble_card': 'noble_card_distance'}
+
+# the templates shown by each state, and whether the state is animated
+SCREENS = {
+    'terminal': (['quest'], False),
+    'quest_confirm': (['friend_pick'], False),
+    'support': (['view_friend_party', 'friend'], False),
+    'party': (['start_quest'], False),
+    'loading': ([], True),
+    'battle': (['attack', '{stage}_3'], False),
+    'cards': (['battleBack', '{stage}_3'], False),
+    'bond': (['bond'], False),
+    'result': (['next_step'], False),
+    'apply': (['not_apply'], False),
+    'continue': (['continue_battle', 'close'], False),
+    'menu': (['menu'], False),
+}
+
+GETEVENT = '''add device 1: /dev/input/event2
+  name:     "sim_touch"
+  events:
+    KEY (0001): 014a
+    ABS (0003): 0035  : value 0, min 0, max 1279, fuzz 0, flat 0, resolution 0
+                0036  : value 0, min 0, max 719, fuzz 0, flat 0, resolution 0
+                0039  : value 0, min 0, max 65535, fuzz 0, flat 0, resolution 0
+  input props:
+    INPUT_PROP_DIRECT
+'''
+
+# a line written to a long-lived shell by `adb.ShellSession`
+SESSION_LINE = re.compile(r"^\{ (.*); \} 2>&1; printf '\\n(\S+)%d\\n' \$\?$")
+
+logger = logging.getLogger('sim')
+
+
+def texture(size: Tuple[int, int], seed: int, low: int = 0, high: int = 256) -> np.ndarray:
+    """
+    Return a random BGR image of `size` (width, height), distinct for each seed.
+    """
+    rng = np.random.default_rng(seed)
+    w, h = size
+    # blocks of 4x4 pixels, so resizing and pyramids keep the pattern
+    small = rng.integers(low, high, (h // 4 + 1, w // 4 + 1, 3), dtype=np.uint8)
+    return cv.resize(small, (w // 4 * 4 + 4, h // 4 * 4 + 4), interpolation=cv.INTER_NEAREST)[:h, :w]
+
+
+class Game:
+    """
+    The state machine of the game screens, reacting to taps.
+
+    :ivar reactions: seconds from a screen appearing to the tap leaving it, by state.
+    :ivar battles: the `time.monotonic()` each battle ended at.
+    """
+
+    def __init__(self, templates: Dict[str, np.ndarray], stages: int = 3, speed: float = 1,
+                 background: np.ndarray = None):
+        """
+
+        :param templates: the images to compose screens from, by name, including 'quest' and 'friend'.
+        :param stages: the number of stages in a battle.
+        :param speed: how many times faster than `LATENCIES` the game runs.
+        :param background: the 1280x720 screen the templates are pasted on. If not given, a random texture.
+        """
+        with open(Path(__file__).absolute().parent / 'config' / 'buttons.json') as f:
+            self.buttons = json.load(f)
+        self.templates = templates
+        self.stages = stages
+        self.speed = speed
+        self.background = background if background is not None else texture(SCREEN_SIZE, 0, 0, 64)
+        self.lock = threading.Lock()
+        self.state, self.stage, self.first = 'terminal', 1, True
+        self.shown_at = monotonic()
+        # the state to enter once the current one has lasted long enough
+        self.next = None  # type: Union[Tuple[float, str], None]
+        self.cards = set()
+        self.screens = {}  # type: Dict[Tuple[str, int, int], np.ndarray]
+        self.encoded = {}  # type: Dict[Tuple[str, int, int, bool], bytes]
+        self.reactions = {}  # type: Dict[str, List[float]]
+        self.battles = []  # type: List[float]
+        self.frame = 0
+
+    def latency(self, kind: str) -> float:
+        return LATENCIES[kind] / self.speed
+
+    def __enter(self, state: str, delay: str = None):
+        """
+        Leave the current state, entering `state` after a latency of kind `delay`.
+        """
+        now = monotonic()
+        self.reactions.setdefault(self.state, []).append(now - self.shown_at)
+        if delay is None:
+            self.state, self.shown_at = state, now
+        else:
+            # a transition in between, such as a loading, shows as animated
+            self.state, self.shown_at = 'loading', now
+            self.next = (now + self.latency(delay), state)
+
+    def __advance(self):
+        if self.next is not None and monotonic() >= self.next[0]:
+            _, self.state = self.next
+            self.next, self.shown_at = None, monotonic()
+            if self.state == 'bond':
+                self.battles.append(self.shown_at)
+                logger.info('Battle {} finished.'.format(len(self.battles)))
+
+    def screen(self) -> np.ndarray:
+        """
+        Return the current screen.
+        """
+        return self.screens[self.__render()]
+
+    def __render(self) -> Tuple[str, int, int]:
+        with self.lock:
+            self.__advance()
+            names, animated = SCREENS[self.state]
+            self.frame = (self.frame + 1) % FRAMES if animated else 0
+            key = (self.state, self.stage, self.frame)
+            if key not in self.screens:
+                img = np.roll(self.background, 8 * self.frame, axis=1).copy()
+                for name in names:
+                    name = name.format(stage=self.stage)
+                    template = self.templates[name]
+                    x, y = POSITIONS[name]
+                    h, w = template.shape[:2]
+                    img[y:y + h, x:x + w] = template
+                self.screens[key] = img
+            return key
+
+    def screencap(self, raw: bool) -> bytes:
+        """
+        Return the current screen as the output of `screencap`, or `screencap -p`.
+        """
+        key = self.__render()
+        img = self.screens[key]
+        key += (raw,)
+        data = self.encoded.get(key)
+        if data is None:
+            if raw:
+                rgba = cv.cvtColor(img, cv.COLOR_BGR2RGBA)
+                data = struct.pack('<4I', img.shape[1], img.shape[0], 1, 0) + rgba.tobytes()
+            else:
+                data = cv.imencode('.png', img)[1].tobytes()
+            self.encoded[key] = data
+        return data
+
+    def __hit(self, name: str, x: int, y: int) -> bool:
+        """
+        Whether `(x, y)` is inside the template `name` shown on the screen.
+        """
+        tx, ty = POSITIONS[name]
+        h, w = self.templates[name].shape[:2]
+        return tx <= x < tx + w and ty <= y < ty + h
+
+    def __button(self, key: str, x: int, y: int, n: int = 0) -> bool:
+        """
+        Whether `(x, y)` is on the `n`-th button `key` of `buttons.json`.
+        """
+        b = self.buttons[key]
+        bx = b['x'] + self.buttons.get(DISTANCES.get(key), 0) * n
+        return bx <= x < bx + b['w'] and b['y'] <= y < b['y'] + b['h']
+
+    def tap(self, x: int, y: int):
+        """
+        React to a tap at `(x, y)`.
+        """
+        with self.lock:
+            self.__advance()
+            state = self.state
+            logger.debug('Tap at {} {} on {}.'.format(x, y, state))
+            if state == 'terminal' and self.__hit('quest', x, y):
+                self.__enter('quest_confirm', 'mid')
+            elif state == 'quest_confirm' and self.__hit('friend_pick', x, y):
+                self.__enter('support', 'mid')
+            elif state == 'support' and self.__hit('friend', x, y):
+                self.__enter('party' if self.first else 'battle', 'short' if self.first else 'long')
+                self.stage = 1
+            elif state == 'party' and self.__hit('start_quest', x, y):
+                self.__enter('battle', 'long')
+            elif state == 'battle' and self.__button('attack', x, y):
+                self.cards = set()
+                self.__enter('cards', 'short')
+            elif state == 'cards':
+                for n in range(5):
+                    if self.__button('card', x, y, n):
+                        self.cards.add(n)
+                for n in range(3):
+                    if self.__button('noble_card', x, y, n):
+                        self.cards.add(5 + n)
+                if len(self.cards) >= 3:
+                    if self.stage < self.stages:
+                        self.__enter('battle', 'long')
+                        self.stage += 1
+                    else:
+                        self.__enter('bond', 'long')
+            elif state == 'bond':
+                self.__enter('result', 'short')
+            elif state == 'result' and self.__hit('next_step', x, y):
+                self.__enter('apply', 'short')
+            elif state == 'apply' and self.__hit('not_apply', x, y):
+                self.__enter('continue', 'short')
+            elif state == 'continue' and self.__hit('continue_battle', x, y):
+                self.first = False
+                self.__enter('quest_confirm', 'mid')
+            elif state == 'continue' and self.__hit('close', x, y):
+                self.__enter('menu', 'long')
+
+    def report(self, start: float) -> dict:
+        """
+        Summarize battles per hour, and the reaction time of the bot on each screen.
+
+        :param start: the `time.monotonic()` the bot started at.
+        """
+        elapsed = monotonic() - start
+        reactions = {}
+        for state, secs in self.reactions.items():
+            if state == 'loading':
+                continue
+            secs = np.array(secs)
+            reactions[state] = {'count': len(secs), 'mean': float(secs.mean()),
+                                'p50': float(np.percentile(secs, 50)), 'max': float(secs.max())}
+        return {
+            'battles': len(self.battles),
+            'seconds': elapsed,
+            'battles_per_hour': len(self.battles) * 3600 / elapsed if elapsed > 0 else 0.0,
+            'reactions': reactions,
+        }
+
+
+class Shell:
+    """
+    Runs the shell commands the bot sends against a `Game`.
+    """
+
+    def __init__(self, game: Game):
+        self.game = game
+        # the multi-touch state of `sendevent`
+        self.touch_pos = [0, 0]
+        self.touch_id = -1
+
+    def run(self, line: str) -> bytes:
+        """
+        Run a line of commands separated by ';', and return their output.
+        """
+        return b''.join(self.__run(cmd.strip()) for cmd in line.split(';') if cmd.strip())
+
+    def __run(self, cmd: str) -> bytes:
+        game = self.game
+        args = cmd.split()
+        sleep(game.latency('command'))
+        if args[0] == 'screencap':
+            sleep(game.latency('screencap'))
+            return game.screencap(raw='-p' not in args)
+        elif args[:2] == ['input', 'tap']:
+            sleep(game.latency('input'))
+            game.tap(int(args[2]), int(args[3]))
+        elif args[:2] == ['input', 'swipe']:
+            sleep(game.latency('input') + int(args[6]) / 1000)
+        elif args[0] == 'sendevent':
+            sleep(game.latency('sendevent'))
+            self.__sendevent(int(args[2]), int(args[3]), int(args[4]))
+        elif args[0] == 'sleep':
+            sleep(float(args[1]))
+        elif args[:2] == ['wm', 'size']:
+            # reported in the natural orientation of the device
+            return 'Physical size: {}x{}\n'.format(SCREEN_SIZE[1], SCREEN_SIZE[0]).encode('utf-8')
+        elif args[:2] == ['getevent', '-p']:
+            return GETEVENT.encode('utf-8')
+        else:
+            return '/system/bin/sh: {}: not found\n'.format(args[0]).encode('utf-8')
+        return b''
+
+    def __sendevent(self, type_: int, code: int, value: int):
+        if type_ == EV_ABS and code == ABS_MT_POSITION_X:
+            self.touch_pos[0] = value
+        elif type_ == EV_ABS and code == ABS_MT_POSITION_Y:
+            self.touch_pos[1] = value
+        elif type_ == EV_ABS and code == ABS_MT_TRACKING_ID:
+            if value == 0xffffffff and self.touch_id != -1:
+                self.touch_id = -2  # lifted, reported at the next SYN
+            else:
+                self.touch_id = value
+        elif type_ == EV_SYN and self.touch_id == -2:
+            self.touch_id = -1
+            self.game.tap(*self.touch_pos)
+
+
+class AdbHandler(socketserver.BaseRequestHandler):
+    """
+    Serves one connection of the adb server protocol.
+    """
+
+    def __recv(self, size: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = self.request.recv(size - len(buf))
+            if not chunk:
+                raise ConnectionError('closed')
+            buf += chunk
+        return bytes(buf)
+
+    def __reply(self, data: str):
+        payload = data.encode('utf-8')
+        self.request.sendall(b'OKAY' + '{:04x}'.format(len(payload)).encode('ascii') + payload)
+
+    def handle(self):
+        shell = Shell(self.server.game)
+        try:
+            while True:
+                request = self.__recv(int(self.__recv(4), 16)).decode('utf-8')
+                if request == 'host:version':
+                    return self.__reply('0029')
+                elif request.startswith('host:devices'):
+                    return self.__reply('{}\tdevice\n'.format(SERIAL))
+                elif request.startswith('host:connect:'):
+                    return self.__reply('already connected to {}'.format(request[len('host:connect:'):]))
+                elif request in ('host:transport-any', 'host:transport:' + SERIAL):
+                    self.request.sendall(b'OKAY')
+                elif request == 'exec:sh':
+                    self.request.sendall(b'OKAY')
+                    return self.__session(shell)
+                elif request.startswith(('exec:', 'shell:')):
+                    self.request.sendall(b'OKAY')
+                    self.request.sendall(shell.run(request.split(':', 1)[1]))
+                    return
+                else:
+                    message = 'unknown request {}'.format(request).encode('utf-8')
+                    self.request.sendall(b'FAIL' + '{:04x}'.format(len(message)).encode('ascii') + message)
+                    return
+        except (ConnectionError, OSError):
+            pass
+
+    def __session(self, shell: Shell):
+        buf = bytearray()
+        while True:
+            pos = buf.find(b'\n')
+            if pos == -1:
+                chunk = self.request.recv(65536)
+                if not chunk:
+                    return
+                buf += chunk
+                continue
+            line = buf[:pos].decode('utf-8')
+            del buf[:pos + 1]
+            m = SESSION_LINE.match(line)
+            if m is None:
+                self.request.sendall(shell.run(line))
+                continue
+            output = shell.run(m.group(1))
+            self.request.sendall(output + '\n{}0\n'.format(m.group(2)).encode('ascii'))
+
+
+class Server(socketserver.ThreadingTCPServer):
+    """
+    A fake adb server in front of a `Game`, on a background thread.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, game: Game, port: int = 0):
+        """
+
+        :param game: the simulated game.
+        :param port: the local port to listen on. If 0, any free port, see `port`.
+        """
+        super().__init__(('127.0.0.1', port), AdbHandler)
+        self.game = game
+        self.thread = threading.Thread(target=self.serve_forever, name='sim-adb', daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self.server_address[1]
+
+    def start(self) -> 'Server':
+        self.thread.start()
+        logger.info('Fake adb server listening on port {}.'.format(self.port))
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def default_templates(workdir: Path) -> Tuple[Dict[str, np.ndarray], Dict[str, Path]]:
+    """
+    Load the templates of `fgobot/images` and write a quest and a friend image to `workdir`.
+
+    :return: the templates by name, and the paths of the quest and friend images.
+    """
+    im_dir = Path(__file__).absolute().parent / 'images'
+    templates = {p.name[:-4]: cv.imread(str(p), cv.IMREAD_COLOR) for p in im_dir.glob('*.png')}
+    paths = {}
+    for n, (name, size) in enumerate([('quest', (400, 80)), ('friend', (160, 130))], 1):
+        templates[name] = texture(size, n)
+        paths[name] = workdir / '{}.png'.format(name)
+        cv.imwrite(str(paths[name]), templates[name])
+    return templates, paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a BattleBot against a simulated game.')
+    parser.add_argument('--battles', type=int, default=3, help='battles to play')
+    parser.add_argument('--speed', type=float, default=1, help='how many times faster than real the game runs')
+    parser.add_argument('--capture', choices=['png', 'raw'], default='raw', help='screenshot format')
+    parser.add_argument('--input', choices=['shell', 'sendevent'], default='shell', help='input backend')
+    parser.add_argument('--engine', choices=['full', 'pyramid'], default='full', help='matching engine')
+    parser.add_argument('--settle', action='store_true', help='wait for animations until the screen settles')
+    parser.add_argument('--background', type=Path, help='a 1280x720 screenshot to compose screens on')
+    parser.add_argument('--port', type=int, default=0, help='the port of the fake adb server')
+    parser.add_argument('--record', type=Path, help='record the session to a trace directory')
+    parser.add_argument('--replay', type=Path, help='replay a recorded trace instead of running the game')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+
+    from . import device
+    from .bot import BattleBot
+    from .input import SendeventInput, ShellInput
+    from .trace import TraceEnd, TraceRecorder, TraceReplayer
+
+    with tempfile.TemporaryDirectory() as workdir:
+        templates, paths = default_templates(Path(workdir))
+        background = cv.imread(str(args.background), cv.IMREAD_COLOR) if args.background else None
+        game = Game(templates, speed=args.speed, background=background)
+        server = Server(game, args.port).start() if args.replay is None else None
+        port = args.port if server is None else server.port
+        bot = BattleBot(quest=str(paths['quest']), friend=str(paths['friend']),
+                        port='127.0.0.1:{}'.format(port),
+                        capture_method=device.RAW_SHELL if args.capture == 'raw' else device.FROM_SHELL,
+                        match_engine=device.PYRAMID_MATCH if args.engine == 'pyramid' else device.FULL_MATCH,
+                        settle=args.settle, learn_timing=False, keep_history=False,
+                        input_backend=SendeventInput() if args.input == 'sendevent' else ShellInput(),
+                        adb_server=('127.0.0.1', port))
+        for stage in range(1, 4):
+            bot.at_stage(stage)(lambda: bot.attack([9, 9, 9]))
+        if args.replay is not None:
+            replayer = TraceReplayer(args.replay)
+            replayer.attach(bot.device)
+            start = monotonic()
+            try:
+                bot.run(args.battles)
+            except TraceEnd as e:
+                logger.warning('Replay stopped: {}'.format(e))
+            seconds = monotonic() - start
+            print(json.dumps({'battles': bot.count, 'seconds': seconds, 'frames': len(replayer),
+                              'recorded_seconds': replayer.now, 'speedup': replayer.now / seconds}, indent=2))
+            return
+
+        recorder = None
+        if args.record is not None:
+            bot.device.probe()
+            recorder = TraceRecorder(args.record)
+            recorder.attach(bot.device)
+        start = monotonic()
+        try:
+            bot.run(args.battles)
+        finally:
+            server.stop()
+            if recorder is not None:
+                recorder.close()
+        print(json.dumps(game.report(start), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+Timing spans on the hot paths, cheap enough to stay on in production.
+
+A span is a named kind of operation, such as a capture or a match, registered once
+and then referred to by its integer id. Timing an operation costs two reads of the
+monotonic clock and a few list updates under a lock, without allocating or formatting,
+either around a block or a whole method with `timed`::
+
+    CAPTURE = spans.register('capture')
+    ...
+    start = monotonic()
+    capture()
+    self.spans.since(CAPTURE, start)
+
+The samples of each span are kept in preallocated ring buffers until `reset`,
+e.g. at the end of each battle after taking the `report`.
+"""
+import functools
+import threading
+from bisect import bisect_left
+from time import monotonic
+from typing import Callable, Dict, List
+
+# the most spans that can be registered
+MAX_SPANS = 128
+# samples kept per span between two resets, older ones are overwritten
+CAPACITY = 2048
+# upper bounds in seconds of the buckets of the histograms, which are never reset
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+# the names of the spans, by id
+NAMES = []  # type: List[str]
+_ids = {}  # type: Dict[str, int]
+_lock = threading.Lock()
+
+
+def register(name: str) -> int:
+    """
+    Register a span, or look up a registered one.
+
+    :param name: the name of the span, such as 'adb.shell' or 'bot.stage.1'.
+    :return: the id of the span.
+    """
+    with _lock:
+        span = _ids.get(name)
+        if span is None:
+            if len(NAMES) >= MAX_SPANS:
+                raise ValueError('Too many spans, at most {} can be registered.'.format(MAX_SPANS))
+            span = _ids[name] = len(NAMES)
+            NAMES.append(name)
+        return span
+
+
+def timed(span: int) -> Callable:
+    """
+    Decorate a method of an object with a `spans` attribute, adding each call's duration to `span`.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            start = monotonic()
+            try:
+                return f(self, *args, **kwargs)
+            finally:
+                self.spans.since(span, start)
+        return wrapper
+    return decorator
+
+
+def phase(span: int) -> Callable:
+    """
+    Like `timed`, and make the span the current phase of the `spans` while the method runs.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(self, *args, **kwargs):
+            previous = self.spans.enter(span)
+            start = monotonic()
+            try:
+                return f(self, *args, **kwargs)
+            finally:
+                self.spans.since(span, start)
+                self.spans.enter(previous)
+        return wrapper
+    return decorator
+
+
+def percentile(samples: List[float], q: float) -> float:
+    """
+    Return the `q`-th percentile of sorted `samples`, by the nearest rank.
+    """
+    return samples[min(int(len(samples) * q / 100), len(samples) - 1)]
+
+
+class Spans:
+    """
+    Durations of the spans of one device, since the last `reset`.
+
+    :ivar count: the number of samples of each span since the last reset, by id.
+    :ivar total: their sum in seconds, by id.
+    :ivar max: the longest sample in seconds, by id.
+    :ivar lifetime_count: the number of samples since creation, by id.
+    :ivar lifetime_total: their sum in seconds, by id.
+    :ivar buckets: the number of samples since creation in each of `BUCKETS`, and above, by id.
+    :ivar phase: the id of the current phase, such as the stage being played, or None.
+    :ivar phase_since: the `time.monotonic()` the current phase was entered at.
+    """
+
+    def __init__(self, capacity: int = CAPACITY):
+        """
+
+        :param capacity: the samples kept per span for percentiles.
+        """
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.count = [0] * MAX_SPANS
+        self.total = [0.0] * MAX_SPANS
+        self.max = [0.0] * MAX_SPANS
+        # ring buffers of samples, allocated on the first sample of each span
+        self.samples = [None] * MAX_SPANS  # type: List[List[float]]
+        self.lifetime_count = [0] * MAX_SPANS
+        self.lifetime_total = [0.0] * MAX_SPANS
+        self.buckets = [None] * MAX_SPANS  # type: List[List[int]]
+        self.started = monotonic()
+        self.phase = None
+        self.phase_since = self.started
+
+    def add(self, span: int, sec: float):
+        """
+        Add a sample to a span.
+
+        :param span: the id of the span, see `register`.
+        :param sec: the duration in seconds.
+        """
+        with self.lock:
+            n = self.count[span]
+            samples = self.samples[span]
+            if samples is None:
+                samples = self.samples[span] = [0.0] * self.capacity
+                self.buckets[span] = [0] * (len(BUCKETS) + 1)
+            samples[n % self.capacity] = sec
+            self.count[span] = n + 1
+            self.total[span] += sec
+            if sec > self.max[span]:
+                self.max[span] = sec
+            self.lifetime_count[span] += 1
+            self.lifetime_total[span] += sec
+            self.buckets[span][bisect_left(BUCKETS, sec)] += 1
+
+    def enter(self, span: int = None) -> int:
+        """
+        Make a span the current phase.
+
+        :param span: the id of the span, or None for no phase.
+        :return: the previous phase.
+        """
+        previous = self.phase
+        if span != previous:
+            self.phase, self.phase_since = span, monotonic()
+        return previous
+
+    def since(self, span: int, start: float):
+        """
+        Add the seconds elapsed since `start`, a `time.monotonic()`, to a span.
+        """
+        self.add(span, monotonic() - start)
+
+    def reset(self):
+        """
+        Forget all samples, keeping the buffers. The lifetime counts and the histograms are kept.
+        """
+        with self.lock:
+            for span in range(MAX_SPANS):
+                self.count[span] = 0
+                self.total[span] = 0.0
+                self.max[span] = 0.0
+            self.started = monotonic()
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        """
+        Summarize the spans with samples since the last reset.
+
+        :return: the number of samples, total, p50, p95 and max seconds, by span name. \
+            The percentiles are of the last `capacity` samples.
+        """
+        with self.lock:
+            stats = [(span, self.count[span], self.total[span], self.max[span],
+                      self.samples[span][:min(self.count[span], self.capacity)])
+                     for span in range(len(NAMES)) if self.count[span]]
+        report = {}
+        for span, count, total, longest, samples in stats:
+            samples.sort()
+            report[NAMES[span]] = {
+                'count': count,
+                'total': total,
+                'p50': percentile(samples, 50),
+                'p95': percentile(samples, 95),
+                'max': longest,
+            }
+        return report
+
+    def histograms(self) -> Dict[str, tuple]:
+        """
+        Return the lifetime histograms of the spans with samples.
+
+        :return: the count, sum in seconds and cumulative counts of `BUCKETS`, by span name.
+        """
+        with self.lock:
+            stats = [(span, self.lifetime_count[span], self.lifetime_total[span], list(self.buckets[span]))
+                     for span in range(len(NAMES)) if self.lifetime_count[span]]
+        histograms = {}
+        for span, count, total, buckets in stats:
+            cumulative, n = [], 0
+            for value in buckets[:-1]:
+                n += value
+                cumulative.append(n)
+            histograms[NAMES[span]] = (count, total, cumulative)
+        return histograms
+
+
+def format_report(report: Dict[str, Dict[str, float]]) -> str:
+    """
+    Format a `Spans.report` as a table in milliseconds, the slowest spans in total first.
+    """
+    lines = ['{:<24}{:>7}{:>10}{:>9}{:>9}{:>9}'.format('span', 'count', 'total', 'p50', 'p95', 'max')]
+    for name, stat in sorted(report.items(), key=lambda item: -item[1]['total']):
+        lines.append('{:<24}{:>7d}{:>10.0f}{:>9.1f}{:>9.1f}{:>9.1f}'.format(
+            name, stat['count'], stat['total'] * 1000, stat['p50'] * 1000, stat['p95'] * 1000, stat['max'] * 1000))
+    return '\n'.join(lines)
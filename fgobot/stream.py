@@ -0,0 +1,216 @@
+"""
+Continuous and pipelined screen capture on background threads.
+"""
+import logging
+import socket
+import struct
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import monotonic, sleep
+from typing import Callable, Tuple, Union
+
+import cv2 as cv
+import numpy as np
+
+# a captured frame: increasing id, monotonic capture time and the image
+Frame = namedtuple('Frame', ['id', 'timestamp', 'image'])
+
+
+class FrameStream:
+    """
+    Pull frames from a source on a background thread and keep the latest one.
+
+    Frames are written to the back slot of a double buffer, then the slots are
+    swapped, so readers always get a complete frame without waiting for a capture.
+    """
+
+    def __init__(self, source: Callable[[], Union[np.ndarray, None]], interval: float = 0):
+        """
+
+        :param source: a callable returning the next screen image, or None if it failed.
+        :param interval: the minimum seconds between two captures.
+        """
+        self.logger = logging.getLogger('stream')
+        self.source = source
+        self.interval = interval
+        self.__slots = [None, None]
+        self.__front = 0
+        self.__cond = threading.Condition()
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        """
+        Start the capturing thread.
+        """
+        if self.__running:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__loop, name='frame-stream', daemon=True)
+        self.__thread.start()
+        self.logger.debug('Frame stream started.')
+
+    def stop(self):
+        """
+        Stop the capturing thread and wait for it to exit.
+        """
+        self.__running = False
+        with self.__cond:
+            self.__cond.notify_all()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+        self.logger.debug('Frame stream stopped.')
+
+    @property
+    def running(self) -> bool:
+        return self.__running
+
+    def __loop(self):
+        frame_id = 0
+        while self.__running:
+            start = monotonic()
+            try:
+                image = self.source()
+            except Exception as e:
+                self.logger.warning('Failed to pull frame: {}'.format(e))
+                image = None
+            if image is None:
+                sleep(max(self.interval, 0.1))
+                continue
+            frame_id += 1
+            back = 1 - self.__front
+            self.__slots[back] = Frame(frame_id, start, image)
+            with self.__cond:
+                self.__front = back
+                self.__cond.notify_all()
+            rest = self.interval - (monotonic() - start)
+            if rest > 0:
+                sleep(rest)
+
+    def latest(self, newer_than: int = 0, timeout: float = None) -> Union[Frame, None]:
+        """
+        Return the latest frame.
+
+        :param newer_than: only return a frame whose id is greater than this, waiting if needed.
+        :param timeout: the seconds to wait for such a frame.
+        :return: the frame, or None on timeout.
+        """
+        with self.__cond:
+            ok = self.__cond.wait_for(self.__has_newer(newer_than), timeout)
+            return self.__slots[self.__front] if ok else None
+
+    def __has_newer(self, newer_than: int) -> Callable[[], bool]:
+        def check():
+            frame = self.__slots[self.__front]
+            return not self.__running or (frame is not None and frame.id > newer_than)
+        return check
+
+
+class FramePipeline:
+    """
+    Capture frames in two stages, transfer and decode, each on its own thread.
+
+    While the caller matches frame N, frame N+1 is already being transferred or
+    decoded. At most `depth` frames are in flight besides the one returned
+    to the caller, so memory stays flat.
+    """
+
+    def __init__(self, fetch: Callable[[], bytes], decode: Callable[[bytes], np.ndarray], depth: int = 1):
+        """
+
+        :param fetch: a callable transferring the next encoded screenshot.
+        :param decode: a callable decoding a screenshot returned by `fetch`.
+        :param depth: the number of frames in flight besides the one returned.
+        """
+        self.fetch = fetch
+        self.decode = decode
+        self.depth = max(depth, 1)
+        self.__fetcher = ThreadPoolExecutor(1, thread_name_prefix='frame-fetch')
+        self.__decoder = ThreadPoolExecutor(1, thread_name_prefix='frame-decode')
+        self.__pending = deque()
+        self.__lock = threading.Lock()
+        self.__frame_id = 0
+
+    def __fetch(self) -> Tuple[float, bytes]:
+        start = monotonic()
+        return start, self.fetch()
+
+    def __decode(self, fetched: Future, result: Future):
+        try:
+            start, data = fetched.result()
+            image = self.decode(data)
+        except BaseException as e:
+            result.set_exception(e)
+            return
+        # frames are decoded in order on this single thread
+        self.__frame_id += 1
+        result.set_result(Frame(self.__frame_id, start, image))
+
+    def __prefetch(self) -> Future:
+        result = Future()
+        fetched = self.__fetcher.submit(self.__fetch)
+        fetched.add_done_callback(lambda f: self.__decoder.submit(self.__decode, f, result))
+        return result
+
+    def next_frame(self) -> Future:
+        """
+        Return the oldest frame in flight, and start capturing another one.
+
+        :return: a future of `Frame`.
+        """
+        with self.__lock:
+            if not self.__pending:
+                self.__pending.append(self.__prefetch())
+            frame = self.__pending.popleft()
+            while len(self.__pending) < self.depth:
+                self.__pending.append(self.__prefetch())
+        return frame
+
+    def stop(self):
+        """
+        Wait for the frames in flight and stop the threads.
+        """
+        with self.__lock:
+            self.__pending.clear()
+        self.__fetcher.shutdown(wait=True)
+        self.__decoder.shutdown(wait=True)
+
+
+class MinicapSource:
+    """
+    A frame source reading the JPEG stream of minicap.
+
+    The minicap socket on the device must be forwarded to a local port, e.g.
+    `adb forward tcp:1313 localabstract:minicap`.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 1313, timeout: int = 15):
+        """
+
+        :param host: the host of the forwarded minicap socket.
+        :param port: the port of the forwarded minicap socket.
+        :param timeout: the timeout of socket operations.
+        """
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        version, length = self.__recv(2)
+        self.banner = self.__recv(length - 2)
+        logging.getLogger('stream').debug('Minicap version {} connected.'.format(version))
+
+    def __recv(self, size: int) -> bytes:
+        buf = bytearray()
+        while len(buf) < size:
+            chunk = self.sock.recv(size - len(buf))
+            if not chunk:
+                raise ConnectionError('Minicap stream closed.')
+            buf += chunk
+        return bytes(buf)
+
+    def __call__(self) -> Union[np.ndarray, None]:
+        length, = struct.unpack('<I', self.__recv(4))
+        data = np.frombuffer(self.__recv(length), np.uint8)
+        return cv.imdecode(data, cv.IMREAD_COLOR)
+
+    def close(self):
+        self.sock.close()
@@ -0,0 +1,156 @@
+"""
+Per-device timing profile learned from observed latencies.
+"""
+import json
+import logging
+import os
+import re
+from collections import deque
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+
+from .bundle import cache_dir
+
+# samples needed before learned values replace the defaults
+MIN_SAMPLES = 5
+# samples kept per kind for percentiles
+WINDOW = 100
+# the factor the sleep shrinks by each time the result was already there when it ended
+SHRINK = 0.8
+
+logger = logging.getLogger('timing')
+
+
+class LatencyStat:
+    """
+    Exponentially weighted moving average and recent samples of a latency.
+    """
+
+    def __init__(self, alpha: float = 0.2, samples: list = (), ewma: float = None, overslept: int = 0):
+        """
+
+        :param alpha: the weight of a new sample in the moving average.
+        :param samples: recent samples, in seconds.
+        :param ewma: the moving average, in seconds.
+        :param overslept: the number of waits in a row whose result was already there when the sleep ended.
+        """
+        self.alpha = alpha
+        self.samples = deque(samples, maxlen=WINDOW)
+        self.ewma = ewma
+        self.overslept = overslept
+
+    def add(self, sec: float):
+        self.samples.append(sec)
+        self.ewma = sec if self.ewma is None else self.alpha * sec + (1 - self.alpha) * self.ewma
+
+    @property
+    def count(self) -> int:
+        return len(self.samples)
+
+    def percentile(self, q: float) -> float:
+        return float(np.percentile(self.samples, q))
+
+
+class TimingProfile:
+    """
+    Latencies observed on one device, by kind, such as 'enter' for loading a battle.
+
+    The bot sleeps through the part of a wait that is almost always dead time,
+    then polls the screen, so observed latencies stay close to the real ones.
+    If the result was already on the first screen after the sleep, the latency is
+    only known to be shorter than the sleep: such a wait is not a sample, and the
+    next sleep is shortened instead, until the result shows up while polling.
+    Profiles are saved as JSON under the cache directory, keyed by device.
+    """
+
+    def __init__(self, key: str, path: Path = None):
+        """
+
+        :param key: the device, e.g. its serial or connect address.
+        :param path: the file to save to. If not given, derived from `key`.
+        """
+        self.key = key
+        self.path = Path(path) if path else cache_dir() / 'timing' / '{}.json'.format(re.sub(r'[^\w.-]', '_', key))
+        self.stats = {}  # type: Dict[str, LatencyStat]
+
+    @classmethod
+    def load(cls, key: str, path: Path = None) -> 'TimingProfile':
+        """
+        Load the saved profile of a device, or start an empty one.
+        """
+        profile = cls(key, path)
+        try:
+            with open(profile.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return profile
+        for kind, stat in data.get('stats', {}).items():
+            profile.stats[kind] = LatencyStat(samples=stat['samples'], ewma=stat['ewma'],
+                                              overslept=stat.get('overslept', 0))
+        logger.info('Timing profile of {} loaded.'.format(key))
+        return profile
+
+    def save(self):
+        """
+        Save the profile. Failures are logged, not raised.
+        """
+        data = {
+            'key': self.key,
+            'stats': {kind: {'ewma': s.ewma, 'samples': list(s.samples), 'overslept': s.overslept}
+                      for kind, s in self.stats.items()},
+        }
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.warning('Failed to save timing profile: {}'.format(e))
+
+    def observe(self, kind: str, sec: float, overslept: bool = False):
+        """
+        Record a latency.
+
+        :param kind: the kind of wait.
+        :param sec: the seconds from the action to the expected screen.
+        :param overslept: whether the expected screen was already there when the sleep before \
+            polling ended, so the latency was at most `sec`.
+        """
+        if sec < 0:
+            return
+        stat = self.stats.setdefault(kind, LatencyStat())
+        if overslept:
+            stat.overslept += 1
+            logger.debug('{} latency under {:.2f}s, shortening the sleep.'.format(kind, sec))
+            return
+        stat.overslept = 0
+        stat.add(sec)
+        logger.debug('Observed {} latency {:.2f}s, average {:.2f}s'.format(kind, sec, stat.ewma))
+
+    def sleep(self, kind: str, default: float) -> float:
+        """
+        Return the seconds to sleep before polling for the expected screen:
+        a bit less than the shortest usual latency, shortened by `SHRINK` for each
+        wait in a row that slept past it.
+
+        :param default: the seconds to use until enough latencies are observed.
+        """
+        stat = self.stats.get(kind)
+        if stat is None:
+            return default
+        sec = default if stat.count < MIN_SAMPLES else min(0.8 * stat.percentile(10), 3 * default)
+        return sec * SHRINK ** stat.overslept
+
+    def timeout(self, kind: str, default: float) -> float:
+        """
+        Return the seconds after which the expected screen is unlikely to appear anymore.
+
+        :param default: the seconds to use until enough latencies are observed.
+        """
+        stat = self.stats.get(kind)
+        if stat is None or stat.count < MIN_SAMPLES:
+            return default
+        return min(max(1.5 * stat.percentile(95), default / 4), 3 * default)
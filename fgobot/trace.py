@@ -0,0 +1,270 @@
+"""
+Record the commands and screens of a `Device` session, and replay them.
+
+A trace is a directory of four files:
+
+- `meta.json`: the settings of the device, such as its screen size.
+- `events.jsonl`: one line per command or screen, in order, with its time.
+- `frames.bin`: the distinct screens, zlib-compressed. A screen is stored as \
+  the XOR with the previous distinct screen, except every `keyframe` screens, \
+  so a static background compresses to almost nothing.
+- `index.bin`: a fixed-size record per distinct screen, memory-mapped when replaying.
+
+Identical screens are stored once, by hash. Replaying feeds the recorded screens
+to `Device.update_screen` in order and answers commands from the trace, without
+a device and without sleeping, so a session replays faster than real time.
+"""
+import hashlib
+import json
+import logging
+import zlib
+from pathlib import Path
+from time import monotonic
+from typing import Iterator, List, Union
+
+import numpy as np
+
+from .stream import Frame
+
+INDEX_DTYPE = np.dtype([
+    ('offset', '<u8'),
+    ('size', '<u4'),
+    ('base', '<i4'),  # the distinct screen this one is XORed with, or -1
+    ('height', '<u2'),
+    ('width', '<u2'),
+    ('channels', '<u1'),
+])
+
+logger = logging.getLogger('trace')
+
+
+class TraceEnd(Exception):
+    """
+    Raised when a replayed session asks for more screens than were recorded.
+    """
+
+
+class TraceRecorder:
+    """
+    Record a device session to a trace directory, see `Device.recorder`.
+    """
+
+    def __init__(self, path: Path, keyframe: int = 30, level: int = 1):
+        """
+
+        :param path: the trace directory, created if needed.
+        :param keyframe: store every `keyframe`-th distinct screen whole.
+        :param level: the zlib compression level.
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.keyframe = keyframe
+        self.level = level
+        self.start = monotonic()
+        self.__events = open(self.path / 'events.jsonl', 'w')
+        self.__frames = open(self.path / 'frames.bin', 'wb')
+        self.__index = open(self.path / 'index.bin', 'wb')
+        self.__hashes = {}
+        self.__count = 0
+        self.__last = None  # the previous distinct screen
+        self.__offset = 0
+        self.device = None
+
+    def attach(self, device):
+        """
+        Start recording a `Device`.
+        """
+        meta = {
+            'screen_size': device.screen_size,
+            'zoom_switch': device.zoom_switch,
+            'zoom_factor': device.zoom_factor,
+            'method': device.method,
+            'serial': device.serial,
+        }
+        with open(self.path / 'meta.json', 'w') as f:
+            json.dump(meta, f)
+        device.recorder = self
+        self.device = device
+
+    def __event(self, event: dict):
+        self.__events.write(json.dumps(event) + '\n')
+
+    def command(self, cmd: List[str], timestamp: float, sec: float, output: Union[bytes, None]):
+        """
+        Record a command, see `Device.__run_cmd`.
+
+        :param cmd: the command.
+        :param timestamp: the `time.monotonic()` the command started at.
+        :param sec: the seconds it took.
+        :param output: its text output, or None for binary outputs such as screenshots, which are not recorded.
+        """
+        recorded = None if output is None else output.decode('utf-8', 'replace')
+        self.__event({'t': timestamp - self.start, 'kind': 'cmd', 'cmd': cmd, 'sec': sec, 'output': recorded})
+
+    def frame(self, screen: Union[np.ndarray, None], timestamp: float):
+        """
+        Record a screen, see `Device.set_screen`.
+
+        :param screen: the screen.
+        :param timestamp: the `time.monotonic()` it was captured at.
+        """
+        if screen is None:
+            self.__event({'t': timestamp - self.start, 'kind': 'frame', 'frame': -1})
+            return
+        screen = np.ascontiguousarray(screen)
+        digest = hashlib.blake2b(screen.data, digest_size=16).digest()
+        index = self.__hashes.get(digest)
+        if index is None:
+            index = self.__store(screen)
+            self.__hashes[digest] = index
+        self.__event({'t': timestamp - self.start, 'kind': 'frame', 'frame': index})
+
+    def __store(self, screen: np.ndarray) -> int:
+        index = self.__count
+        last = self.__last
+        if last is not None and last[1].shape == screen.shape and index % self.keyframe:
+            base, data = last[0], np.bitwise_xor(screen, last[1])
+        else:
+            base, data = -1, screen
+        blob = zlib.compress(data.tobytes(), self.level)
+        self.__frames.write(blob)
+        h, w = screen.shape[:2]
+        channels = screen.shape[2] if screen.ndim == 3 else 1
+        record = np.array([(self.__offset, len(blob), base, h, w, channels)], INDEX_DTYPE)
+        self.__index.write(record.tobytes())
+        self.__offset += len(blob)
+        self.__count += 1
+        self.__last = (index, screen.copy())
+        return index
+
+    def close(self):
+        """
+        Stop recording and flush the trace.
+        """
+        if self.device is not None and self.device.recorder is self:
+            self.device.recorder = None
+        for f in (self.__events, self.__frames, self.__index):
+            f.close()
+        logger.info('Trace of {} distinct screens, {} bytes, saved to {}.'.format(
+            self.__count, self.__offset, self.path))
+
+
+class TraceReplayer:
+    """
+    Replay a recorded session on a `Device`, see `Device.replay`.
+
+    The device gets the recorded screens in order, one per `update_screen`,
+    and the recorded output of the commands it runs. Nothing is sent to a device
+    and `Device.wait` and the waits on the screen do not sleep.
+    """
+
+    def __init__(self, path: Path):
+        """
+
+        :param path: the trace directory.
+        """
+        self.path = Path(path)
+        with open(self.path / 'meta.json') as f:
+            self.meta = json.load(f)
+        with open(self.path / 'events.jsonl') as f:
+            self.events = [json.loads(line) for line in f]
+        self.index = np.memmap(self.path / 'index.bin', INDEX_DTYPE, mode='r') \
+            if (self.path / 'index.bin').stat().st_size else np.zeros(0, INDEX_DTYPE)
+        self.data = np.memmap(self.path / 'frames.bin', np.uint8, mode='r') \
+            if (self.path / 'frames.bin').stat().st_size else np.zeros(0, np.uint8)
+        self.frame_events = [e for e in self.events if e['kind'] == 'frame']
+        self.command_events = [e for e in self.events if e['kind'] == 'cmd']
+        self.__frame_cursor = 0
+        self.__command_cursor = 0
+        self.__cache = (-1, None)
+        self.device = None
+        # `time.monotonic()` at the start of the replay, and the seconds replayed since
+        self.origin, self.now = monotonic(), 0.0
+
+    def __len__(self) -> int:
+        return len(self.frame_events)
+
+    def screen(self, index: int) -> np.ndarray:
+        """
+        Decode a distinct screen.
+
+        :param index: the index of the screen in the trace.
+        """
+        if index == self.__cache[0]:
+            return self.__cache[1]
+        record = self.index[index]
+        offset, size = int(record['offset']), int(record['size'])
+        shape = (int(record['height']), int(record['width']), int(record['channels']))
+        data = np.frombuffer(zlib.decompress(self.data[offset:offset + size]), np.uint8)
+        data = data.reshape(shape if shape[2] > 1 else shape[:2])
+        if record['base'] >= 0:
+            data = np.bitwise_xor(data, self.screen(int(record['base'])))
+        self.__cache = (index, data)
+        return data
+
+    def frames(self) -> Iterator[Frame]:
+        """
+        Iterate over the recorded screens, in order, timestamped in seconds from the start of the recording.
+        """
+        for n, event in enumerate(self.frame_events, 1):
+            yield Frame(n, event['t'], None if event['frame'] < 0 else self.screen(event['frame']))
+
+    def attach(self, device):
+        """
+        Replay on a `Device`: restore its recorded settings, and feed it from the trace.
+        """
+        device.stop_stream()
+        device.stop_pipeline()
+        device.probed = True
+        device.screen_size = tuple(self.meta['screen_size'])
+        device.zoom_switch = self.meta['zoom_switch']
+        device.zoom_factor = tuple(self.meta['zoom_factor'])
+        device.replay = self
+        self.device = device
+        self.__frame_cursor = self.__command_cursor = 0
+        self.origin, self.now = monotonic(), 0.0
+        device.input.setup(lambda cmd: self.command(['shell', cmd]).decode('utf-8').splitlines(),
+                           device.screen_size)
+
+    def detach(self):
+        """
+        Stop replaying.
+        """
+        if self.device is not None and self.device.replay is self:
+            self.device.replay = None
+
+    def clock(self) -> float:
+        """
+        The time of the session being replayed, i.e. `time.monotonic()` at the start
+        of the replay plus the recorded time of the last screen or command replayed.
+        """
+        return self.origin + self.now
+
+    def next_frame(self) -> Frame:
+        """
+        Return the next recorded screen.
+
+        :raise TraceEnd: if all screens have been replayed.
+        """
+        if self.__frame_cursor >= len(self.frame_events):
+            raise TraceEnd('All {} screens replayed.'.format(len(self.frame_events)))
+        event = self.frame_events[self.__frame_cursor]
+        self.__frame_cursor += 1
+        self.now = max(self.now, event['t'])
+        image = None if event['frame'] < 0 else self.screen(event['frame'])
+        return Frame(self.__frame_cursor, self.origin + event['t'], image)
+
+    def command(self, cmd: List[str]) -> bytes:
+        """
+        Return the recorded output of the next occurrence of a command.
+        A command that was not recorded gets no output, e.g. a tap at a random position
+        or after a change of decisions.
+        """
+        for n in range(self.__command_cursor, len(self.command_events)):
+            event = self.command_events[n]
+            if event['cmd'] == cmd:
+                self.__command_cursor = n + 1
+                self.now = max(self.now, event['t'])
+                return (event['output'] or '').encode('utf-8')
+        logger.debug('Command not in trace: {}'.format(' '.join(cmd)))
+        return b''
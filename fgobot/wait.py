@@ -0,0 +1,164 @@
+"""
+Screen change and motion detection, and adaptive polling schedule for waiting on the screen.
+"""
+from time import monotonic
+from typing import Callable, Union
+
+import cv2 as cv
+import numpy as np
+
+# size of the thumbnails compared to tell whether the screen changed, each pixel averages 8x8 pixels of the screen
+THUMBNAIL_SIZE = (160, 90)
+# difference of any thumbnail pixel above which the screen counts as changed
+CHANGE_THRESHOLD = 4
+
+
+def thumbnail(screen: np.ndarray) -> np.ndarray:
+    """
+    Return a downsampled grayscale version of the screen, cheap to compare.
+    """
+    gray = cv.cvtColor(screen, cv.COLOR_BGR2GRAY)
+    return cv.resize(gray, THUMBNAIL_SIZE, interpolation=cv.INTER_AREA)
+
+
+class ChangeDetector:
+    """
+    Tell whether a screen differs from the last screen that counted as changed.
+
+    Screens are compared on downsampled grayscale thumbnails. Any block of 8x8 pixels
+    whose mean brightness moved by more than `threshold` counts as a change,
+    so a small button appearing is still detected. The baseline only moves on a change,
+    so a slow fade or scroll is detected once its steps add up to the threshold.
+    """
+
+    def __init__(self, threshold: float = CHANGE_THRESHOLD):
+        self.threshold = threshold
+        self.last = None
+
+    def update(self, screen: Union[np.ndarray, None]) -> bool:
+        """
+        Compare `screen` with the baseline, and make it the baseline if it changed.
+
+        :return: whether the screen changed. The first screen always counts as changed.
+        """
+        if screen is None:
+            self.last = None
+            return True
+        thumb = thumbnail(screen)
+        if self.last is not None and int(cv.absdiff(thumb, self.last).max()) <= self.threshold:
+            return False
+        self.last = thumb
+        return True
+
+
+class SettleDetector:
+    """
+    Tell whether the screen has settled, e.g. an animation or a loading has finished.
+
+    The motion energy of a frame is the mean absolute difference of its thumbnail
+    from the previous frame's. The screen has settled once the energy stayed below
+    `threshold` for `quiet` seconds.
+    """
+
+    def __init__(self, quiet: float = 2, threshold: float = 1):
+        """
+
+        :param quiet: the seconds without motion for the screen to count as settled.
+        :param threshold: the motion energy, in gray levels, below which a frame counts as still.
+        """
+        self.quiet = quiet
+        self.threshold = threshold
+        self.last = None
+        # the timestamp since which every frame has been still
+        self.still_since = None
+        self.energy = 0.0
+
+    def update(self, screen: np.ndarray, timestamp: float) -> bool:
+        """
+        Add a frame to the window.
+
+        :param screen: the frame.
+        :param timestamp: the `time.monotonic()` the frame was captured at.
+        :return: whether the screen has settled.
+        """
+        thumb = thumbnail(screen)
+        last, self.last = self.last, thumb
+        if last is None:
+            self.still_since = timestamp
+            return False
+        self.energy = float(cv.absdiff(thumb, last).mean())
+        if self.energy >= self.threshold:
+            self.still_since = timestamp
+            return False
+        return timestamp - self.still_since >= self.quiet
+
+
+def count_deadline(count: Union[int, None], sec: float, now: float, deadline: float = None) -> Union[float, None]:
+    """
+    Turn a limit on the number of captures into a deadline.
+
+    Waits used to capture once every `sec` seconds, so `count` captures took about
+    `count * sec` seconds. Polling adaptively, the same number of polls can take
+    a fraction of that, so the limit is kept as time instead.
+
+    :param count: the max number of captures, or None for no limit.
+    :param sec: the seconds between two captures.
+    :param now: the current time, on the clock of `deadline`.
+    :param deadline: an earlier deadline to keep, if any.
+    :return: the earlier of the two deadlines, or None if neither is given.
+    """
+    if count is None:
+        return deadline
+    limit = now + count * sec
+    return limit if deadline is None else min(deadline, limit)
+
+
+class Poller:
+    """
+    Decide how long to sleep between two polls of the screen.
+    The caller sleeps, e.g. `Device` skipping the sleeps of a replayed trace.
+
+    Polls tightly at first, e.g. right after a tap when the screen is about to change,
+    and backs off up to `max_interval` while the screen stays the same.
+    A change on the screen brings the interval back to `min_interval`.
+    """
+
+    def __init__(self, min_interval: float = 0.05,
+                 max_interval: float = 1,
+                 backoff: float = 2,
+                 deadline: float = None,
+                 clock: Callable[[], float] = monotonic,
+                 ):
+        """
+
+        :param min_interval: the seconds to sleep after a change.
+        :param max_interval: the longest seconds to sleep.
+        :param backoff: the factor the interval grows by while nothing changes.
+        :param deadline: the `time.monotonic()` after which to stop polling. If not given, poll forever.
+        :param clock: the clock of `deadline`, e.g. `Device.clock` to follow the time of a replayed trace.
+        """
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.deadline = deadline
+        self.clock = clock
+        self.interval = self.min_interval
+
+    def next_interval(self, changed: bool = True) -> Union[float, None]:
+        """
+        Return the seconds to sleep until the next poll, without sleeping.
+
+        :param changed: whether the screen of the poll that just happened changed, see `ChangeDetector`.
+        :return: the seconds, or None if the deadline has passed.
+        """
+        if changed:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+        sec = self.interval
+        if self.deadline is not None:
+            rest = self.deadline - self.clock()
+            if rest <= 0:
+                return None
+            sec = min(sec, rest)
+        return sec
@@ -11,7 +11,6 @@ setup(
     install_requires=[
         'opencv-python',
         'numpy',
-        'matplotlib'
     ],
 
     author='willC',
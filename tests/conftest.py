@@ -0,0 +1,17 @@
+import pytest
+
+from fgobot import sim
+
+
+@pytest.fixture
+def game(tmp_path):
+    templates, _ = sim.default_templates(tmp_path)
+    # fast enough that the latencies of the simulated device do not slow the tests down
+    return sim.Game(templates, speed=100)
+
+
+@pytest.fixture
+def server(game):
+    server = sim.Server(game).start()
+    yield server
+    server.stop()
@@ -0,0 +1,115 @@
+import struct
+
+import pytest
+
+from fgobot import sim
+from fgobot.adb import AdbClient, AdbError, ShellSession, new_marker, pop_output, shell_line
+
+
+@pytest.fixture
+def client(server):
+    client = AdbClient(host='127.0.0.1', port=server.port, timeout=5)
+    yield client
+    client.close()
+
+
+def test_host_query(client):
+    assert client.host('host:devices') == '{}\tdevice\n'.format(sim.SERIAL)
+
+
+def test_transport_to_serial(server):
+    client = AdbClient(serial=sim.SERIAL, host='127.0.0.1', port=server.port, timeout=5)
+    assert client.exec_once('wm size') == b'Physical size: 720x1280\n'
+
+
+def test_transport_to_unknown_serial_fails(server):
+    client = AdbClient(serial='emulator-5556', host='127.0.0.1', port=server.port, timeout=5)
+    with pytest.raises(AdbError, match='host:transport:emulator-5556: unknown request'):
+        client.open('exec:sh')
+
+
+def test_unknown_service_fails(client):
+    with pytest.raises(AdbError, match='unknown request'):
+        client.open('framebuffer:')
+
+
+def test_host_error_reply(client):
+    with pytest.raises(AdbError, match='host:features: unknown request host:features'):
+        client.host('host:features')
+
+
+def test_session_frames_consecutive_commands(client):
+    session = ShellSession(client)
+    try:
+        assert session.run('wm size') == b'Physical size: 720x1280\n'
+        assert session.run('input tap 1 1') == b''
+        assert session.run('foo') == b'/system/bin/sh: foo: not found\n'
+        assert session.run('wm size; foo') == b'Physical size: 720x1280\n/system/bin/sh: foo: not found\n'
+        assert session.buf == b''
+    finally:
+        session.close()
+
+
+def test_session_output_spanning_several_reads(client):
+    session = ShellSession(client)
+    try:
+        for _ in range(2):
+            data = session.run('screencap')
+            w, h, _ = struct.unpack('<3I', data[:12])
+            assert (w, h) == sim.SCREEN_SIZE
+            # far more than one recv of 64 KiB
+            assert len(data) == 16 + w * h * 4
+    finally:
+        session.close()
+
+
+def test_exec_reuses_session_per_thread(client):
+    assert client.exec('wm size') == b'Physical size: 720x1280\n'
+    session = client.local.session
+    assert client.exec('wm size') == b'Physical size: 720x1280\n'
+    assert client.local.session is session
+    assert client.sessions == {session}
+
+
+def test_exec_reopens_broken_session(client):
+    client.exec('wm size')
+    broken = client.local.session
+    broken.sock.close()
+    assert client.exec('wm size') == b'Physical size: 720x1280\n'
+    assert client.local.session is not broken
+    assert client.sessions == {client.local.session}
+
+
+def test_exec_multiline_runs_once(client):
+    # a newline would end the line written to the session early
+    assert client.exec('wm size\n') == b'Physical size: 720x1280\n'
+    assert getattr(client.local, 'session', None) is None
+
+
+def test_pop_output_waits_for_complete_marker_line():
+    marker = new_marker()
+    data = b'abc\n' + b'\n' + marker + b'0\n' + b'next'
+    buf, start = bytearray(), 0
+    # fed one byte at a time, the output only comes out once the marker line is complete
+    for n, byte in enumerate(data[:-len(b'next')]):
+        buf.append(byte)
+        output, start = pop_output(buf, marker, start)
+        assert (output is None) == (n < len(data) - len(b'next') - 1)
+    assert output == b'abc\n'
+    assert buf == b''
+
+
+def test_pop_output_keeps_following_output():
+    marker = new_marker()
+    buf = bytearray(b'one\n' + marker + b'0\ntwo\n' + marker + b'1\n')
+    assert pop_output(buf, marker) == (b'one', 0)
+    assert pop_output(buf, marker) == (b'two', 0)
+    assert buf == b''
+
+
+def test_shell_line_is_understood_by_the_simulator():
+    marker = new_marker()
+    line = shell_line('wm size', marker).decode('utf-8')
+    assert line.endswith('\n')
+    m = sim.SESSION_LINE.match(line[:-1])
+    assert m is not None and m.group(1) == 'wm size' and m.group(2) == marker.decode('ascii')
@@ -0,0 +1,77 @@
+import asyncio
+from time import monotonic
+
+import numpy as np
+import pytest
+
+from fgobot import device, sim
+from fgobot.aio import AsyncDevice
+
+
+@pytest.fixture
+def async_device(tmp_path, game, server):
+    _, paths = sim.default_templates(tmp_path)
+    dev = AsyncDevice(port='127.0.0.1:{}'.format(server.port), adb_server=('127.0.0.1', server.port),
+                      capture_method=device.RAW_SHELL)
+    dev.device.load_image(paths['quest'])
+    yield dev
+    dev.device.adb.close()
+
+
+def run(dev: AsyncDevice, coro):
+    """
+    Run `coro` on a new event loop, closing the streams of `dev` on that loop when done.
+    """
+    async def main():
+        try:
+            return await coro
+        finally:
+            dev.close()
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize('method', [device.FROM_SHELL, device.RAW_SHELL], ids=['png', 'raw'])
+def test_update_screen_captures_the_game(game, async_device, method):
+    async_device.device.method = method
+    run(async_device, async_device.update_screen())
+    assert np.array_equal(async_device.screen, game.screen())
+    assert async_device.spans.count[device.SPAN_CAPTURE] == 1
+
+
+def test_update_screen_resizes_once(async_device):
+    async def capture():
+        await async_device.probe()
+        async_device.device.zoom_switch = True
+        await async_device.update_screen()
+
+    run(async_device, capture())
+    assert async_device.screen.shape == (720, 1280, 3)
+    assert async_device.spans.count[device.SPAN_RESIZE] == 1
+
+
+def test_wait_match(async_device):
+    match = run(async_device, async_device.wait_match('quest', sec=0.05, countLimit=10))
+    assert match is not None and match.name == 'quest'
+    assert match.loc == sim.POSITIONS['quest']
+    assert match.value >= async_device.device.threshold
+
+
+def test_wait_match_times_out(async_device):
+    start = monotonic()
+    assert run(async_device, async_device.wait_match('attack', sec=0.05, countLimit=4)) is None
+    # the budget of the count limit, whatever the polling
+    assert 0.2 <= monotonic() - start < 1.5
+
+
+def test_wait_any_returns_the_screen_that_appears(game, async_device):
+    async def enter_quest():
+        match = await async_device.wait_match('quest', sec=0.05, countLimit=10)
+        assert await async_device.tap_match(match)
+        return await async_device.wait_any({'start_quest': None, 'friend_pick': None, 'quest': None},
+                                           sec=0.05, countLimit=20)
+
+    # the quest is gone as soon as the tap leaves the terminal
+    match = run(async_device, enter_quest())
+    assert match is not None and match.name == 'friend_pick'
+    assert match.loc == sim.POSITIONS['friend_pick']
+    assert game.state == 'quest_confirm'
@@ -0,0 +1,33 @@
+import pytest
+
+from fgobot import bot, device, sim
+from fgobot.bot import BattleBot
+
+
+@pytest.fixture
+def fast_bot(tmp_path, monkeypatch, game, server):
+    """
+    A bot learning its timing on the simulated game, with the waits made short to match its speed.
+    """
+    monkeypatch.setenv('FGOBOT_CACHE', str(tmp_path / 'cache'))
+    for name, sec in [('INTERVAL_LONG', 0.3), ('INTERVAL_MID', 0.2), ('INTERVAL_SHORT', 0.05), ('INTERVAL_TAP', 0.01)]:
+        monkeypatch.setattr(bot, name, sec)
+    _, paths = sim.default_templates(tmp_path)
+    battle_bot = BattleBot(quest=str(paths['quest']), friend=str(paths['friend']),
+                           port='127.0.0.1:{}'.format(server.port), capture_method=device.RAW_SHELL,
+                           learn_timing=True, keep_history=False, adb_server=('127.0.0.1', server.port))
+    for stage in range(1, 4):
+        battle_bot.at_stage(stage)(lambda: battle_bot.attack([9, 9, 9]))
+    yield battle_bot
+    battle_bot.device.adb.close()
+
+
+def test_latencies_are_learned_by_kind(fast_bot):
+    assert fast_bot.run(2) == 2
+    stats = fast_bot.timing.stats
+    assert {'quest', 'continue', 'enter', 'attack', 'close'} <= set(stats)
+    # the support list after tapping the quest, once, and after continuing the first battle, once.
+    # The quest sleeps before polling, and the list may already be there when it ends
+    assert stats['quest'].count + stats['quest'].overslept == 1
+    assert stats['continue'].count == 1
+    assert 'mid' not in stats
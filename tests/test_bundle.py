@@ -0,0 +1,92 @@
+import json
+import os
+import struct
+import time
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from fgobot import bundle
+
+
+@pytest.fixture
+def paths(tmp_path, monkeypatch):
+    monkeypatch.setenv('FGOBOT_CACHE', str(tmp_path / 'cache'))
+    rng = np.random.default_rng(0)
+    paths = {}
+    for name in ('attack', 'close'):
+        paths[name] = tmp_path / '{}.png'.format(name)
+        cv.imwrite(str(paths[name]), rng.integers(0, 256, (60, 80, 3), dtype=np.uint8))
+    return paths
+
+
+def header(**fields) -> bytes:
+    data = json.dumps(fields).encode('utf-8')
+    return bundle.MAGIC + struct.pack('<Q', len(data)) + data
+
+
+def test_load_or_build_round_trip(paths):
+    built = bundle.load_or_build(paths)
+    loaded = bundle.load(paths, bundle.bundle_path(paths))
+    assert loaded is not None
+    for name, p in paths.items():
+        assert np.array_equal(loaded.images[name], cv.imread(str(p), cv.IMREAD_COLOR))
+        assert len(loaded.pyramids[name]) == len(built.pyramids[name])
+
+
+@pytest.mark.parametrize('content', [
+    b'',
+    bundle.MAGIC,
+    bundle.MAGIC + struct.pack('<Q', 100) + b'{"version"',
+    header(),
+    header(version=bundle.VERSION),
+    header(version=bundle.VERSION, max_levels=None, min_side=None, sources=[]),
+    bundle.MAGIC + struct.pack('<Q', 2) + b'[]',
+], ids=['empty', 'magic', 'truncated', 'no_fields', 'some_fields', 'wrong_types', 'not_an_object'])
+def test_bad_header_is_rebuilt(paths, content):
+    path = bundle.bundle_path(paths)
+    path.parent.mkdir(parents=True)
+    path.write_bytes(content)
+    assert bundle.load(paths, path) is None
+    assert bundle.load_or_build(paths) is not None
+    assert bundle.load(paths, path) is not None
+
+
+def test_truncated_pixels_are_rebuilt(paths):
+    path = bundle.bundle_path(paths)
+    bundle.load_or_build(paths)
+    path.write_bytes(path.read_bytes()[:-4096])
+    assert bundle.load(paths, path) is None
+    assert bundle.load_or_build(paths) is not None
+
+
+def test_build_prunes_stale_bundles(paths, tmp_path):
+    cache = bundle.cache_dir()
+    cache.mkdir(parents=True)
+    old = time.time() - bundle.MAX_AGE - 60
+    stale = cache / 'templates-{}.bundle'.format('0' * 16)
+    recent = cache / 'templates-{}.bundle'.format('1' * 16)
+    # left by a build that was interrupted
+    leftover = cache / 'templates-{}.bundleabc.tmp'.format('2' * 16)
+    other = cache / 'history.sqlite'
+    for p in (stale, recent, leftover, other):
+        p.write_bytes(b'')
+    for p in (stale, leftover, other):
+        os.utime(p, (old, old))
+
+    path = bundle.bundle_path(paths)
+    bundle.load_or_build(paths)
+    assert path.exists() and recent.exists() and other.exists()
+    assert not stale.exists() and not leftover.exists()
+
+
+def test_load_marks_the_bundle_used(paths):
+    path = bundle.bundle_path(paths)
+    bundle.load_or_build(paths)
+    old = time.time() - bundle.MAX_AGE - 60
+    os.utime(path, (old, old))
+    bundle.load_or_build(paths)
+    assert path.stat().st_mtime > old + 60
+    bundle.prune()
+    assert path.exists()
@@ -0,0 +1,125 @@
+import re
+import urllib.error
+import urllib.request
+
+import pytest
+
+from fgobot import device, exporter, spans
+
+SAMPLE = re.compile(r'^([a-z_]+)\{(.*)\} (\S+)$')
+LABEL = re.compile(r'([a-z_]+)="((?:[^"\\]|\\.)*)"')
+
+
+@pytest.fixture
+def served():
+    server = exporter.MetricsExporter(port=0).start()
+    yield server
+    server.stop()
+
+
+def scrape(server: exporter.MetricsExporter, path: str = '/metrics') -> str:
+    with urllib.request.urlopen('http://127.0.0.1:{}{}'.format(server.port, path), timeout=5) as response:
+        assert response.headers['Content-Type'] == exporter.CONTENT_TYPE
+        return response.read().decode('utf-8')
+
+
+def parse(text: str) -> dict:
+    """
+    Parse the text exposition format, checking that every sample belongs to a metric
+    declared with its HELP and TYPE before it.
+
+    :return: the values by metric name and labels.
+    """
+    assert text.endswith('\n')
+    helps, types, samples = set(), {}, {}
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            helps.add(line.split()[2])
+        elif line.startswith('# TYPE '):
+            _, _, name, kind = line.split()
+            assert name in helps and kind in ('counter', 'gauge', 'histogram')
+            types[name] = kind
+        else:
+            match = SAMPLE.match(line)
+            assert match, line
+            name, labels, value = match.groups()
+            family = re.sub(r'_(bucket|sum|count)$', '', name) if name.startswith('fgobot_span_seconds') else name
+            assert family in types, line
+            assert LABEL.sub('', labels).replace(',', '') == ''
+            samples[name, tuple(LABEL.findall(labels))] = float(value)
+    return samples
+
+
+def value(samples: dict, name: str, **labels) -> float:
+    return samples[name, tuple(labels.items())]
+
+
+def test_exposition_format(served):
+    source = spans.Spans()
+    served.add(source, {'device': '127.0.0.1:5555', 'script': 'say "hi"\\'})
+    decode, match = spans.register('decode'), spans.register('match')
+    for sec in (0.02, 0.03, 0.2):
+        source.add(decode, sec)
+    source.add(match, 0.004)
+    source.enter(spans.register('bot.battle'))
+
+    samples = parse(scrape(served))
+    labels = {'device': '127.0.0.1:5555', 'script': 'say \\"hi\\"\\\\'}
+    assert value(samples, 'fgobot_captures_total', **labels) == 3
+    assert value(samples, 'fgobot_matches_total', **labels) == 1
+    assert value(samples, 'fgobot_battles_total', **labels) == 0
+    assert value(samples, 'fgobot_phase', **labels, phase='bot.battle') == 1
+    assert value(samples, 'fgobot_phase_seconds', **labels) >= 0
+
+    buckets = [value(samples, 'fgobot_span_seconds_bucket', **labels, span='decode', le=repr(float(b)))
+               for b in spans.BUCKETS]
+    assert buckets == sorted(buckets)
+    assert buckets[spans.BUCKETS.index(0.025)] == 1 and buckets[-1] == 3
+    assert value(samples, 'fgobot_span_seconds_bucket', **labels, span='decode', le='+Inf') == 3
+    assert value(samples, 'fgobot_span_seconds_count', **labels, span='decode') == 3
+    assert value(samples, 'fgobot_span_seconds_sum', **labels, span='decode') == pytest.approx(0.25)
+
+
+def test_counters_are_monotonic_across_reset(served):
+    source = spans.Spans()
+    served.add(source, {'device': 'a'})
+    decode = spans.register('decode')
+    source.add(decode, 0.01)
+    source.add(decode, 0.01)
+    before = parse(scrape(served))
+    # the bot resets its spans after each battle
+    source.reset()
+    after = parse(scrape(served))
+    assert value(after, 'fgobot_captures_total', device='a') == value(before, 'fgobot_captures_total', device='a') == 2
+    assert value(after, 'fgobot_span_seconds_count', device='a', span='decode') == 2
+    source.add(decode, 0.01)
+    assert value(parse(scrape(served)), 'fgobot_captures_total', device='a') == 3
+
+
+def test_screen_unchanged_and_removed_sources(served):
+    dev = device.Device(adb_server=None)
+    first, second = spans.Spans(), spans.Spans()
+    served.add(first, {'device': 'a'}, dev).add(second, {'device': 'b'})
+    samples = parse(scrape(served))
+    assert value(samples, 'fgobot_screen_unchanged_seconds', device='a') >= 0
+    assert ('fgobot_screen_unchanged_seconds', (('device', 'b'),)) not in samples
+    served.remove(first)
+    samples = parse(scrape(served))
+    assert ('fgobot_captures_total', (('device', 'a'),)) not in samples
+    assert value(samples, 'fgobot_captures_total', device='b') == 0
+
+
+def test_other_paths_are_not_found(served):
+    assert 'fgobot_captures_total' in scrape(served, '/')
+    with pytest.raises(urllib.error.HTTPError) as error:
+        scrape(served, '/other')
+    assert error.value.code == 404
+
+
+def test_serve_starts_one_exporter_per_port():
+    server = exporter.serve(0)
+    try:
+        assert exporter.serve(0) is server
+    finally:
+        server.stop()
+        exporter._exporters.pop(0)
@@ -0,0 +1,71 @@
+import logging
+
+import pytest
+
+from fgobot import farm
+from fgobot.farm import FarmResult
+
+
+class StubBot:
+    """
+    Stands in for a `BattleBot`: `run` completes `count` battles, then returns or raises
+    as the bot of the serial is told to.
+    """
+
+    def __init__(self, count: int, outcome):
+        self.count = 0
+        self.completed = count
+        self.outcome = outcome
+
+    def run(self, max_loops: int) -> int:
+        self.count = min(self.completed, max_loops)
+        if isinstance(self.outcome, Exception):
+            raise self.outcome
+        return self.outcome
+
+
+# by serial, the battles the bot completes and what its `run` does then
+OUTCOMES = {
+    'ok': (3, 3),
+    'interrupted': (5, -1),
+    'failed': (2, RuntimeError('device lost')),
+}
+
+
+def setup(serial: str) -> StubBot:
+    if serial == 'broken':
+        raise OSError('no such device')
+    return StubBot(*OUTCOMES[serial])
+
+
+@pytest.mark.parametrize('serial, status, battles', [
+    ('ok', 'ok', 3),
+    ('interrupted', 'interrupted', 5),
+    ('failed', 'failed', 2),
+    ('broken', 'failed', 0),
+])
+def test_run_bot(serial, status, battles):
+    result = farm.run_bot(setup, serial, 10)
+    assert (result.serial, result.status, result.battles) == (serial, status, battles)
+    assert result.seconds >= 0
+    assert (result.error is None) == (status != 'failed')
+
+
+def test_summarize():
+    summary = farm.summarize([
+        FarmResult('a', 'ok', 3, 1800.0, None),
+        FarmResult('b', 'interrupted', 5, 3600.0, None),
+        FarmResult('c', 'failed', 0, 10.0, 'OSError()'),
+    ])
+    assert summary == {'devices': 3, 'failed': 1, 'battles': 8, 'battles_per_hour': 8.0}
+
+
+def test_summarize_nothing():
+    assert farm.summarize([]) == {'devices': 0, 'failed': 0, 'battles': 0, 'battles_per_hour': 0.0}
+
+
+def test_run_farm_keeps_the_order_of_serials():
+    serials = ['interrupted', 'broken', 'ok']
+    results = farm.run_farm(setup, serials, max_loops=4, workers=2, log_level=logging.CRITICAL)
+    assert [(r.serial, r.status, r.battles) for r in results] == [
+        ('interrupted', 'interrupted', 4), ('broken', 'failed', 0), ('ok', 'ok', 3)]
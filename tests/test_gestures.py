@@ -0,0 +1,156 @@
+from time import monotonic
+
+import pytest
+
+from fgobot import device, sim
+from fgobot.bot import INTERVAL_SHORT, INTERVAL_TAP, BattleBot
+from fgobot.stream import Frame
+
+# a device of 1920x1080, whose taps are scaled from 1280x720
+ZOOM = 1.5
+
+
+class Script:
+    """
+    Stands in for a device through `Device.replay`: keeps the commands sent, and shows
+    the first of `screens`, then the next one after each command.
+    """
+
+    def __init__(self, dev: device.Device, *screens):
+        self.screens = list(screens)
+        self.commands = []
+        dev.probed = True
+        dev.zoom_switch, dev.zoom_factor = True, (ZOOM, ZOOM)
+        dev.replay = self
+
+    def next_frame(self) -> Frame:
+        return Frame(0, monotonic(), self.screens[0])
+
+    def command(self, cmd):
+        self.commands.append(cmd)
+        if len(self.screens) > 1:
+            self.screens.pop(0)
+        return b''
+
+    def clock(self) -> float:
+        return monotonic()
+
+    @property
+    def shell(self):
+        return [cmd[1] for cmd in self.commands if cmd[0] == 'shell']
+
+
+def scaled(x, y) -> str:
+    return 'input tap {:d} {:d}'.format(int(x * ZOOM), int(y * ZOOM))
+
+
+@pytest.fixture(scope='module')
+def sim_files(tmp_path_factory):
+    templates, paths = sim.default_templates(tmp_path_factory.mktemp('sim'))
+    game = sim.Game(templates)
+    screens = {}
+    for state in ('battle', 'cards'):
+        game.state = state
+        screens[state] = game.screen()
+    return screens, paths
+
+
+@pytest.fixture
+def bot(sim_files):
+    screens, paths = sim_files
+    bot = BattleBot(quest=str(paths['quest']), friend=str(paths['friend']), adb_server=None)
+    bot.script = Script(bot.device, screens['battle'])
+    return bot
+
+
+def test_perform_sends_one_command(bot):
+    dev = bot.device
+    gestures = device.Gestures().tap(100, 200).wait(0.5).swipe((10, 20), (30, 40), 300).wait(0).tap(5, 6)
+    assert len(gestures) == 4
+    assert dev.perform(gestures)
+    assert bot.script.commands == [['shell', '; '.join([
+        scaled(100, 200), 'sleep 0.500', 'input swipe 15 30 45 60 300', scaled(5, 6)])]]
+
+
+def test_perform_nothing(bot):
+    assert bot.device.perform(device.Gestures())
+    assert bot.script.commands == []
+
+
+def test_use_skill(bot):
+    bot.use_skill(2, 3, reinforceOrNot=True)
+    b = bot.buttons
+    x = b['skill']['x'] + b['servant_distance'] + b['skill_distance'] * 2
+    assert bot.script.shell[0] == '; '.join([
+        scaled(x, b['skill']['y']), 'sleep {:.3f}'.format(INTERVAL_SHORT),
+        scaled(*b['skill_reinforce']['yes']), 'sleep {:.3f}'.format(INTERVAL_SHORT / 2)])
+    # then the tap speeding up the animation, on its own
+    assert bot.script.shell[1] == scaled(590, 230)
+
+
+def test_use_master_skill(bot):
+    bot.use_master_skill(2)
+    b = bot.buttons
+    assert bot.script.shell[0] == '; '.join([
+        scaled(b['master_skill_menu']['x'], b['master_skill_menu']['y']), 'sleep {:.3f}'.format(INTERVAL_SHORT),
+        scaled(b['master_skill']['x'] + b['master_skill_distance'], b['master_skill']['y']),
+        'sleep {:.3f}'.format(INTERVAL_SHORT)])
+
+
+def test_use_spell(bot):
+    bot.use_spell(3)
+    b = bot.buttons
+    steps = []
+    for im in ['spell', 'spell_np', 'spell_decide']:
+        steps += [scaled(*b[im].values()), 'sleep {:.3f}'.format(INTERVAL_SHORT / 2)]
+    steps += [scaled(b['choose_object']['x'] + b['choose_object_distance'] * 2, b['choose_object']['y']),
+              scaled(590, 230)]
+    assert bot.script.shell == ['; '.join(steps)]
+
+
+def card_taps(cmd: str):
+    """
+    Return the taps of a batch, unscaled, and the sleeps between them.
+    """
+    taps, sleeps = [], []
+    for step in cmd.split('; '):
+        words = step.split()
+        if words[0] == 'input':
+            taps.append((int(words[2]) / ZOOM, int(words[3]) / ZOOM))
+        else:
+            sleeps.append(float(words[1]))
+    return taps, sleeps
+
+
+def in_button(pos, button: dict, dx: int = 0) -> bool:
+    x, y = pos
+    # scaling truncates the coordinates
+    return button['x'] + dx - 1 <= x < button['x'] + dx + button['w'] and button['y'] - 1 <= y < button['y'] + button['h']
+
+
+def test_attack_old(bot):
+    bot.attack_old([2, 7, 1])
+    b = bot.buttons
+    assert len(bot.script.shell) == 1
+    assert bot.script.shell[0].startswith(scaled(b['attack']['x'], b['attack']['y']) + '; ')
+    taps, sleeps = card_taps(bot.script.shell[0])
+    assert in_button(taps[1], b['card'], b['normal_card_distance'])
+    assert in_button(taps[2], b['noble_card'], b['noble_card_distance'])
+    assert in_button(taps[3], b['card'])
+    assert sleeps == [INTERVAL_SHORT * 2] + [INTERVAL_SHORT] * 3
+
+
+def test_attack_taps_the_cards_in_one_batch(bot, sim_files):
+    screens, _ = sim_files
+    # the cards show once the attack button is tapped
+    bot.script.screens.append(screens['cards'])
+    bot.attack([6, 9, 9], enemy=1)
+    b = bot.buttons
+    # the enemy and the attack button, then the three cards chosen on one screen
+    assert bot.script.shell[0] == '; '.join([scaled(*b['enemy'].values()), scaled(b['attack']['x'], b['attack']['y'])])
+    taps, sleeps = card_taps(bot.script.shell[1])
+    assert in_button(taps[0], b['noble_card'])
+    # random cards are the leftmost unselected ones
+    assert in_button(taps[1], b['card'])
+    assert in_button(taps[2], b['card'], b['normal_card_distance'])
+    assert sleeps == [INTERVAL_TAP] * 3
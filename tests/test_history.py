@@ -0,0 +1,127 @@
+import sqlite3
+from time import time
+
+import pytest
+
+from fgobot.history import RunHistory, format_table
+
+DAY = 86400
+
+
+def report(battle: float, attack: float) -> dict:
+    return {
+        'bot.battle': {'count': 1, 'total': battle, 'p50': battle, 'p95': battle, 'max': battle},
+        'bot.attack': {'count': 3, 'total': attack, 'p50': attack / 3, 'p95': attack / 2, 'max': attack / 2},
+    }
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = RunHistory(tmp_path / 'history.sqlite')
+    yield history
+    history.close()
+
+
+def test_round_trip(history, tmp_path):
+    now = time()
+    history.start_run('127.0.0.1:5555', 'qp', 'quest')
+    history.add_battle(1, now - 300, 120, 3, report(120, 30), {'refreshes': 2, 'apple': 1})
+    history.add_battle(2, now - 180, 100, 3, report(100, 24), {'refreshes': 1, 'apple': 0})
+    # failed to detect the stage in the third battle
+    history.add_battle(3, now - 80, 40, 1, report(40, 9), {'stage_failures': 1}, status='interrupted')
+    history.end_run('interrupted')
+    assert history.run_id is None
+
+    # read back by another connection, as the command line does
+    other = RunHistory(tmp_path / 'history.sqlite')
+    [summary] = other.summary()
+    assert (summary['device'], summary['script'], summary['quest']) == ('127.0.0.1:5555', 'qp', 'quest')
+    assert (summary['runs'], summary['battles'], summary['interrupted']) == (1, 2, 1)
+    # the means are of the finished battles only
+    assert summary['seconds_per_battle'] == pytest.approx(110)
+    assert summary['rounds_per_battle'] == pytest.approx(3)
+    assert summary['hours'] > 0 and summary['battles_per_hour'] > 0
+
+    [trend] = other.trend()
+    assert trend['battles'] == 2 and trend['seconds_per_battle'] == pytest.approx(110)
+
+    phases = other.phases()
+    assert [p['span'] for p in phases] == ['bot.battle', 'bot.attack']
+    assert phases[0]['battles'] == 3 and phases[0]['max'] == 120
+    assert phases[1]['count_per_battle'] == 3
+
+    counters = {c['name']: c for c in other.counters()}
+    # counters of 0 are not stored
+    assert {name: c['total'] for name, c in counters.items()} == {'apple': 1, 'refreshes': 3, 'stage_failures': 1}
+    assert counters['refreshes']['per_battle'] == pytest.approx(1.5)
+    other.close()
+
+
+def test_filters(history):
+    for device in ('a', 'b'):
+        history.start_run(device, 'qp', 'quest')
+        history.add_battle(1, time(), 60, 3, {}, {})
+        history.end_run('ok')
+    assert [s['device'] for s in history.summary()] == ['a', 'b']
+    assert [s['device'] for s in history.summary(device='b')] == ['b']
+    assert history.summary(script='other') == []
+    assert history.trend(days=1)[0]['battles'] == 2
+
+
+def test_regressions(history):
+    now = time()
+    # battles of 'slow' took 60 seconds a week ago and 90 in the last days
+    history.start_run('slow', 'qp', 'quest')
+    for n, (started, seconds) in enumerate([(now - 7 * DAY, 60), (now - 6 * DAY, 60),
+                                            (now - DAY, 90), (now - 3600, 90)], 1):
+        history.add_battle(n, started, seconds, 3, {}, {})
+    # interrupted battles are short or long by chance, and not counted
+    history.add_battle(5, now - 60, 500, 2, {}, {}, status='interrupted')
+    history.end_run('ok')
+    # battles of 'steady' within the tolerance
+    history.start_run('steady', 'qp', 'quest')
+    history.add_battle(1, now - 7 * DAY, 60, 3, {}, {})
+    history.add_battle(2, now - DAY, 66, 3, {}, {})
+    history.end_run('ok')
+    # battles of 'new' only in the last days, with nothing to compare with
+    history.start_run('new', 'qp', 'quest')
+    history.add_battle(1, now - DAY, 200, 3, {}, {})
+    history.end_run('ok')
+    # battles of 'old' before the baseline days
+    history.start_run('old', 'qp', 'quest')
+    history.add_battle(1, now - 60 * DAY, 10, 3, {}, {})
+    history.add_battle(2, now - DAY, 60, 3, {}, {})
+    history.end_run('ok')
+
+    [regression] = history.regressions(recent=3, days=30)
+    assert regression['device'] == 'slow'
+    assert (regression['before'], regression['recent']) == (60, 90)
+    assert regression['recent_battles'] == 2
+    assert regression['ratio'] == pytest.approx(1.5)
+    assert [r['device'] for r in history.regressions(tolerance=1.05)] == ['slow', 'steady']
+    assert history.regressions(tolerance=2) == []
+
+
+def test_opens_databases_without_battle_status(tmp_path):
+    path = tmp_path / 'history.sqlite'
+    db = sqlite3.connect(str(path))
+    db.executescript('''
+        CREATE TABLE runs (id INTEGER PRIMARY KEY, device TEXT NOT NULL, script TEXT NOT NULL,
+                           quest TEXT NOT NULL, started REAL NOT NULL, ended REAL, status TEXT);
+        CREATE TABLE battles (id INTEGER PRIMARY KEY, run_id INTEGER NOT NULL, number INTEGER NOT NULL,
+                              started REAL NOT NULL, seconds REAL NOT NULL, rounds INTEGER NOT NULL);
+        INSERT INTO runs VALUES (1, 'a', 'qp', 'quest', 0, 3600, 'ok');
+        INSERT INTO battles VALUES (1, 1, 1, 0, 120, 3);''')
+    db.commit()
+    db.close()
+    history = RunHistory(path)
+    [summary] = history.summary()
+    assert (summary['battles'], summary['interrupted'], summary['battles_per_hour']) == (1, 0, 1)
+    history.close()
+
+
+def test_format_table():
+    assert format_table([]) == '(no data)'
+    lines = format_table([{'device': 'a', 'battles': 12, 'ratio': 1.5, 'before': None}]).splitlines()
+    assert lines[0].split() == ['device', 'battles', 'ratio', 'before']
+    assert lines[1].split() == ['a', '12', '1.50', '-']
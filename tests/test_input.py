@@ -0,0 +1,212 @@
+from time import monotonic, sleep
+
+import pytest
+
+from fgobot import device, sim
+from fgobot.input import (ABS_MT_POSITION_X, ABS_MT_POSITION_Y, ABS_MT_PRESSURE, ABS_MT_TOUCH_MAJOR,
+                          ABS_MT_TRACKING_ID, BTN_TOUCH, EV_ABS, EV_KEY, EV_SYN, SENDEVENT_COST, SWIPE_STEP,
+                          SYN_REPORT, SendeventInput, ShellInput, parse_getevent)
+
+# `getevent -p` of a phone: a key device, then a portrait touch panel of 1080x2400
+PHONE = '''add device 1: /dev/input/event1
+  name:     "gpio-keys"
+  events:
+    KEY (0001): 0072  0073  0074
+  input props:
+    <none>
+add device 2: /dev/input/event3
+  name:     "fts_ts"
+  events:
+    KEY (0001): 014a
+    ABS (0003): 002f  : value 0, min 0, max 9, fuzz 0, flat 0, resolution 0
+                0030  : value 0, min 0, max 255, fuzz 0, flat 0, resolution 0
+                0035  : value 0, min 0, max 1079, fuzz 0, flat 0, resolution 0
+                0036  : value 0, min 0, max 2399, fuzz 0, flat 0, resolution 0
+                0039  : value 0, min 0, max 65535, fuzz 0, flat 0, resolution 0
+                003a  : value 0, min 0, max 255, fuzz 0, flat 0, resolution 0
+  input props:
+    INPUT_PROP_DIRECT
+'''
+
+# `getevent -p` of an emulator: a landscape panel whose axes span 0-32767, without BTN_TOUCH
+EMULATOR = '''add device 1: /dev/input/event4
+  name:     "virtio_input_multi_touch_7"
+  events:
+    ABS (0003): 0035  : value 0, min 0, max 32767, fuzz 0, flat 0, resolution 0
+                0036  : value 0, min 0, max 32767, fuzz 0, flat 0, resolution 0
+                0039  : value 0, min 0, max 10, fuzz 0, flat 0, resolution 0
+  input props:
+    INPUT_PROP_DIRECT
+'''
+
+UP = 0xffffffff
+
+
+class FakeAdb:
+    """
+    Stands in for the shell of a device: answers `getevent -p`, and records the other commands.
+    """
+
+    def __init__(self, getevent: str):
+        self.getevent = getevent
+        self.commands = []
+
+    def __call__(self, cmd: str):
+        if cmd == 'getevent -p':
+            return self.getevent.splitlines()
+        self.commands.append(cmd)
+        return []
+
+
+def events(cmd: str, path: str):
+    """
+    Parse a line of `sendevent` and `sleep` commands into (type, code, value) and ('sleep', seconds).
+    """
+    result = []
+    for part in cmd.split('; '):
+        args = part.split()
+        if args[0] == 'sleep':
+            result.append(('sleep', float(args[1])))
+        else:
+            assert args[:2] == ['sendevent', path]
+            result.append(tuple(int(a) for a in args[2:]))
+    return result
+
+
+def setup(getevent: str, screen_size, **kwargs) -> SendeventInput:
+    backend = SendeventInput(**kwargs)
+    backend.setup(FakeAdb(getevent), screen_size)
+    return backend
+
+
+def test_parse_getevent():
+    keys, touch = parse_getevent(PHONE.splitlines())
+    assert (keys.path, keys.name, keys.multi_touch) == ('/dev/input/event1', 'gpio-keys', False)
+    assert keys.keys == {0x72, 0x73, 0x74}
+    assert (touch.path, touch.name, touch.multi_touch) == ('/dev/input/event3', 'fts_ts', True)
+    assert touch.keys == {BTN_TOUCH}
+    assert touch.axes[ABS_MT_POSITION_X] == (0, 1079)
+    assert touch.axes[ABS_MT_POSITION_Y] == (0, 2399)
+    assert touch.axes[ABS_MT_TRACKING_ID] == (0, 65535)
+    assert touch.props == {'INPUT_PROP_DIRECT'}
+
+
+def test_tap_on_portrait_panel():
+    backend = setup(PHONE, (2400, 1080))
+    # the panel is portrait, the game landscape
+    assert backend.rotation == 1
+    assert events(backend.tap(100, 200), '/dev/input/event3') == [
+        (EV_ABS, ABS_MT_TRACKING_ID, 1),
+        (EV_ABS, ABS_MT_TOUCH_MAJOR, 127),
+        (EV_ABS, ABS_MT_PRESSURE, 127),
+        (EV_ABS, ABS_MT_POSITION_X, 1079 - 200),
+        (EV_ABS, ABS_MT_POSITION_Y, 100),
+        (EV_KEY, BTN_TOUCH, 1),
+        (EV_SYN, SYN_REPORT, 0),
+        (EV_ABS, ABS_MT_TRACKING_ID, UP),
+        (EV_KEY, BTN_TOUCH, 0),
+        (EV_SYN, SYN_REPORT, 0),
+    ]
+
+
+def test_tap_on_emulator_scales_to_axes():
+    backend = setup(EMULATOR, (1280, 720))
+    assert backend.rotation == 0
+    # corners map to the ends of the axes, and no BTN_TOUCH without the key
+    assert events(backend.tap(0, 0), '/dev/input/event4') == [
+        (EV_ABS, ABS_MT_TRACKING_ID, 1),
+        (EV_ABS, ABS_MT_POSITION_X, 0),
+        (EV_ABS, ABS_MT_POSITION_Y, 0),
+        (EV_SYN, SYN_REPORT, 0),
+        (EV_ABS, ABS_MT_TRACKING_ID, UP),
+        (EV_SYN, SYN_REPORT, 0),
+    ]
+    assert backend.to_axes(1279, 719) == (32767, 32767)
+    assert backend.to_axes(640, 360) == (round(640 * 32767 / 1279), round(360 * 32767 / 719))
+
+
+@pytest.mark.parametrize('rotation, pos, expected', [
+    (0, (10, 20), (10, 20)),
+    (1, (10, 20), (719 - 20, 10)),
+    (2, (10, 20), (1279 - 10, 719 - 20)),
+    (3, (10, 20), (20, 1279 - 10)),
+])
+def test_rotations(rotation, pos, expected):
+    # a panel of one axis unit per pixel in every orientation
+    getevent = EMULATOR.replace('max 32767', 'max 1279')
+    backend = setup(getevent, (1280, 720), rotation=rotation)
+    touch = backend.touch
+    if rotation % 2:
+        touch.axes[ABS_MT_POSITION_X] = touch.axes[ABS_MT_POSITION_X]._replace(max=719)
+    else:
+        touch.axes[ABS_MT_POSITION_Y] = touch.axes[ABS_MT_POSITION_Y]._replace(max=719)
+    assert backend.to_axes(*pos) == expected
+
+
+def test_tracking_ids_increase():
+    backend = setup(PHONE, (2400, 1080))
+    ids = [events(backend.tap(1, 1), '/dev/input/event3')[0][2] for _ in range(3)]
+    assert ids == [1, 2, 3]
+    backend.tracking_id = 0xffff
+    assert events(backend.tap(1, 1), '/dev/input/event3')[0] == (EV_ABS, ABS_MT_TRACKING_ID, 0)
+
+
+def test_swipe():
+    backend = setup(EMULATOR.replace('max 32767', 'max 1279', 1).replace('max 32767', 'max 719'), (1280, 720))
+    duration = 100
+    sent = events(backend.swipe(100, 600, 500, 200, duration), '/dev/input/event4')
+    down, up = sent[:4], sent[-2:]
+    assert down == [(EV_ABS, ABS_MT_TRACKING_ID, 1), (EV_ABS, ABS_MT_POSITION_X, 100),
+                    (EV_ABS, ABS_MT_POSITION_Y, 600), (EV_SYN, SYN_REPORT, 0)]
+    assert up == [(EV_ABS, ABS_MT_TRACKING_ID, UP), (EV_SYN, SYN_REPORT, 0)]
+    moves = sent[4:-2]
+    steps = int(duration / 1000 / SWIPE_STEP)
+    assert len(moves) == steps * 4
+    positions = []
+    for n in range(steps):
+        sleep_, x, y, syn = moves[n * 4:n * 4 + 4]
+        assert sleep_[0] == 'sleep'
+        assert x[:2] == (EV_ABS, ABS_MT_POSITION_X) and y[:2] == (EV_ABS, ABS_MT_POSITION_Y)
+        assert syn == (EV_SYN, SYN_REPORT, 0)
+        positions.append((x[2], y[2]))
+    # the sleeps and the estimated cost of the sendevent of the moves add up to the duration
+    sleeps = sum(m[1] for m in moves[::4])
+    assert sleeps + steps * 3 * SENDEVENT_COST == pytest.approx(duration / 1000, abs=0.01)
+    assert positions[-1] == (500, 200)
+    assert all(a[0] < b[0] and a[1] > b[1] for a, b in zip(positions, positions[1:]))
+
+
+@pytest.mark.parametrize('duration, moves, sleeps', [(1000, 33, 33), (30, 1, 1), (10, 1, 0)])
+def test_swipe_processes(duration, moves, sleeps):
+    backend = setup(EMULATOR, (1280, 720))
+    parts = backend.swipe(100, 600, 500, 200, duration).split('; ')
+    # the down, the moves and the up
+    assert sum(p.startswith('sendevent') for p in parts) == 4 + 3 * moves + 2
+    pauses = [float(p.split()[1]) for p in parts if p.startswith('sleep')]
+    assert len(pauses) == sleeps and all(p > 0 for p in pauses)
+
+
+def test_device_path():
+    backend = setup(PHONE, (2400, 1080), device_path='/dev/input/event3')
+    assert backend.touch.name == 'fts_ts'
+    with pytest.raises(RuntimeError, match='at /dev/input/event1'):
+        setup(PHONE, (2400, 1080), device_path='/dev/input/event1')
+    with pytest.raises(RuntimeError, match='No multi-touch input device found'):
+        setup(PHONE.split('add device 2')[0], (2400, 1080))
+
+
+def test_shell_input():
+    assert ShellInput().tap(1, 2) == 'input tap 1 2'
+    assert ShellInput().swipe(1, 2, 3, 4, 500) == 'input swipe 1 2 3 4 500'
+
+
+def test_sendevent_taps_the_simulated_game(game, server):
+    dev = device.Device(port='127.0.0.1:{}'.format(server.port), adb_server=('127.0.0.1', server.port),
+                        input_backend=SendeventInput())
+    x, y = sim.POSITIONS['quest']
+    assert dev.tap(x + 10, y + 10)
+    deadline = monotonic() + 5
+    while game.state == 'terminal' and monotonic() < deadline:
+        sleep(0.01)
+    assert game.state != 'terminal'
+    dev.adb.close()
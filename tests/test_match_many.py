@@ -0,0 +1,53 @@
+import pytest
+
+from fgobot import device, sim
+from fgobot.bot import BattleBot
+
+
+@pytest.fixture(scope='module')
+def composed(tmp_path_factory):
+    """
+    The screens of the simulated game by state, those of a battle by stage, and the quest and friend images.
+    """
+    templates, paths = sim.default_templates(tmp_path_factory.mktemp('sim'))
+    game = sim.Game(templates)
+    screens, battles = {}, {}
+    for state in sim.SCREENS:
+        game.state, game.stage = state, 2
+        screens[state] = game.screen()
+    for stage in range(1, 4):
+        game.state, game.stage = 'battle', stage
+        battles[stage] = game.screen()
+    return screens, battles, paths
+
+
+@pytest.mark.parametrize('engine', [device.FULL_MATCH, device.PYRAMID_MATCH], ids=['full', 'pyramid'])
+@pytest.mark.parametrize('state', ['battle', 'support', 'continue'])
+def test_match_many_equals_match(composed, engine, state):
+    screens, _, paths = composed
+    many = device.Device(adb_server=None, match_engine=engine)
+    one = device.Device(adb_server=None, match_engine=engine)
+    for dev in (many, one):
+        dev.load_images(paths)
+        dev.set_screen(screens[state], 0)
+    # the templates the bot matches at once: stage counters, support and end of battle screens
+    names = ['1_3', '2_3', '3_3', 'attack', 'friend', 'view_friend_party', 'close', 'continue_battle', 'unknown']
+    results = many.match_many(names)
+    assert list(results) == names
+    for name in names[:-1]:
+        value, loc = one.match(name)
+        assert results[name].name == name
+        assert results[name].loc == loc
+        assert results[name].value == pytest.approx(value, abs=1e-6)
+    assert (results['unknown'].value, results['unknown'].loc) == (0, (-1, -1))
+
+
+@pytest.mark.parametrize('engine', [device.FULL_MATCH, device.PYRAMID_MATCH], ids=['full', 'pyramid'])
+def test_bot_detects_the_stage(composed, engine):
+    _, battles, paths = composed
+    bot = BattleBot(quest=str(paths['quest']), friend=str(paths['friend']), match_engine=engine, adb_server=None)
+    for stage, screen in battles.items():
+        bot.device.set_screen(screen, 0)
+        # private methods of the bot are called as in a battle
+        assert bot._BattleBot__get_current_stage() == stage
+    assert bot.counters['stage_failures'] == 0
@@ -0,0 +1,70 @@
+from pathlib import Path
+
+import cv2 as cv
+import numpy as np
+import pytest
+
+from fgobot import matching
+
+ROOT = Path(__file__).absolute().parent.parent
+PNGS = sorted(ROOT.glob('*.png')) + sorted((ROOT / 'fgobot' / 'images').glob('*.png'))
+SCREENS = [p for p in PNGS if cv.imread(str(p), cv.IMREAD_UNCHANGED).shape[:2] == (720, 1280)]
+TEMPLATES = [p for p in PNGS if p not in SCREENS]
+
+# the value from which the full engine counts as finding the template
+FOUND = 0.85
+# how far the value of the pyramid engine may be from the full engine's
+TOLERANCE = 0.02
+
+
+@pytest.fixture(scope='module', params=SCREENS, ids=lambda p: p.name)
+def screen(request):
+    img = cv.imread(str(request.param), cv.IMREAD_COLOR)
+    return img, matching.build_pyramid(img, matching.MAX_LEVELS)
+
+
+@pytest.mark.parametrize('path', TEMPLATES, ids=lambda p: p.relative_to(ROOT).as_posix())
+def test_pyramid_matches_full_resolution(screen, path):
+    """
+    Where the full engine finds a template, on the screen as is or with the template pasted on it,
+    the pyramid engine finds it at the same location with about the same value.
+    """
+    img, pyramid = screen
+    template = cv.imread(str(path), cv.IMREAD_COLOR)
+    th, tw = template.shape[:2]
+    if th >= img.shape[0] or tw >= img.shape[1]:
+        pytest.skip('template larger than the screen')
+    # the same position on every run
+    rng = np.random.default_rng(sum(path.name.encode()))
+    x, y = int(rng.integers(0, img.shape[1] - tw)), int(rng.integers(0, img.shape[0] - th))
+    pasted = img.copy()
+    pasted[y:y + th, x:x + tw] = template
+
+    templates = matching.build_pyramid(template, matching.pyramid_levels(template))
+    for name, screen_img, screen_pyramid in [('screen', img, pyramid),
+                                             ('pasted', pasted, matching.build_pyramid(pasted, matching.MAX_LEVELS))]:
+        expected = matching.full_match(screen_img, template)
+        if expected[0] < FOUND:
+            continue
+        actual = matching.pyramid_match(screen_pyramid, templates)
+        assert actual[1] == expected[1], '{}: full {} / pyramid {}'.format(name, expected, actual)
+        assert actual[0] == pytest.approx(expected[0], abs=TOLERANCE), '{}: full {} / pyramid {}'.format(
+            name, expected, actual)
+
+
+def test_pasted_templates_are_found():
+    # the parity test above only means something if the full engine finds the pasted templates
+    img = cv.imread(str(SCREENS[0]), cv.IMREAD_COLOR)
+    template = cv.imread(str(TEMPLATES[0]), cv.IMREAD_COLOR)
+    th, tw = template.shape[:2]
+    pasted = img.copy()
+    pasted[100:100 + th, 200:200 + tw] = template
+    assert matching.full_match(pasted, template) == (pytest.approx(1, abs=1e-4), (200, 100))
+
+
+def test_pyramid_levels_respect_limits():
+    for side in (1, 23, 24, 47, 48, 95, 96, 400):
+        levels = matching.pyramid_levels(np.zeros((side, 1000, 3), np.uint8))
+        assert 0 <= levels <= matching.MAX_LEVELS
+        assert levels == 0 or side >> levels >= matching.MIN_TEMPLATE_SIDE
+        assert levels == matching.MAX_LEVELS or side >> (levels + 1) < matching.MIN_TEMPLATE_SIDE
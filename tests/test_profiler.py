@@ -0,0 +1,58 @@
+import threading
+from time import monotonic
+
+from fgobot import spans
+from fgobot.profiler import SamplingProfiler
+
+PHASE = spans.register('test.profiled')
+
+
+def spin(seconds: float):
+    end = monotonic() + seconds
+    while monotonic() < end:
+        pass
+
+
+def spin_in_bot(source: spans.Spans, started: threading.Event, stop: threading.Event):
+    source.enter(PHASE)
+    started.set()
+    while not stop.is_set():
+        spin(0.01)
+
+
+def profile(thread: bool) -> dict:
+    """
+    Profile a bot spinning in its phase in a thread, while the main thread spins outside it.
+
+    :param thread: whether to sample the bot's thread only.
+    :return: the collapsed stacks.
+    """
+    source = spans.Spans()
+    started, stop = threading.Event(), threading.Event()
+    bot = threading.Thread(target=spin_in_bot, args=(source, started, stop), name='bot')
+    bot.start()
+    started.wait()
+    try:
+        profiler = SamplingProfiler(source, interval=0.005, thread=bot.ident if thread else None).start()
+        spin(0.3)
+        profiler.stop()
+    finally:
+        stop.set()
+        bot.join()
+    return profiler.collapse()
+
+
+def test_samples_only_the_bot_thread():
+    stacks = profile(thread=True)
+    assert sum(stacks.values()) > 10
+    for stack in stacks:
+        phase, thread, *frames = stack.split(';')
+        assert (phase, thread) == ('test.profiled', 'bot')
+        # never the main thread spinning in `profile`
+        assert 'test_profiler:spin_in_bot' in frames and 'test_profiler:profile' not in frames
+
+
+def test_samples_all_threads():
+    threads = {stack.split(';')[1] for stack in profile(thread=False)}
+    assert {'bot', 'MainThread'} <= threads
+    assert 'profiler' not in threads
@@ -0,0 +1,75 @@
+import json
+from pathlib import Path
+
+import cv2 as cv
+import pytest
+
+from fgobot import device, sim
+
+ROOT = Path(__file__).absolute().parent.parent
+with open(ROOT / 'fgobot' / 'config' / 'rois.json') as f:
+    ROIS = {name: roi for name, roi in json.load(f).items() if name != 'margin'}
+# screenshots of the game, on which the full engine finds some of the templates
+SCREENSHOTS = [ROOT / 'how_to_run.png']
+# the value from which the full engine counts as finding the template
+FOUND = 0.85
+
+
+@pytest.fixture(scope='module')
+def screens(tmp_path_factory):
+    """
+    The composed screens of the simulator showing each template, and the screenshots, by template name.
+    """
+    templates, _ = sim.default_templates(tmp_path_factory.mktemp('sim'))
+    game = sim.Game(templates, background=cv.imread(str(ROOT / 'how_to_run.png'), cv.IMREAD_COLOR))
+    screenshots = [cv.imread(str(p), cv.IMREAD_COLOR) for p in SCREENSHOTS]
+    screens = {name: list(screenshots) for name in ROIS}
+    for state, (names, _) in sim.SCREENS.items():
+        for stage in range(1, 4):
+            game.state, game.stage = state, stage
+            for name in names:
+                name = name.format(stage=stage)
+                if name in screens:
+                    screens[name].append(game.screen())
+    return screens
+
+
+@pytest.fixture(scope='module')
+def devices():
+    """
+    A device matching inside the regions, and one matching the whole screen.
+    """
+    unbounded = device.Device(adb_server=None)
+    unbounded.rois = {}
+    return device.Device(adb_server=None), unbounded
+
+
+@pytest.mark.parametrize('name', sorted(ROIS))
+def test_roi_fits_template(name, devices):
+    bounded, _ = devices
+    x, y, w, h = bounded.rois[name]
+    th, tw = bounded.images[name].shape[:2]
+    assert 0 <= x and 0 <= y and x + w <= 1280 and y + h <= 720
+    assert tw <= w and th <= h
+
+
+@pytest.mark.parametrize('name', sorted(ROIS))
+def test_roi_contains_template(name, screens, devices):
+    """
+    Wherever the template is found on the whole screen, it is found at the same place
+    with the same value inside its region.
+    """
+    bounded, unbounded = devices
+    found = 0
+    for screen in screens[name]:
+        unbounded.set_screen(screen, 0)
+        value, loc = unbounded.match(name)
+        if value < FOUND:
+            continue
+        found += 1
+        bounded.set_screen(screen, 0)
+        bounded_value, bounded_loc = bounded.match(name)
+        assert bounded_loc == loc
+        assert bounded_value == pytest.approx(value, abs=1e-4)
+    if not found:
+        pytest.skip('no screen shows {}'.format(name))
@@ -0,0 +1,89 @@
+import pytest
+
+from fgobot import spans
+
+SPAN = spans.register('test.spans')
+PHASE = spans.register('test.phase')
+
+
+def test_register_is_idempotent():
+    assert spans.register('test.spans') == SPAN
+    assert spans.NAMES[SPAN] == 'test.spans'
+
+
+def test_percentile_is_nearest_rank():
+    samples = list(range(1, 101))
+    assert spans.percentile(samples, 50) == 51
+    assert spans.percentile(samples, 95) == 96
+    assert spans.percentile(samples, 100) == 100
+    assert spans.percentile([3.0], 95) == 3.0
+
+
+def test_ring_buffer_wraps_around():
+    s = spans.Spans(capacity=4)
+    for n in range(1, 11):
+        s.add(SPAN, float(n))
+    report = s.report()['test.spans']
+    # count, total and max are of all samples
+    assert report['count'] == 10
+    assert report['total'] == 55
+    assert report['max'] == 10
+    # the percentiles of the last 4 samples, 7 to 10
+    assert report['p50'] == 9
+    assert report['p95'] == 10
+
+
+def test_percentiles_before_wrapping():
+    s = spans.Spans(capacity=8)
+    for sec in (0.3, 0.1, 0.2):
+        s.add(SPAN, sec)
+    report = s.report()['test.spans']
+    assert (report['count'], report['p50'], report['p95']) == (3, 0.2, 0.3)
+    assert report['total'] == pytest.approx(0.6)
+
+
+def test_reset_keeps_lifetime_and_histograms():
+    s = spans.Spans(capacity=4)
+    for sec in (0.001, 0.02, 0.02, 3, 500):
+        s.add(SPAN, sec)
+    s.reset()
+    assert 'test.spans' not in s.report()
+    s.add(SPAN, 0.2)
+    assert s.report()['test.spans']['count'] == 1
+    count, total, cumulative = s.histograms()['test.spans']
+    assert count == 6 and total == pytest.approx(503.241)
+    assert len(cumulative) == len(spans.BUCKETS)
+    # cumulative counts up to each bound; 500 s is above all of them
+    bounds = dict(zip(spans.BUCKETS, cumulative))
+    assert (bounds[0.005], bounds[0.025], bounds[0.25], bounds[5], bounds[120]) == (1, 3, 4, 5, 5)
+
+
+def test_timed_and_phase():
+    class Bot:
+        def __init__(self):
+            self.spans = spans.Spans()
+
+        @spans.timed(SPAN)
+        def step(self):
+            return self.spans.phase
+
+        @spans.phase(PHASE)
+        def play(self):
+            return self.step()
+
+    bot = Bot()
+    assert bot.play() == PHASE
+    assert bot.spans.phase is None
+    report = bot.spans.report()
+    assert report['test.spans']['count'] == report['test.phase']['count'] == 1
+
+
+def test_format_report():
+    s = spans.Spans()
+    s.add(SPAN, 0.5)
+    s.add(PHASE, 2)
+    lines = spans.format_report(s.report()).splitlines()
+    assert lines[0].split() == ['span', 'count', 'total', 'p50', 'p95', 'max']
+    # the slowest in total first, in milliseconds
+    assert lines[1].split() == ['test.phase', '1', '2000', '2000.0', '2000.0', '2000.0']
+    assert lines[2].split()[0] == 'test.spans'
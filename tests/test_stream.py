@@ -0,0 +1,222 @@
+import random
+import threading
+from time import monotonic, sleep
+
+import numpy as np
+import pytest
+
+from fgobot import device, sim
+from fgobot.stream import Frame, FramePipeline, FrameStream
+
+
+class FakeSource:
+    """
+    A frame source whose n-th frame is filled with n, taking `delay` seconds per frame.
+    With `gate`, each frame waits until the gate is released once.
+    """
+
+    def __init__(self, delay: float = 0, gate: bool = False, shape=(720, 1280, 3)):
+        self.delay = delay
+        self.shape = shape
+        self.gate = threading.Semaphore(0) if gate else None
+        self.count = 0
+        self.fail_next = False
+
+    def __call__(self):
+        # a frame not released yet counts as a failed capture, so the stream can stop meanwhile
+        if self.gate is not None and not self.gate.acquire(timeout=0.05):
+            return None
+        if self.delay:
+            sleep(self.delay)
+        if self.fail_next:
+            self.fail_next = False
+            raise OSError('capture failed')
+        self.count += 1
+        return np.full(self.shape, self.count % 256, np.uint8)
+
+    def release(self, frames: int = 1):
+        for _ in range(frames):
+            self.gate.release()
+
+
+@pytest.fixture
+def stream():
+    streams = []
+
+    def start(source, interval=0):
+        s = FrameStream(source, interval)
+        s.start()
+        streams.append(s)
+        return s
+
+    yield start
+    for s in streams:
+        s.stop()
+
+
+def test_latest_waits_for_newer_frame(stream):
+    source = FakeSource(gate=True, shape=(4, 4, 3))
+    s = stream(source)
+    assert s.latest(timeout=0.05) is None
+    source.release()
+    frame = s.latest(timeout=1)
+    assert frame.id == 1 and (frame.image == 1).all()
+    # nothing newer than 1 yet
+    assert s.latest(newer_than=1, timeout=0.05) is None
+    # but the current frame is still served without waiting
+    assert s.latest(newer_than=0, timeout=0).id == 1
+    source.release()
+    frame = s.latest(newer_than=1, timeout=1)
+    assert frame.id == 2 and (frame.image == 2).all()
+
+
+def test_latest_skips_to_newest_frame(stream):
+    source = FakeSource(gate=True, shape=(4, 4, 3))
+    s = stream(source)
+    source.release(3)
+    deadline = monotonic() + 1
+    while source.count < 3 and monotonic() < deadline:
+        sleep(0.01)
+    frame = s.latest(newer_than=0, timeout=1)
+    assert frame.id == 3 and (frame.image == 3).all()
+
+
+def test_latest_times_out(stream):
+    s = stream(FakeSource(gate=True, shape=(4, 4, 3)))
+    start = monotonic()
+    assert s.latest(newer_than=0, timeout=0.2) is None
+    assert 0.2 <= monotonic() - start < 1
+
+
+def test_failed_capture_is_skipped(stream):
+    source = FakeSource(gate=True, shape=(4, 4, 3))
+    source.fail_next = True
+    s = stream(source)
+    source.release(2)
+    frame = s.latest(newer_than=0, timeout=2)
+    assert frame.id == 1 and (frame.image == 1).all()
+
+
+def test_double_buffer_serves_complete_frames(stream):
+    # readers racing the capturing thread always get a frame matching its id,
+    # and a frame they hold is never overwritten
+    s = stream(FakeSource(shape=(90, 160, 3)))
+    held = []
+    last = 0
+    for _ in range(200):
+        frame = s.latest(newer_than=last, timeout=1)
+        assert frame is not None and frame.id > last
+        assert (frame.image == frame.id % 256).all()
+        held.append(frame)
+        last = frame.id
+    for frame in held:
+        assert (frame.image == frame.id % 256).all()
+
+
+def test_stop_wakes_waiting_readers(stream):
+    s = stream(FakeSource(gate=True, shape=(4, 4, 3)))
+    threading.Timer(0.1, s.stop).start()
+    start = monotonic()
+    s.latest(newer_than=0, timeout=5)
+    assert monotonic() - start < 2
+    assert not s.running
+
+
+def test_pipeline_keeps_order():
+    fetched = []
+    lock = threading.Lock()
+
+    def fetch():
+        sleep(random.uniform(0, 0.005))
+        with lock:
+            fetched.append(len(fetched) + 1)
+            return fetched[-1]
+
+    def decode(n):
+        # later frames may decode faster than earlier ones
+        sleep(random.uniform(0, 0.005))
+        return n
+
+    pipeline = FramePipeline(fetch, decode, depth=3)
+    try:
+        frames = [pipeline.next_frame().result(timeout=5) for _ in range(30)]
+    finally:
+        pipeline.stop()
+    assert [f.id for f in frames] == list(range(1, 31))
+    assert [f.image for f in frames] == list(range(1, 31))
+    assert all(a.timestamp <= b.timestamp for a, b in zip(frames, frames[1:]))
+    # no more than `depth` frames in flight beyond those returned
+    assert len(fetched) <= 30 + 3
+
+
+def test_pipeline_raises_failed_fetch():
+    def fetch():
+        raise OSError('no device')
+
+    pipeline = FramePipeline(fetch, lambda data: data)
+    try:
+        with pytest.raises(OSError, match='no device'):
+            pipeline.next_frame().result(timeout=5)
+    finally:
+        pipeline.stop()
+
+
+def test_device_stream_after_sync_captures():
+    dev = device.Device(adb_server=None, timeout=1)
+    dev.probed = True
+    source = FakeSource(gate=True)
+    # screens captured before streaming
+    for n in range(20):
+        dev.set_screen(np.full((720, 1280, 3), 200, np.uint8), monotonic())
+    assert dev.frame_id == 20
+    dev.start_stream(source)
+    try:
+        for n in range(1, 4):
+            source.release()
+            start = monotonic()
+            dev.update_screen()
+            assert monotonic() - start < dev.timeout
+            assert dev.stream_frame_id == n
+            assert dev.frame_id == 20 + n
+            assert (dev.screen == n).all()
+    finally:
+        dev.stop_stream()
+
+
+def test_device_stream_restart_counts_from_one():
+    dev = device.Device(adb_server=None, timeout=1)
+    dev.probed = True
+    for _ in range(2):
+        source = FakeSource(gate=True)
+        dev.start_stream(source)
+        try:
+            source.release()
+            dev.update_screen()
+            assert dev.stream_frame_id == 1
+            assert (dev.screen == 1).all()
+        finally:
+            dev.stop_stream()
+
+
+def test_device_stream_drops_frames_captured_before_tap(server):
+    dev = device.Device(port='127.0.0.1:{}'.format(server.port), adb_server=('127.0.0.1', server.port), timeout=0.5)
+    source = FakeSource(gate=True)
+    dev.start_stream(source)
+    try:
+        source.release()
+        deadline = monotonic() + 1
+        while source.count < 1 and monotonic() < deadline:
+            sleep(0.01)
+        assert dev.tap(*sim.POSITIONS['quest'])
+        # the only frame there is was captured before the tap
+        dev.update_screen()
+        assert dev.screen is None
+        # let the stream start a capture after the tap
+        sleep(0.2)
+        source.release()
+        dev.update_screen()
+        assert dev.stream_frame_id == 2
+        assert (dev.screen == 2).all()
+    finally:
+        dev.stop_stream()
+        dev.adb.close()
@@ -0,0 +1,104 @@
+from time import monotonic
+
+import numpy as np
+import pytest
+
+from fgobot import device, sim
+from fgobot.trace import TraceEnd, TraceRecorder, TraceReplayer
+
+
+@pytest.fixture(scope='module')
+def slow_server(tmp_path_factory):
+    templates, _ = sim.default_templates(tmp_path_factory.mktemp('sim'))
+    # at real speed, the loading after a tap shows animated screens for a second
+    server = sim.Server(sim.Game(templates, speed=1)).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(scope='module')
+def recording(tmp_path_factory, slow_server):
+    """
+    Record a session on the simulated game: the same screen twice, then with a button lit,
+    a command with output, a tap, and the animated loading screens after it.
+
+    :return: the trace directory, the screens and their times from the start of the recording.
+    """
+    dev = device.Device(port='127.0.0.1:{}'.format(slow_server.port),
+                        adb_server=('127.0.0.1', slow_server.port), capture_method=device.RAW_SHELL)
+    dev.probe()
+    path = tmp_path_factory.mktemp('trace')
+    recorder = TraceRecorder(path, keyframe=4)
+    recorder.attach(dev)
+    screens, times = [], []
+
+    def capture():
+        dev.update_screen()
+        screens.append(dev.screen.copy())
+        times.append(dev.frame_time - recorder.start)
+
+    capture()
+    capture()
+    lit = screens[0].copy()
+    x, y = sim.POSITIONS['quest']
+    lit[y:y + 40, x:x + 60] //= 2
+    dev.set_screen(lit, monotonic())
+    screens.append(lit)
+    times.append(dev.frame_time - recorder.start)
+    assert dev.get_screen_size()
+    assert dev.tap(x + 10, y + 10)
+    for _ in range(12):
+        capture()
+    recorder.close()
+    dev.adb.close()
+    return path, screens, times
+
+
+def test_replay_gives_the_recorded_screens(recording):
+    path, screens, times = recording
+    replayer = TraceReplayer(path)
+    dev = device.Device(adb_server=None)
+    replayer.attach(dev)
+    assert len(replayer) == len(screens)
+    for screen, t in zip(screens, times):
+        dev.update_screen()
+        assert np.array_equal(dev.screen, screen)
+        assert dev.frame_time - replayer.origin == pytest.approx(t, abs=1e-9)
+    with pytest.raises(TraceEnd):
+        dev.update_screen()
+
+
+def test_replay_gives_the_recorded_commands(recording):
+    path, _, _ = recording
+    x, y = sim.POSITIONS['quest']
+    events = [e for e in TraceReplayer(path).events if e['kind'] == 'cmd']
+    assert [e['cmd'] for e in events if e['output'] is not None] == [
+        ['shell', 'wm', 'size'], ['shell', 'input tap {} {}'.format(x + 10, y + 10)]]
+    replayer = TraceReplayer(path)
+    for event in events:
+        if event['output'] is not None:
+            assert replayer.command(event['cmd']).decode('utf-8') == event['output']
+    # commands not in the trace get no output
+    assert replayer.command(['shell', 'getprop']) == b''
+
+    dev = device.Device(adb_server=None)
+    TraceReplayer(path).attach(dev)
+    assert dev.get_screen_size()
+    assert dev.screen_size == (sim.SCREEN_SIZE[0], sim.SCREEN_SIZE[1])
+
+
+def test_screens_are_stored_once_and_as_deltas(recording):
+    path, screens, _ = recording
+    replayer = TraceReplayer(path)
+    distinct = {screen.tobytes() for screen in screens}
+    # identical screens share one record, by hash
+    assert len(replayer.index) == len(distinct) < len(screens)
+    bases = [int(b) for b in replayer.index['base']]
+    # every 4th distinct screen whole, the others XORed with the one before
+    assert bases == [-1 if n % 4 == 0 else n - 1 for n in range(len(bases))]
+    for n in range(len(replayer.index)):
+        assert replayer.screen(n).tobytes() in distinct
+    # the screen with a button lit differs from the one before in the button only,
+    # and its delta compresses to much less than a whole screen
+    sizes = replayer.index['size']
+    assert bases[1] == 0 and sizes[1] < sizes[0] / 20
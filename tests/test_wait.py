@@ -0,0 +1,167 @@
+from time import monotonic
+
+import numpy as np
+import pytest
+
+from fgobot import device, sim
+from fgobot.wait import CHANGE_THRESHOLD, ChangeDetector, Poller, count_deadline
+
+
+@pytest.fixture
+def battle(game):
+    game.state, game.stage = 'battle', 2
+    return game.screen()
+
+
+def highlight(screen: np.ndarray, name: str, amount: int = 40) -> np.ndarray:
+    """
+    Return `screen` with the button of template `name` turned on, i.e. brighter.
+    """
+    x, y = sim.POSITIONS[name]
+    lit = screen.copy()
+    area = lit[y:y + 40, x:x + 60].astype(np.int16) + amount
+    lit[y:y + 40, x:x + 60] = np.clip(area, 0, 255)
+    return lit
+
+
+def test_first_screen_counts_as_changed(battle):
+    detector = ChangeDetector()
+    assert detector.update(battle)
+    assert not detector.update(battle.copy())
+    assert detector.update(None)
+    assert detector.update(battle)
+
+
+def test_noise_does_not_count_as_change(battle):
+    detector = ChangeDetector()
+    detector.update(battle)
+    rng = np.random.default_rng(0)
+    noisy = np.clip(battle.astype(np.int16) + rng.integers(-2, 3, battle.shape), 0, 255).astype(np.uint8)
+    assert not detector.update(noisy)
+
+
+def test_small_button_turning_on_is_a_change(battle):
+    detector = ChangeDetector()
+    detector.update(battle)
+    assert detector.update(highlight(battle, 'attack'))
+
+
+def test_slow_fade_is_a_change_once_it_adds_up(battle):
+    detector = ChangeDetector()
+    detector.update(battle)
+    step = CHANGE_THRESHOLD // 2 + 1
+    changes = [detector.update(highlight(battle, 'attack', step * n)) for n in range(1, 5)]
+    # each step alone is under the threshold, two add up to more
+    assert changes == [False, True, False, True]
+
+
+@pytest.fixture
+def dev(battle):
+    dev = device.Device(adb_server=None)
+    dev.set_screen(battle, 0)
+    return dev
+
+
+def matches(dev: device.Device) -> int:
+    return dev.spans.count[device.SPAN_MATCH]
+
+
+def test_unchanged_screen_reuses_match_results(dev, battle):
+    result = dev.match('attack')
+    assert result[1] == sim.POSITIONS['attack']
+    dev.set_screen(battle.copy(), 1)
+    assert not dev.screen_changed
+    assert dev.match('attack') == result
+    assert matches(dev) == 1
+
+
+def test_button_turning_on_clears_match_results(dev, battle):
+    dev.match('attack')
+    dev.set_screen(highlight(battle, 'attack'), 1)
+    assert dev.screen_changed
+    value, loc = dev.match('attack')
+    assert matches(dev) == 2
+    assert loc == sim.POSITIONS['attack'] and value < 0.99
+
+
+def test_switching_engine_clears_match_results(dev):
+    dev.match('attack')
+    dev.engine = device.PYRAMID_MATCH
+    dev.match('attack')
+    assert matches(dev) == 2
+
+
+def test_setting_roi_clears_match_results(dev):
+    dev.set_roi('attack', 0, 0, 400, 300)
+    value, _ = dev.match('attack')
+    # the button is outside the new region
+    assert value < dev.threshold
+    dev.set_roi('attack', *sim.POSITIONS['attack'], 160, 80, margin=10)
+    value, loc = dev.match('attack')
+    assert value >= dev.threshold and loc == sim.POSITIONS['attack']
+    assert matches(dev) == 2
+
+
+def test_poller_backs_off_until_a_change():
+    poller = Poller(0.05, 1, backoff=2)
+    assert [poller.next_interval(False) for _ in range(6)] == [0.1, 0.2, 0.4, 0.8, 1, 1]
+    assert poller.next_interval(True) == 0.05
+    assert poller.next_interval(False) == 0.1
+
+
+def test_poller_stops_at_deadline():
+    now = [0.0]
+    poller = Poller(0.05, 1, deadline=1.5, clock=lambda: now[0])
+    assert poller.next_interval(False) == 0.1
+    now[0] = 1.45
+    assert poller.next_interval(False) == pytest.approx(0.05)
+    now[0] = 1.5
+    assert poller.next_interval(True) is None
+
+
+def test_count_deadline():
+    assert count_deadline(None, 1, 10) is None
+    assert count_deadline(None, 1, 10, 12) == 12
+    assert count_deadline(5, 0.2, 10) == pytest.approx(11)
+    assert count_deadline(5, 0.2, 10, 10.5) == 10.5
+    assert count_deadline(5, 0.2, 10, 20) == pytest.approx(11)
+
+
+@pytest.fixture
+def sim_device(tmp_path, server):
+    _, paths = sim.default_templates(tmp_path)
+    dev = device.Device(port='127.0.0.1:{}'.format(server.port), adb_server=('127.0.0.1', server.port),
+                        capture_method=device.RAW_SHELL)
+    dev.load_images(paths)
+    yield dev
+    dev.adb.close()
+
+
+def test_wait_any_returns_the_image_that_appears(game, sim_device):
+    match = sim_device.wait_match('quest', sec=0.05, countLimit=10)
+    assert sim_device.tap_match(match)
+    match = sim_device.wait_any({'start_quest': None, 'friend_pick': None, 'quest': None}, sec=0.05, countLimit=20)
+    assert match.name == 'friend_pick' and match.loc == sim.POSITIONS['friend_pick']
+    assert game.state == 'quest_confirm'
+
+
+def test_wait_any_prefers_the_first_image(game, sim_device):
+    game.state = 'support'
+    for imgs in ({'friend': None, 'view_friend_party': None}, {'view_friend_party': None, 'friend': None}):
+        match = sim_device.wait_any(imgs, sec=0.05, countLimit=10)
+        assert match.name == next(iter(imgs))
+
+
+def test_count_limit_keeps_the_time_budget(sim_device):
+    # the terminal never shows the attack button
+    start = monotonic()
+    assert not sim_device.wait_until('attack', sec=0.2, countLimit=5)
+    assert 0.95 <= monotonic() - start < 1.6
+    # polling adaptively, more captures fit in that time than the count limit
+    assert sim_device.spans.count[device.SPAN_CAPTURE] > 5
+
+
+def test_wait_until_honours_threshold(sim_device):
+    # the quest is shown as is, and matches with a value of about 1
+    assert not sim_device.wait_until('quest', sec=0.05, threshold=1.01, countLimit=2)
+    assert sim_device.wait_until('quest', sec=0.05, threshold=0.99, countLimit=2)